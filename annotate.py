@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import util
+from lattice import Lattice
+
+'''
+Annotation infers the furigana of every kanji of a (word, reading) pair from
+a trained model, without knowing the answer: the belief of every partition
+is the product of the probabilities of its (kanji, furigana) pairs, as in
+TestCase.test. Kanjis that the model has never seen do not take part in the
+product; when none of the kanjis of the word is known the beliefs are the
+omega heuristics (the baseline algorithm).
+
+The partitions are never listed: the probabilities weight the kanji edges of
+the lattice of the word, and only the best maxAlternatives + 1 partitions are
+found by a k-best search over the lattice, so that a long compound with
+millions of partitions is annotated as fast as a short word.
+
+The model is anything mapping kanjis to objects with prob(furigana): the
+nodeMap of the learner or a snapshot.
+'''
+class Annotation:
+    def __init__(self, word, reading, partitions, beliefs, confidence, unknownKanjis, fallback):
+        self.word = word
+        self.reading = reading
+        self.partitions = partitions  # the best ones, sorted by decreasing belief
+        self.beliefs = beliefs
+        self.confidence = confidence
+        self.unknownKanjis = unknownKanjis
+        self.fallback = fallback  # True if the omega heuristics were used
+
+    @property
+    def bestPartition(self):
+        return self.partitions[0] if self.partitions else None
+
+    def toDict(self, alternatives=None):
+        # alternatives: maximal number of partitions other than the best one
+        n = len(self.partitions) if alternatives is None else alternatives + 1
+        return {
+            'word': self.word,
+            'reading': self.reading,
+            'partition': self.bestPartition,
+            'alternatives': [{'partition': p, 'belief': b}
+                             for p, b in zip(self.partitions[1:n], self.beliefs[1:n])],
+            'belief': self.beliefs[0] if self.beliefs else None,
+            'confidence': self.confidence,
+            'unknown': self.unknownKanjis,
+            'fallback': self.fallback,
+        }
+
+    def __str__(self):
+        if not self.partitions:
+            return u'%s %s: no partition' % (self.word, self.reading)
+        return u'%s %s: %s (confidence %.3f%s)' % (
+            self.word, self.reading, u' '.join([u'%s:%s' % t for t in self.bestPartition]),
+            self.confidence, ', heuristics' if self.fallback else '')
+
+
+class Annotator:
+    def __init__(self, model, maxAlternatives=10):
+        self.model = model
+        # annotations keep at most maxAlternatives partitions besides the best
+        self.maxAlternatives = maxAlternatives
+
+    def annotate(self, word, reading):
+        return self.annotateBatch([(word, reading)])[0]
+
+    def annotateBatch(self, pairs):
+        # annotations of a list of (word, reading), the probability of every
+        # distinct (kanji, furigana) of the batch is looked up once
+        probs = {}
+        def _prob(pair):
+            if pair not in probs:
+                probs[pair] = self.model[pair[0]].prob(pair[1])
+            return probs[pair]
+
+        known = {}
+        def _known(k):
+            if k not in known:
+                known[k] = k in self.model
+            return known[k]
+
+        annotations = []
+        for word, reading in pairs:
+            # the lattice of a query is not interned: the shared tables of the
+            # lattices would otherwise grow with every new pair asked for
+            lattice = Lattice(word, reading, intern=False)
+            if lattice.isEmpty():
+                annotations.append(Annotation(word, reading, [], [], 0.0, [], False))
+                continue
+
+            kanjis = list(lattice.allKanji)
+            if not kanjis:
+                # nothing to infer in a word written in kana
+                annotations.append(Annotation(word, reading, [[]], [10.0], 10.0, [], False))
+                continue
+
+            # the omega heuristics of a partition are the sum of those of its
+            # kanji edges, they break the ties between beliefs
+            unknownKanjis = [k for k in kanjis if not _known(k)]
+            fallback = len(unknownKanjis) == len(kanjis)
+            weights = [1.0] * lattice.numEdges
+            heuristics = [0.0] * lattice.numEdges
+            for e, k, f in lattice.kanjiEdges():
+                heuristics[e] = util.furiganaHeuristics(f)
+                if _known(k):
+                    weights[e] = _prob((k, f))
+
+            # the second best partition is needed for the confidence
+            best = lattice.kBest(weights, max(self.maxAlternatives + 1, 2), heuristics)
+            if fallback:
+                beliefs = [total for _, total, _ in best]
+            else:
+                beliefs = [value for value, _, _ in best]
+            util.normalize_vector(beliefs)
+
+            confidence = 10.0 if len(best) == 1 else beliefs[0] - beliefs[1]
+            del best[self.maxAlternatives + 1:], beliefs[self.maxAlternatives + 1:]
+            annotations.append(Annotation(word, reading, [lattice.partition(path) for _, _, path in best],
+                                          beliefs, confidence, unknownKanjis, fallback))
+        return annotations
@@ -0,0 +1,346 @@
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+import util
+import lattice
+import partitioncache
+import learner
+import test
+
+'''
+The benchmark times the hot paths of inference on synthetic corpora of
+increasing size. A synthetic corpus is drawn from a random lexicon:
+
+  - every kanji has a number of readings (ambiguity), drawn from a pool of
+    random readings of 1 to 3 syllables, so that kanjis share readings
+  - words are made of 1 to maxWordLength kanjis, chosen with a Zipf law
+    (hubness: the larger the exponent, the more words share the most
+    frequent kanjis), and may end with okurigana
+  - the furigana of a word is the concatenation of one reading of each of
+    its kanjis
+
+The test set is a sample of words of several kanjis with their correct
+partition, in the format of test.txt. Every stage is timed at every scale,
+and the results are written as JSON. The learn stages also report the work
+of the residual scheduler: updates per factor, and the number of factors
+that ran out of update budget instead of settling within the tolerance.
+
+With --memory, the size of the model objects (nodes and factors, with all
+they reference) after the first trial is measured instead, and reported per
+100k tuples. The same model is also measured in the layout of the original
+model.py (baseline): objects with a __dict__, partitions listed as lists of
+(kanji, furigana) tuples, omegas and alphas as lists of floats, and a
+pointer to the map of all vertices in every factor.
+'''
+
+SYLLABLES = [unichr(c) for c in range(0x3042, 0x3094)
+             if unichr(c) not in util.AUX_HIRAGANA_SET and unichr(c) not in util.NON_OCCUPYING_HIRAGANA_SET
+             and unichr(c) not in [u'ぃ', u'ぅ', u'ぇ', u'ぉ', u'ゎ']]
+SMALL_SYLLABLES = [u'ゃ', u'ゅ', u'ょ', u'っ', u'ん']
+OKURIGANA = [u'う', u'く', u'す', u'つ', u'る', u'い', u'む', u'ぶ']
+
+
+class SyntheticCorpus:
+    def __init__(self, numKanji=2000, ambiguity=3, readingPool=None, maxWordLength=4,
+                 hubness=1.0, okurigana=0.3, seed=0):
+        self.random = random.Random(seed)
+        self.maxWordLength = maxWordLength
+        self.okurigana = okurigana
+
+        # a CJK code point for every kanji, and its readings
+        readingPool = readingPool or numKanji
+        pool = list(set([self._reading() for _ in range(readingPool)]))
+        self.kanjis = [unichr(0x4E00 + i) for i in range(numKanji)]
+        self.readings = dict([(k, self.random.sample(pool, min(ambiguity, len(pool)))) for k in self.kanjis])
+
+        # cumulative Zipf weights of the kanjis
+        self.cumulative = []
+        total = 0.0
+        for rank in range(numKanji):
+            total += 1.0 / (rank + 1) ** hubness
+            self.cumulative.append(total)
+
+    def _reading(self):
+        reading = u''
+        for _ in range(self.random.choice([1, 1, 2, 2, 2, 3])):
+            reading += self.random.choice(SYLLABLES)
+            if self.random.random() < 0.15:
+                reading += self.random.choice(SMALL_SYLLABLES)
+        return reading
+
+    def _kanji(self):
+        x = self.random.random() * self.cumulative[-1]
+        low, high = 0, len(self.cumulative) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.cumulative[middle] < x:
+                low = middle + 1
+            else:
+                high = middle
+        return self.kanjis[low]
+
+    def word(self, minLength=1):
+        # (kanji, furigana, [furigana of every kanji])
+        kanjis = [self._kanji() for _ in range(self.random.randint(minLength, self.maxWordLength))]
+        answer = [self.random.choice(self.readings[k]) for k in kanjis]
+        word, furigana = u''.join(kanjis), u''.join(answer)
+        if self.random.random() < self.okurigana:
+            ending = self.random.choice(OKURIGANA)
+            word += ending
+            furigana += ending
+        return word, furigana, answer
+
+    def tuples(self, size):
+        for _ in range(size):
+            word, furigana, _ = self.word()
+            yield word, furigana
+
+    def writeTestSet(self, path, size):
+        with open(path, 'w') as f:
+            for _ in range(size):
+                word, furigana, answer = self.word(minLength=2)
+                parts = answer + list(word[len(answer):])
+                f.write((u'%s %s\n' % (word, u','.join(parts))).encode('utf-8'))
+
+
+def _time(function, repeat=1):
+    # best wall time of repeat runs, and the last result
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+_OPAQUE = (type, types.ClassType, types.ModuleType, types.FunctionType, types.BuiltinFunctionType,
+           types.MethodType)
+
+def deepSize(roots):
+    # total size in bytes of the objects reachable from roots, every object
+    # counted once, following containers, __dict__ and __slots__ (but not
+    # classes, modules and functions)
+    seen = set()
+    size = 0
+    stack = list(roots)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _OPAQUE):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, name):
+                    stack.append(getattr(obj, name))
+    return size
+
+
+class _BaselineNode:
+    # the attributes of a node of the original model.py
+    def __init__(self, node):
+        self.kanji = node.kanji
+        self.factors = []
+        self.distribution = dict(node.distribution)
+        self.alphas = list(node.alphas)
+        self.probSmoothing = node.probSmoothing
+
+
+class _BaselineFactor:
+    # the attributes of a factor of the original model.py
+    def __init__(self, factor, verticesMap):
+        self.word = factor.word
+        self.pronunciation = factor.pronunciation
+        self.partitions = util.generatePossiblePartitions(factor.word, factor.pronunciation)
+        self.allKanji = [k for k, _ in self.partitions[0]]
+        self._verticesMap = verticesMap
+        self.omegas = factor.partitionOmegas()
+        bestPartition = factor.bestPartition
+        self.bestPartition = self.partitions[self.partitions.index(bestPartition)] if bestPartition else None
+
+
+def baselineModel(nodeMap, allFactors):
+    # (nodeMap, allFactors) of the same model in the original layout
+    baselineMap = dict([(k, _BaselineNode(node)) for k, node in nodeMap.iteritems()])
+    baselineFactors = []
+    for factor in allFactors:
+        baselineFactor = _BaselineFactor(factor, baselineMap)
+        baselineFactors.append(baselineFactor)
+        for k in baselineFactor.allKanji:
+            baselineMap[k].factors.append(baselineFactor)
+    return baselineMap, baselineFactors
+
+
+def memory(scale, corpus):
+    # (bytes, baseline bytes, decoded bytes, number of factors) of the model
+    # after the first trial: bytes include the shared tables of the lattices
+    # and their decoded structures (which also hold the lattices of previous
+    # scales), decoded bytes are those of the decoded structures alone
+    tuples = list(corpus.tuples(scale))
+    learner.reset()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        learner.learn(0, tuples)
+        learner.adjustParameters()
+    finally:
+        sys.stdout = stdout
+    roots = [learner.nodeMap, learner.allFactors, lattice._buffer, lattice._structures, lattice._kanjis,
+             lattice._decoded, lattice._decodedOffsets, lattice._furiganas]
+    baseline = deepSize(baselineModel(learner.nodeMap, learner.allFactors))
+    decoded = deepSize([lattice._decoded, lattice._decodedOffsets])
+    return deepSize(roots), baseline, decoded, len(learner.allFactors)
+
+
+def benchmark(scale, corpus, testPath, compiled=True, repeat=1):
+    # returns a list of (stage, seconds, count, extra fields of the record)
+    results = []
+    def _record(stage, seconds, count, **extra):
+        results.append((stage, seconds, count, extra))
+        print '  %-28s %9.3fs %8d items %10.1fus/item' % (stage, seconds, count, seconds / max(count, 1) * 1e6)
+
+    def _recordInference(stage, seconds, scheduler):
+        updates = sum(scheduler.updateCounts)
+        factors = len(scheduler.updateCounts)
+        _record(stage, seconds, factors, updates=updates, exhausted=scheduler.exhausted)
+        print '  %-28s %9.1f updates/factor %5d of %d out of budget' % (
+            '', float(updates) / max(factors, 1), scheduler.exhausted, factors)
+
+    tuples = list(corpus.tuples(scale))
+
+    seconds, _ = _time(lambda: [util.generatePossiblePartitions(k, f) for k, f in tuples], repeat)
+    _record('generatePossiblePartitions', seconds, len(tuples))
+
+    # a cold cache computes every distinct pair once, a warm one only decodes
+    cache = partitioncache.PartitionCache()
+    seconds, _ = _time(lambda: [cache.partitions(k, f) for k, f in tuples])
+    _record('partition cache (cold)', seconds, len(tuples))
+    seconds, _ = _time(lambda: [cache.partitions(k, f) for k, f in tuples], repeat)
+    _record('partition cache (warm)', seconds, len(tuples))
+
+    learner.reset()
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        seconds, scheduler = _time(lambda: learner.learn(0, tuples, compiled=compiled))
+        sys.stdout = stdout
+        _recordInference('learn (trial 0)', seconds, scheduler)
+
+        sys.stdout = open(os.devnull, 'w')
+        seconds, _ = _time(learner.adjustParameters)
+        sys.stdout = stdout
+        _record('adjustParameters', seconds, len(learner.allFactors) + len(learner.nodeMap))
+
+        sys.stdout = open(os.devnull, 'w')
+        seconds, scheduler = _time(lambda: learner.learn(1, tuples, compiled=compiled))
+        sys.stdout = stdout
+        _recordInference('learn (trial 1)', seconds, scheduler)
+    finally:
+        sys.stdout = stdout
+
+    # messages of the factors, without the cache
+    def _messages():
+        n = 0
+        for factor in learner.allFactors:
+            factor.invalidateMessages(learner.nodeMap)
+            for k in factor.allKanji:
+                factor.newDistributionForKanji(k, learner.nodeMap)
+                n += 1
+        return n
+    seconds, count = _time(_messages, repeat)
+    _record('Factor.newDistributionForKanji', seconds, count)
+
+    def _updates():
+        for node in learner.nodeMap.itervalues():
+            node.invalidateMessages()
+            node.updateDistribution()
+        return len(learner.nodeMap)
+    seconds, count = _time(_updates, repeat)
+    _record('Node.updateDistribution', seconds, count)
+
+    test.loadTestSet(testPath)
+    seconds, result = _time(lambda: test._performTesting(learner.nodeMap, path=testPath), repeat)
+    _record('_performTesting', seconds, result[0])
+
+    return results
+
+
+def main():
+    argParser = argparse.ArgumentParser(description='Time the inference hot paths on synthetic corpora.')
+    argParser.add_argument('--scales', default='500,1000,2000', help='comma separated corpus sizes')
+    argParser.add_argument('--kanji', type=int, default=2000, help='number of distinct kanjis')
+    argParser.add_argument('--ambiguity', type=int, default=3, help='readings per kanji')
+    argParser.add_argument('--word-length', type=int, default=4, help='maximum number of kanjis per word')
+    argParser.add_argument('--hubness', type=float, default=1.0, help='exponent of the Zipf law of kanjis')
+    argParser.add_argument('--okurigana', type=float, default=0.3, help='probability of okurigana')
+    argParser.add_argument('--test-size', type=int, default=200)
+    argParser.add_argument('--repeat', type=int, default=1, help='best of repeat runs for the short stages')
+    argParser.add_argument('--object-model', action='store_true', help='learn without the compiled graph')
+    argParser.add_argument('--memory', action='store_true', help='measure the size of the model instead of timing')
+    argParser.add_argument('--seed', type=int, default=0)
+    argParser.add_argument('--output', default='result/benchmark.json')
+    args = argParser.parse_args()
+
+    config = {
+        'kanji': args.kanji, 'ambiguity': args.ambiguity, 'wordLength': args.word_length,
+        'hubness': args.hubness, 'okurigana': args.okurigana, 'testSize': args.test_size,
+        'repeat': args.repeat, 'compiled': not args.object_model, 'seed': args.seed, 'memory': args.memory,
+    }
+    corpus = SyntheticCorpus(args.kanji, args.ambiguity, None, args.word_length, args.hubness,
+                             args.okurigana, args.seed)
+
+    tmpDir = tempfile.mkdtemp()
+    testPath = os.path.join(tmpDir, 'test.txt')
+    corpus.writeTestSet(testPath, args.test_size)
+
+    records = []
+    try:
+        for scale in [int(s) for s in args.scales.split(',')]:
+            print ' ** Scale %d:' % scale
+            if args.memory:
+                size, baseline, decoded, numFactors = memory(scale, corpus)
+                for stage, stageSize in [('model memory', size), ('decoded structures', decoded),
+                                         ('baseline model memory', baseline)]:
+                    records.append({'scale': scale, 'stage': stage, 'bytes': stageSize, 'factors': numFactors,
+                                    'bytesPer100kTuples': stageSize * 100000.0 / scale})
+                    print '  %-28s %9.1fMB %8d factors %10.1fMB/100k tuples' % (
+                        stage, stageSize / 1e6, numFactors, stageSize * 0.1 / scale)
+                records.append({'scale': scale, 'stage': 'memory saving', 'ratio': float(baseline) / size})
+                print '  %-28s %9.1fx' % ('saving against baseline', float(baseline) / size)
+                continue
+            for stage, seconds, count, extra in benchmark(scale, corpus, testPath, not args.object_model, args.repeat):
+                record = {'scale': scale, 'stage': stage, 'seconds': seconds, 'count': count,
+                          'secondsPerItem': seconds / max(count, 1)}
+                record.update(extra)
+                records.append(record)
+    finally:
+        shutil.rmtree(tmpDir)
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': config, 'results': records},
+                  f, indent=2, sort_keys=True)
+    print ' ** Results written to %s.' % args.output
+
+
+if __name__ == "__main__":
+    main()
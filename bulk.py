@@ -0,0 +1,144 @@
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import codecs
+import collections
+import json
+import multiprocessing
+import sys
+import time
+
+import ingest
+import snapshot
+from annotate import Annotator
+
+'''
+Bulk annotation of vocabulary files (one "word reading" per line, as in the
+corpus) with a trained model snapshot. The input is streamed in chunks of
+lines, the chunks are annotated by a pool of processes (every process maps
+the snapshot once, and shares its pages with the others), and the results
+are written in the order of the input.
+
+At most window chunks are in flight: reading the input waits for the oldest
+chunk to be written, so memory stays bounded whatever the size of the input.
+'''
+
+_annotator = None
+
+def _initWorker(path, maxAlternatives):
+    global _annotator
+    _annotator = Annotator(snapshot.load(path), maxAlternatives)
+
+
+def formatAnnotation(annotation, outputFormat, alternatives=None):
+    if outputFormat == 'jsonl':
+        return json.dumps(annotation.toDict(alternatives), ensure_ascii=False) + u'\n'
+    partition = u' '.join([u'%s:%s' % t for t in annotation.bestPartition or []])
+    return u'%s\t%s\t%s\t%.3f\t%s\t%s\n' % (
+        annotation.word, annotation.reading, partition, annotation.confidence,
+        u'heuristics' if annotation.fallback else u'model', u''.join(annotation.unknownKanjis))
+
+
+def formatError(lineNumber, line, outputFormat):
+    if outputFormat == 'jsonl':
+        return json.dumps({'line': lineNumber, 'error': 'invalid line', 'text': line}, ensure_ascii=False) + u'\n'
+    return u'#\t%d\tinvalid line\t%s\n' % (lineNumber, line)
+
+
+def _annotateChunk(args):
+    # the formatted output of a chunk of (lineNumber, line)
+    chunk, outputFormat, alternatives = args
+    valid = []
+    for lineNumber, line in chunk:
+        fields = line.split()
+        if len(fields) == 2:
+            valid.append((lineNumber, fields[0], fields[1]))
+    annotations = iter(_annotator.annotateBatch([(word, reading) for _, word, reading in valid]))
+    validLines = set([lineNumber for lineNumber, _, _ in valid])
+
+    output = []
+    for lineNumber, line in chunk:
+        if lineNumber in validLines:
+            output.append(formatAnnotation(next(annotations), outputFormat, alternatives))
+        else:
+            output.append(formatError(lineNumber, line.rstrip(), outputFormat))
+    return u''.join(output)
+
+
+def _chunks(path, chunkSize):
+    chunk = []
+    for _, lineNumber, line in ingest.readLines([path]):
+        if not line.strip():
+            continue
+        chunk.append((lineNumber, line))
+        if len(chunk) == chunkSize:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def annotateFile(inputPath, output, modelPath, outputFormat='jsonl', alternatives=3,
+                 numProcesses=None, chunkSize=500, window=None):
+    # annotate every line of inputPath into the file object output, returns
+    # the number of lines
+    numProcesses = numProcesses or multiprocessing.cpu_count()
+    window = window or 2 * numProcesses
+    chunks = ((chunk, outputFormat, alternatives) for chunk in _chunks(inputPath, chunkSize))
+
+    nLines = 0
+    if numProcesses == 1:
+        _initWorker(modelPath, alternatives)
+        for args in chunks:
+            output.write(_annotateChunk(args))
+            nLines += len(args[0])
+        return nLines
+
+    pool = multiprocessing.Pool(numProcesses, _initWorker, (modelPath, alternatives))
+    try:
+        pending = collections.deque()
+        for args in chunks:
+            if len(pending) >= window:
+                output.write(pending.popleft().get())
+            pending.append(pool.apply_async(_annotateChunk, (args,)))
+            nLines += len(args[0])
+        while pending:
+            output.write(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return nLines
+
+
+def main():
+    argParser = argparse.ArgumentParser(description='Annotate a vocabulary file with a trained model.')
+    argParser.add_argument('input', help='file of "word reading" lines')
+    argParser.add_argument('-o', '--output', help='output file (standard output by default)')
+    argParser.add_argument('-m', '--model', default='result/model.snapshot', help='model snapshot')
+    argParser.add_argument('-f', '--format', choices=['jsonl', 'tsv'], default='jsonl')
+    argParser.add_argument('-a', '--alternatives', type=int, default=3,
+                           help='number of alternative partitions in JSONL output')
+    argParser.add_argument('-j', '--processes', type=int, default=None)
+    argParser.add_argument('--chunk-size', type=int, default=500)
+    argParser.add_argument('--window', type=int, default=None, help='maximal number of chunks in flight')
+    args = argParser.parse_args()
+
+    if args.output:
+        output = codecs.open(args.output, 'w', encoding='utf-8')
+    else:
+        output = codecs.getwriter('utf-8')(sys.stdout)
+
+    start = time.time()
+    try:
+        nLines = annotateFile(args.input, output, args.model, args.format, args.alternatives,
+                              args.processes, args.chunk_size, args.window)
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.time() - start
+    sys.stderr.write(' ** Annotated %d lines in %.1fs (%.0f lines/s).\n' % (nLines, elapsed, nLines / max(elapsed, 1e-9)))
+
+
+if __name__ == "__main__":
+    main()
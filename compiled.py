@@ -0,0 +1,620 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import operator
+import time
+from array import array
+
+import metrics
+import util
+from scheduler import ResidualScheduler
+
+'''
+A compiled graph holds the factor graph of nodeMap and allFactors in flat
+tables indexed by interned integer ids, for learner.learn(compiled=True):
+
+  - kanjis and furiganas are interned (kanjiTable / kanjiIds, furiganaTable /
+    furiganaIds)
+  - the domain of node n is the slots nodeOffsets[n] to nodeOffsets[n + 1]:
+    nodeFurigana is the furigana of every slot, prob its probability (0.0 if
+    the furigana is not in the distribution) and value what the factors read
+    (the probability, or the smoothing of the node)
+  - the positions of node n, one per entry of Node.factors, are
+    nodeFactorOffsets[n] to nodeFactorOffsets[n + 1]: nodeFactors is the
+    factor of every position and weights its weight (alpha times the number
+    of occurrences seen, 0.0 for a factor not seen yet)
+  - the kanjis of factor f are factorKanji[factorKanjiOffsets[f]:...], and
+    factorKanjiPos is the position of the factor in each of them
+  - the partitions of factor f are the paths factorPathOffsets[f] to
+    factorPathOffsets[f + 1], pathOmega is the product of the omegas of the
+    edges of every path
+
+The message of a factor to node n is, for every path and every edge of n on
+it, the omega of the path times the values of the other kanji edges of the
+path, summed per slot and normalized (the same sums as Lattice.marginals,
+partitions being few). These terms are listed once per position with slot
+numbers, so that a message is a loop over floats without any lookup by
+string. A factor with one kanji, or with one path and the kanji only once,
+sends the same message whatever the distributions: it is computed once and
+never made stale. A factor with more than MAX_PATHS paths is left to its
+lattice.
+
+Messages and their weighted sums are kept per position and per node, and
+updated in the same order as the Node objects do, so that inference on a
+compiled graph updates the nodes in the same order and the distributions
+only differ by rounding (the probabilities of a node are not summed in the
+same order as in a dict, so a residual right on the tolerance can fall on
+the other side of it and the schedules part from there). A factor that sends the same message whatever the
+distributions does not make its kanjis neighbours either: a change of one
+cannot change the other through it (the Node objects skip them too). Ids are
+kept in arrays; the floats are kept in lists as they are read by the inner
+loops. CompiledScheduler runs the residual scheduler on the ids of the
+graph, and CompiledNode and CompiledFactor are thin views with the interface
+of Node and Factor.
+'''
+
+MAX_PATHS = 256
+
+
+class CompiledGraph:
+    def __init__(self, nodeMap, allFactors, numActive=None):
+        self.kanjiTable = []
+        self.kanjiIds = {}
+        self.furiganaTable = []
+        self.furiganaIds = {}
+
+        self._nodes = []
+        self._factors = list(allFactors)
+        self.factorIds = {}
+        for f, factor in enumerate(self._factors):
+            self.factorIds[factor] = f
+            for k in factor.allKanji:
+                if k not in self.kanjiIds:
+                    self.kanjiIds[k] = len(self.kanjiTable)
+                    self.kanjiTable.append(k)
+                    self._nodes.append(nodeMap[k])
+
+        # the domain of a node: its distribution, and the furiganas of its
+        # edges in all its factors
+        self._domains = [{} for _ in self._nodes]  # furigana id -> slot in the domain
+        domainFuriganas = [[] for _ in self._nodes]
+
+        def _slot(n, furigana):
+            fid = self.furiganaIds.get(furigana)
+            if fid is None:
+                fid = self.furiganaIds[furigana] = len(self.furiganaTable)
+                self.furiganaTable.append(furigana)
+            domain = self._domains[n]
+            if fid not in domain:
+                domain[fid] = len(domainFuriganas[n])
+                domainFuriganas[n].append(fid)
+            return domain[fid]
+
+        for n, node in enumerate(self._nodes):
+            for furigana in sorted(node.distribution):
+                _slot(n, furigana)
+
+        # the kanji edges of every factor as (edge, node, slot in the domain),
+        # and its paths (None if there are too many)
+        factorEdges = []
+        factorPaths = []
+        for factor in self._factors:
+            edges = [(e, self.kanjiIds[k], _slot(self.kanjiIds[k], furigana))
+                     for e, k, furigana in factor.lattice.kanjiEdges()]
+            factorEdges.append(edges)
+            paths = list(itertools.islice(factor.lattice.paths(), MAX_PATHS + 1))
+            factorPaths.append(paths if len(paths) <= MAX_PATHS else None)
+
+        self.nodeOffsets = array('l', [0])
+        self.nodeFurigana = array('l')
+        for furiganas in domainFuriganas:
+            self.nodeFurigana.extend(furiganas)
+            self.nodeOffsets.append(len(self.nodeFurigana))
+        numSlots = len(self.nodeFurigana)
+
+        # positions, in the order of Node.factors
+        self.nodeFactorOffsets = array('l', [0])
+        self.nodeFactors = array('l')
+        for node in self._nodes:
+            self.nodeFactors.extend([self.factorIds[factor] for factor in node.factors])
+            self.nodeFactorOffsets.append(len(self.nodeFactors))
+        numPositions = len(self.nodeFactors)
+        self._positionNode = array('l')
+        for n in xrange(len(self._nodes)):
+            self._positionNode.extend([n] * (self.nodeFactorOffsets[n + 1] - self.nodeFactorOffsets[n]))
+
+        positions = {}
+        for j, f in enumerate(self.nodeFactors):
+            positions.setdefault((f, self._positionNode[j]), []).append(j)
+        self.factorKanjiOffsets = array('l', [0])
+        self.factorKanji = array('l')
+        self.factorKanjiPos = array('l')
+        for f, factor in enumerate(self._factors):
+            for k in factor.allKanji:
+                n = self.kanjiIds[k]
+                self.factorKanji.append(n)
+                self.factorKanjiPos.append(positions[(f, n)].pop(0))
+            self.factorKanjiOffsets.append(len(self.factorKanji))
+
+        # the paths of every factor, and the terms of the message of every
+        # position: (path, slots of the other kanji edges, index of the slot
+        # of the edge of the node in _positionSlots)
+        self.factorPathOffsets = array('l', [0])
+        self._pathEdges = []
+        self._positionSlots = [()] * numPositions  # slots of the message, in the domain of the node
+        self._positionTerms = [None] * numPositions
+        self._constants = [None] * numPositions    # message of a factor that sends the same one
+        self._latticeEdges = {}  # factor -> (edge, slot) of its kanji edges, without paths
+        offsets = self.nodeOffsets
+        for f, factor in enumerate(self._factors):
+            edges = factorEdges[f]
+            paths = factorPaths[f]
+            if paths is not None:
+                for path in paths:
+                    self._pathEdges.append(tuple(path))
+            self.factorPathOffsets.append(len(self._pathEdges))
+            if paths is None:
+                self._latticeEdges[f] = [(e, offsets[n] + s) for e, n, s in edges]
+
+            edgeSlots = dict([(e, (n, s)) for e, n, s in edges])
+            kanjiIds = self.factorKanji[self.factorKanjiOffsets[f]:self.factorKanjiOffsets[f + 1]]
+            for p, n in enumerate(kanjiIds):
+                j = self.factorKanjiPos[self.factorKanjiOffsets[f] + p]
+                if len(kanjiIds) == 1:
+                    # uniform over the furiganas of the factor
+                    furiganas = factor.lattice.furiganaSet()
+                    message = util.normalize(dict([(furigana, 1.0 / len(furiganas)) for furigana in furiganas]))
+                    items = [(self._domains[n][self.furiganaIds[furigana]], x) for furigana, x in message.iteritems()]
+                elif paths is not None and len(paths) == 1 and kanjiIds.count(n) == 1:
+                    # the furigana of the edge of the kanji on the only path
+                    items = [(edgeSlots[e][1], 1.0) for e in paths[0] if e in edgeSlots and edgeSlots[e][0] == n]
+                else:
+                    items = None
+                if items is not None:
+                    self._positionSlots[j] = tuple([s for s, _ in items])
+                    self._constants[j] = [x for _, x in items]
+                    continue
+
+                slots = []
+                for e, m, s in edges:
+                    if m == n and s not in slots:
+                        slots.append(s)
+                self._positionSlots[j] = tuple(slots)
+                if paths is None:
+                    continue
+                terms = []
+                p0 = self.factorPathOffsets[f]
+                for i, path in enumerate(paths):
+                    onPath = [e for e in path if e in edgeSlots]
+                    for e in onPath:
+                        m, s = edgeSlots[e]
+                        if m == n:
+                            others = tuple([offsets[edgeSlots[o][0]] + edgeSlots[o][1] for o in onPath if o != e])
+                            terms.append((p0 + i, others, slots.index(s)))
+                self._positionTerms[j] = tuple(terms)
+
+        # the positions of the messages that depend on the distribution of
+        # every node, and the (factor, kanji, positions in the kanji) of its
+        # neighbours, by factor
+        self._dependents = []
+        self._neighbours = []
+        for n in xrange(len(self._nodes)):
+            dependents = []
+            neighbours = []
+            previous = None
+            for f in self.nodeFactors[self.nodeFactorOffsets[n]:self.nodeFactorOffsets[n + 1]]:
+                if f == previous:
+                    continue  # the kanji appears twice in the factor
+                previous = f
+                k0, k1 = self.factorKanjiOffsets[f], self.factorKanjiOffsets[f + 1]
+                kanjiIds = self.factorKanji[k0:k1]
+                seen = set()
+                for p in xrange(k0, k1):
+                    k, j = self.factorKanji[p], self.factorKanjiPos[p]
+                    if self._constants[j] is None and (k != n or kanjiIds.count(n) > 1):
+                        dependents.append((f, k, j))
+                    if k != n and k not in seen and self._constants[j] is None:
+                        seen.add(k)
+                        neighbours.append((f, k, tuple([self.factorKanjiPos[q] for q in xrange(k0, k1)
+                                                        if self.factorKanji[q] == k])))
+            self._dependents.append(tuple(dependents))
+            self._neighbours.append(tuple(neighbours))
+
+        self.prob = [0.0] * numSlots
+        self.value = [0.0] * numSlots
+        self.smoothing = [0.0] * len(self._nodes)
+        self.residual = [0.0] * len(self._nodes)
+        self.factorWeight = [0.0] * len(self._factors)
+        self.weights = [0.0] * numPositions
+        self.pathOmega = [1.0] * len(self._pathEdges)
+        self._alphas = [None] * len(self._nodes)
+
+        # the weighted sum of the messages to every node is kept between
+        # updates, only the stale positions are summed in again
+        self._messages = [None] * numPositions
+        self._sums = [None] * len(self._nodes)
+        self._stale = [set() for _ in self._nodes]
+        self._totals = [None] * len(self._nodes)
+        self._shares = [None] * len(self._nodes)  # adjacentShares, until a weight changes
+
+        # factors with an id >= numActive have not been seen yet (trial 0)
+        self.numActive = len(self._factors) if numActive is None else numActive
+
+        self.nodes = dict([(k, CompiledNode(self, n)) for n, k in enumerate(self.kanjiTable)])
+        self.factors = [CompiledFactor(self, f) for f in xrange(len(self._factors))]
+        self.load()
+
+    def compiles(self, nodeMap, allFactors):
+        # True if the graph is still the one of nodeMap and allFactors
+        return (len(allFactors) == len(self._factors) and all([a is b for a, b in zip(allFactors, self._factors)])
+                and all([nodeMap.get(k) is node for k, node in zip(self.kanjiTable, self._nodes)]))
+
+    def load(self):
+        # copy distributions, smoothings, alphas and omegas from the node and
+        # factor objects (the distributions have to fit in the domains)
+        prob, value = self.prob, self.value
+        for n, node in enumerate(self._nodes):
+            d0, d1 = self.nodeOffsets[n], self.nodeOffsets[n + 1]
+            smoothing = self.smoothing[n] = node.probSmoothing
+            prob[d0:d1] = [0.0] * (d1 - d0)
+            value[d0:d1] = [smoothing] * (d1 - d0)
+            domain = self._domains[n]
+            for furigana, p in node.distribution.iteritems():
+                s = d0 + domain[self.furiganaIds[furigana]]
+                prob[s] = value[s] = p
+            self._alphas[n] = list(node.alphas) if node.alphas else None
+
+        for f, factor in enumerate(self._factors):
+            self.factorWeight[f] = float(factor.weight) if f < self.numActive else 0.0
+            omegas = factor.omegas
+            for p in xrange(self.factorPathOffsets[f], self.factorPathOffsets[f + 1]):
+                omega = 1.0
+                if omegas:
+                    for e in self._pathEdges[p]:
+                        omega *= omegas[e]
+                self.pathOmega[p] = omega
+
+        for n in xrange(len(self._nodes)):
+            self._updateWeights(n)
+        self._messages = [None] * len(self.nodeFactors)
+        self._sums = [None] * len(self._nodes)
+        for stale in self._stale:
+            stale.clear()
+
+    def _updateWeights(self, n):
+        # same as Node._weight, for all the positions of n
+        j0, j1 = self.nodeFactorOffsets[n], self.nodeFactorOffsets[n + 1]
+        factorWeight = self.factorWeight
+        alphas = self._alphas[n]
+        if alphas:
+            self.weights[j0:j1] = [alpha * factorWeight[f] for alpha, f in zip(alphas, self.nodeFactors[j0:j1])]
+        else:
+            self.weights[j0:j1] = [factorWeight[f] for f in self.nodeFactors[j0:j1]]
+        self._totals[n] = None
+        self._shares[n] = None
+        for _, k, _ in self._neighbours[n]:
+            self._shares[k] = None
+
+    def addOccurrence(self, factor):
+        # one more occurrence of the tuple of factor has been seen: a new
+        # factor becomes active (its messages are stale), the messages of a
+        # known one weigh more (the sums are summed again)
+        f = self.factorIds[factor]
+        k0, k1 = self.factorKanjiOffsets[f], self.factorKanjiOffsets[f + 1]
+        if f >= self.numActive:
+            for g in xrange(self.numActive, f + 1):
+                self.factorWeight[g] = 1.0
+            self.numActive = f + 1
+            for p in xrange(k0, k1):
+                self._stale[self.factorKanji[p]].add(self.factorKanjiPos[p])
+        else:
+            self.factorWeight[f] += 1.0
+            for n in self.factorKanji[k0:k1]:
+                self._sums[n] = None
+        for n in set(self.factorKanji[k0:k1]):
+            self._updateWeights(n)
+
+    def store(self, kanjis=None):
+        # copy the distributions back to the node objects (only the nodes of
+        # kanjis if given)
+        if kanjis is None:
+            ids = xrange(len(self._nodes))
+        else:
+            ids = [self.kanjiIds[k] for k in kanjis if k in self.kanjiIds]
+        for n in ids:
+            node = self._nodes[n]
+            node.probSmoothing = self.smoothing[n]
+            node.setDistribution(self.distribution(n))
+
+    def distribution(self, n):
+        prob = self.prob
+        distribution = {}
+        for s in xrange(self.nodeOffsets[n], self.nodeOffsets[n + 1]):
+            if prob[s]:
+                distribution[self.furiganaTable[self.nodeFurigana[s]]] = prob[s]
+        return distribution
+
+    def probOf(self, n, furigana):
+        s = self._domains[n].get(self.furiganaIds.get(furigana))
+        if s is None:
+            return self.smoothing[n]
+        return self.value[self.nodeOffsets[n] + s]
+
+    def message(self, j):
+        # the message (one probability per slot of _positionSlots[j]) of the
+        # factor of position j to its node, same as Factor.newDistributionForKanji
+        constant = self._constants[j]
+        if constant is not None:
+            return constant
+        terms = self._positionTerms[j]
+        if terms is None:
+            return self._latticeMessage(j)
+
+        value, pathOmega = self.value, self.pathOmega
+        message = [0.0] * len(self._positionSlots[j])
+        for p, others, i in terms:
+            w = pathOmega[p]
+            for s in others:
+                w *= value[s]
+            message[i] += w
+        total = sum(message)
+        return [x if x >= 1e-3 else 0.0 for x in [x / total for x in message]]
+
+    def _latticeMessage(self, j):
+        # the message of a factor with too many paths, by its lattice
+        f, n = self.nodeFactors[j], self._positionNode[j]
+        factor = self._factors[f]
+        ownWeights = factor.omegas or [1.0] * factor.lattice.numEdges
+        weights = list(ownWeights)
+        value = self.value
+        for e, s in self._latticeEdges[f]:
+            weights[e] *= value[s]
+        distribution = util.normalize(factor.lattice.marginals(self.kanjiTable[n], weights, ownWeights))
+        slots = self._positionSlots[j]
+        message = [0.0] * len(slots)
+        domain = self._domains[n]
+        for furigana, x in distribution.iteritems():
+            message[slots.index(domain[self.furiganaIds[furigana]])] = x
+        return message
+
+    def _updateMessageSum(self, n):
+        # same as Node._updateMessageSum
+        messages, weights, slots = self._messages, self.weights, self._positionSlots
+        sums = self._sums[n]
+        if sums is None:
+            # summed again from scratch, with the messages that are not stale
+            # (as the Factor objects keep theirs)
+            sums = [0.0] * (self.nodeOffsets[n + 1] - self.nodeOffsets[n])
+            stale = self._stale[n]
+            j0 = self.nodeFactorOffsets[n]
+            for f in self.nodeFactors[j0:self.nodeFactorOffsets[n + 1]]:
+                if f >= self.numActive:
+                    break
+                message = messages[j0]
+                if message is None or j0 in stale:
+                    message = messages[j0] = self.message(j0)
+                w = weights[j0]
+                for i, x in zip(slots[j0], message):
+                    sums[i] += x * w
+                j0 += 1
+        else:
+            message = self.message
+            for j in sorted(self._stale[n]):
+                new = message(j)
+                w = weights[j]
+                old = messages[j]
+                if old is None:
+                    for i, y in zip(slots[j], new):
+                        sums[i] += y * w
+                else:
+                    for i, x, y in zip(slots[j], old, new):
+                        sums[i] += (y - x) * w
+                messages[j] = new
+            # drop what is left of removed entries (rounding errors)
+            sums = [x if x >= 1e-12 else 0.0 for x in sums]
+        self._sums[n] = sums
+        self._stale[n].clear()
+        return sums
+
+    def updateNode(self, n, damping=0.0):
+        # same as Node.updateDistribution, returns True if nothing changed
+        sums = self._sums[n]
+        if sums is None or self._stale[n]:
+            sums = self._updateMessageSum(n)
+        total = sum(sums)
+        distribution = [x if x >= 1e-3 else 0.0 for x in [x / total for x in sums]]
+
+        d0, d1 = self.nodeOffsets[n], self.nodeOffsets[n + 1]
+        old = self.prob[d0:d1]
+        if damping:
+            keep = 1.0 - damping
+            mixed = [damping * x + keep * y for x, y in zip(old, distribution)]
+            total = sum(mixed)
+            distribution = [x if x >= 1e-3 else 0.0 for x in [x / total for x in mixed]]
+
+        residual = self.residual[n] = max(map(abs, map(operator.sub, old, distribution)))
+        if residual > util.SAME_DISTRIBUTION_TOLERANCE:
+            self._setDistribution(n, distribution)
+            return False
+        return True
+
+    def _setDistribution(self, n, distribution):
+        # the messages of all active factors of n to the other kanjis (and to
+        # n itself if it appears twice in the factor) become stale
+        d0, d1 = self.nodeOffsets[n], self.nodeOffsets[n + 1]
+        smoothing = self.smoothing[n]
+        self.prob[d0:d1] = distribution
+        self.value[d0:d1] = [x or smoothing for x in distribution]
+        numActive, stale = self.numActive, self._stale
+        for f, k, j in self._dependents[n]:
+            if f >= numActive:
+                break
+            stale[k].add(j)
+
+    def _total(self, n):
+        # same as Node._totalWeight
+        if self._totals[n] is None:
+            j0, j1 = self.nodeFactorOffsets[n], self.nodeFactorOffsets[n + 1]
+            self._totals[n] = float(sum(self.weights[j0:j1]))
+        return self._totals[n]
+
+    def adjacentShares(self, n):
+        # same as Node.adjacentShares, with the ids of the kanjis
+        if self._shares[n] is not None:
+            return self._shares[n]
+        shares = {}
+        order = []
+        weights, numActive = self.weights, self.numActive
+        for f, k, positions in self._neighbours[n]:
+            if f >= numActive:
+                break
+            total = self._totals[k]
+            if total is None:
+                total = self._total(k)
+            share = sum([weights[j] for j in positions]) / total if total else 0.0
+            if share > shares.get(k, 0.0):
+                if k not in shares:
+                    order.append(k)
+                shares[k] = share
+        self._shares[n] = [(k, shares[k]) for k in order]
+        return self._shares[n]
+
+    def adjacentKanjis(self, n):
+        kanji_set = set()
+        for f, k, _ in self._neighbours[n]:
+            if f >= self.numActive:
+                break
+            kanji_set.add(self.kanjiTable[k])
+        return kanji_set
+
+    def resetDistribution(self, n):
+        # same as Node.resetDistribution
+        d0, d1 = self.nodeOffsets[n], self.nodeOffsets[n + 1]
+        old = self.prob[d0:d1]
+        numFurigana = len([x for x in old if x > 0.01])
+        self.smoothing[n] = 0.001
+        self._setDistribution(n, [1.0 / numFurigana if x > 0.01 else 0.0 for x in old])
+
+
+class CompiledScheduler(ResidualScheduler):
+    # ResidualScheduler.infer on the ids of a compiled graph: the same
+    # updates in the same order, without the views
+    def __init__(self, graph, tolerance=1e-2, updatesPerKanji=20, damping=0.5):
+        ResidualScheduler.__init__(self, graph.nodes, tolerance, updatesPerKanji, damping)
+        self.graph = graph
+
+    def infer(self, factor):
+        graph = self.graph
+        tolerance, damping = self.tolerance, self.damping
+        kanjiTable, nodeResidual = graph.kanjiTable, graph.residual
+        changed, updated = self.changed, self.updated
+        heap = []
+        residuals = {}
+        order = itertools.count()
+
+        f = graph.factorIds[factor]
+        kanjis = graph.factorKanji[graph.factorKanjiOffsets[f]:graph.factorKanjiOffsets[f + 1]]
+        for n in kanjis:
+            if n not in residuals:
+                residuals[n] = float('inf')
+                heapq.heappush(heap, (float('-inf'), next(order), n))
+
+        m = metrics.current
+        enabled = m.enabled
+
+        updates = 0
+        budget = self.updatesPerKanji * len(set(kanjis))
+        while heap and updates < budget:
+            negResidual, _, n = heapq.heappop(heap)
+            if residuals.get(n) != -negResidual:
+                continue  # outdated entry, the node has been pushed again
+            del residuals[n]
+
+            if enabled:
+                start = time.time()
+            unchanged = graph.updateNode(n, damping)
+            if enabled:
+                m.addTime('node.update', time.time() - start, kanjiTable[n])
+                m.count('node.update.unchanged' if unchanged else 'node.update.changed')
+            if not unchanged:
+                changed.add(kanjiTable[n])
+            updated.add(kanjiTable[n])
+            updates += 1
+            residual = min(nodeResidual[n], -negResidual)
+            if residual > tolerance:
+                for k, share in graph.adjacentShares(n):
+                    r = residual * share
+                    if r > tolerance and r > residuals.get(k, 0.0):
+                        residuals[k] = r
+                        heapq.heappush(heap, (-r, next(order), k))
+
+        if residuals:
+            self.exhausted += 1
+        self.updateCounts.append(updates)
+        if enabled:
+            m.count('infer.factors')
+            if residuals:
+                m.count('infer.exhausted')
+            m.observe('infer.updates', updates)
+        return updates
+
+
+'''
+Thin views over a compiled graph, with the interface of Node and Factor.
+'''
+class CompiledNode(object):
+    __slots__ = ('graph', 'id', 'kanji')
+
+    def __init__(self, graph, n):
+        self.graph = graph
+        self.id = n
+        self.kanji = graph.kanjiTable[n]
+
+    @property
+    def distribution(self):
+        return self.graph.distribution(self.id)
+
+    @property
+    def probSmoothing(self):
+        return self.graph.smoothing[self.id]
+
+    @property
+    def residual(self):
+        return self.graph.residual[self.id]
+
+    def prob(self, furigana):
+        return self.graph.probOf(self.id, furigana)
+
+    def updateDistribution(self, damping=0.0):
+        return self.graph.updateNode(self.id, damping)
+
+    def adjacentShares(self):
+        kanjiTable = self.graph.kanjiTable
+        return [(kanjiTable[k], share) for k, share in self.graph.adjacentShares(self.id)]
+
+    def allAdjacentKanjis(self):
+        return self.graph.adjacentKanjis(self.id)
+
+    def resetDistribution(self):
+        self.graph.resetDistribution(self.id)
+
+
+class CompiledFactor(object):
+    __slots__ = ('graph', 'id', 'allKanji')
+
+    def __init__(self, graph, f):
+        self.graph = graph
+        self.id = f
+        self.allKanji = graph._factors[f].allKanji
+
+    def newDistributionForKanji(self, kanji, nodeMap=None):
+        graph = self.graph
+        n = graph.kanjiIds[kanji]
+        p = graph.factorKanji[graph.factorKanjiOffsets[self.id]:graph.factorKanjiOffsets[self.id + 1]].index(n)
+        j = graph.factorKanjiPos[graph.factorKanjiOffsets[self.id] + p]
+        distribution = {}
+        for s, x in zip(graph._positionSlots[j], graph.message(j)):
+            if x:
+                distribution[graph.furiganaTable[graph.nodeFurigana[graph.nodeOffsets[n] + s]]] = x
+        return distribution
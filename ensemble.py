@@ -0,0 +1,148 @@
+
+# -*- coding: utf-8 -*-
+
+import argparse
+import codecs
+import math
+import multiprocessing
+import os
+import random
+import sys
+from array import array
+
+import util
+import learner
+import ingest
+from test import testModel
+
+'''
+The model learned from a corpus depends on the order of its tuples: factors
+are inferred one after another, and the messages of the first ones shape
+the distributions seen by the next ones. An ensemble trains several members
+in a pool of processes, each on the tuples shuffled with its own seed, and
+averages them into one model:
+
+  - the distribution (and smoothing) of every kanji is the mean of its
+    distributions in the members
+  - the omegas of every factor are the mean of its omegas in the members,
+    its best partition is the best path of the mean omegas, and the alphas
+    are computed again from the best partitions
+
+The spread of the members tells how stable the model is: for every kanji,
+the standard deviation of the probability of each furigana over the
+members is reported, and the largest one is the instability of the kanji.
+'''
+
+def _trainMember(args):
+    tuples, seed, numTrials = args
+    sys.stdout = open(os.devnull, 'w')
+    tuples = list(tuples)
+    random.Random(seed).shuffle(tuples)
+    learner.reset()
+    learner.train(tuples, numTrials, compiled=True, activeSet=True)
+
+    nodes = dict([(k, (node.distribution, node.probSmoothing)) for k, node in learner.nodeMap.iteritems()])
+    factors = dict([((factor.word, factor.pronunciation), factor.omegas) for factor in learner.allFactors])
+    return nodes, factors
+
+
+def average(tuples, members):
+    # build the graph of tuples in learner with the mean of the members,
+    # returns {kanji: [(furigana, mean, standard deviation)]} by decreasing
+    # mean
+    learner.reset()
+    for kanji, furigana in tuples:
+        learner.construct(kanji, furigana)
+    n = float(len(members))
+
+    spreads = {}
+    for k, node in learner.nodeMap.iteritems():
+        distributions = [nodes[k][0] for nodes, _ in members]
+        mean = {}
+        for distribution in distributions:
+            util.addDistribution(mean, distribution, weight=1.0 / n)
+        spread = []
+        for f, p in mean.iteritems():
+            variance = sum([(distribution.get(f, 0.0) - p) ** 2 for distribution in distributions]) / n
+            spread.append((f, p, math.sqrt(variance)))
+        spreads[k] = sorted(spread, key=lambda t: (-t[1], t[0]))
+        node.probSmoothing = sum([nodes[k][1] for nodes, _ in members]) / n
+        node.setDistribution(util.normalize(mean))
+
+    for factor in learner.allFactors:
+        key = (factor.word, factor.pronunciation)
+        omegas = array('d', [0.0]) * factor.lattice.numEdges
+        for _, factors in members:
+            for e, omega in enumerate(factors[key]):
+                omegas[e] += omega / n
+        factor.omegas = omegas
+        factor.setBestPath(tuple(factor.lattice.viterbi(omegas)), learner.nodeMap)
+    for node in learner.nodeMap.itervalues():
+        node.updateWeightVectorAlpha()
+
+    # the averaged model is adjusted, only what changes from now on has to be
+    learner.staleFactors.clear()
+    for k, node in learner.nodeMap.iteritems():
+        learner.adjustedDistributions[k] = (dict(node.distribution), node.probSmoothing)
+    learner.readingIndex.update(learner.nodeMap.itervalues(), learner.allFactors)
+    return spreads
+
+
+def instability(spread):
+    # the largest standard deviation of the probability of a furigana
+    return max([std for _, _, std in spread] or [0.0])
+
+
+def writeSpreads(spreads, path='result/ensemble_spread.txt'):
+    # most unstable kanjis first
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        for k, spread in sorted(spreads.iteritems(), key=lambda t: (-instability(t[1]), t[0])):
+            f.write(u'%s: %.3f %s\n' % (k, instability(spread),
+                                        u' '.join([u'%s(%.1f±%.1f)' % (furigana, mean * 100, std * 100)
+                                                   for furigana, mean, std in spread])))
+
+
+def train(tuples, numMembers, numTrials=10, numProcesses=None, seed=0):
+    numProcesses = numProcesses or multiprocessing.cpu_count()
+    print ' ** Training %d members in %d processes.' % (numMembers, min(numProcesses, numMembers))
+
+    pool = multiprocessing.Pool(min(numProcesses, numMembers))
+    try:
+        members = pool.map(_trainMember, [(tuples, seed + i, numTrials) for i in range(numMembers)])
+    finally:
+        pool.close()
+        pool.join()
+
+    spreads = average(tuples, members)
+    print ' ** Averaged %d members.' % len(members)
+    return spreads
+
+
+def main():
+    argParser = argparse.ArgumentParser(description='Train an ensemble of differently seeded models and average them.')
+    argParser.add_argument('-i', '--input', default='tuples.txt', help='training tuples')
+    argParser.add_argument('-n', '--members', type=int, default=4, help='number of members')
+    argParser.add_argument('-j', '--processes', type=int, default=None)
+    argParser.add_argument('-t', '--trials', type=int, default=10, help='maximal number of trials of a member')
+    argParser.add_argument('--seed', type=int, default=0, help='seed of the first member')
+    argParser.add_argument('-o', '--output', default='result/model.snapshot', help='averaged snapshot')
+    args = argParser.parse_args()
+
+    alltuples = list(ingest.readTuples(args.input))
+    print ' ** Training set contains %d tuples.' % (len(alltuples))
+
+    spreads = train(alltuples, args.members, args.trials, args.processes, args.seed)
+    writeSpreads(spreads)
+    print ' ** Most unstable kanjis:'
+    for k, spread in sorted(spreads.iteritems(), key=lambda t: (-instability(t[1]), t[0]))[:10]:
+        print (u'    %s %.3f' % (k, instability(spread))).encode('utf-8')
+
+    print ' ** Start testing:'
+    testModel(learner.nodeMap)
+
+    learner.saveModel(args.output)
+    print ' ** All done. Output written to files.'
+
+
+if __name__ == "__main__":
+    main()
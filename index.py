@@ -0,0 +1,86 @@
+
+# -*- coding: utf-8 -*-
+
+'''
+A reading index answers the hint queries of the README without scanning the
+graph:
+  - which kanjis can be read as a given furigana (weighted by the
+    probability of the reading in the distribution of each kanji)
+  - which readings of a kanji have been seen, and in which words (according
+    to the best partition of each factor)
+The index remembers what it has recorded for every node and factor, so that
+updating it only touches the entries of nodes and factors that changed.
+'''
+class ReadingIndex:
+    def __init__(self):
+        self._kanjis = {}    # furigana -> {kanji: prob}
+        self._readings = {}  # kanji -> {furigana: set of factors}
+
+        self._nodeReadings = {}    # kanji -> distribution recorded
+        self._factorReadings = {}  # factor -> best partition recorded
+
+    def updateNode(self, node):
+        old = self._nodeReadings.get(node.kanji, {})
+        if old == node.distribution:
+            return False
+
+        for f in old:
+            del self._kanjis[f][node.kanji]
+            if not self._kanjis[f]:
+                del self._kanjis[f]
+        for f, prob in node.distribution.iteritems():
+            self._kanjis.setdefault(f, {})[node.kanji] = prob
+        self._nodeReadings[node.kanji] = dict(node.distribution)
+        return True
+
+    def updateFactor(self, factor):
+        old = self._factorReadings.get(factor, [])
+        new = factor.bestPartition or []
+        if old == new:
+            return False
+
+        # a partition can use a pair twice, e.g. 点々 (点:てん 点:てん)
+        for k, f in set(old):
+            words = self._readings.get(k, {}).get(f)
+            if words is None:
+                continue
+            words.discard(factor)
+            if not words:
+                del self._readings[k][f]
+        for k, f in set(new):
+            self._readings.setdefault(k, {}).setdefault(f, set()).add(factor)
+        self._factorReadings[factor] = list(new)
+        return True
+
+    def update(self, nodes=(), factors=()):
+        # returns the number of nodes and factors whose entries have changed
+        nNodes = len(filter(None, [self.updateNode(node) for node in nodes]))
+        nFactors = len(filter(None, [self.updateFactor(factor) for factor in factors]))
+        return nNodes, nFactors
+
+    def kanjisForReading(self, furigana):
+        # [(kanji, prob)] of all kanjis that can be read as furigana
+        kanjis = self._kanjis.get(furigana, {})
+        return sorted(kanjis.iteritems(), key=lambda t: (-t[1], t[0]))
+
+    def readingsForKanji(self, kanji):
+        # {furigana: [(word, pronunciation)]} of all readings seen for kanji
+        readings = {}
+        for f, factors in self._readings.get(kanji, {}).iteritems():
+            readings[f] = sorted([(factor.word, factor.pronunciation) for factor in factors])
+        return readings
+
+    def wordsForReading(self, kanji, furigana):
+        factors = self._readings.get(kanji, {}).get(furigana, ())
+        return sorted([(factor.word, factor.pronunciation) for factor in factors])
+
+    def hints(self, partition):
+        # for each (kanji, furigana) of a partition: the other readings of the
+        # kanji and the other kanjis with the same reading
+        hints = []
+        for k, f in partition:
+            otherReadings = self.readingsForKanji(k)
+            otherReadings.pop(f, None)
+            sameReading = [(kanji, prob) for kanji, prob in self.kanjisForReading(f) if kanji != k]
+            hints.append((k, f, otherReadings, sameReading))
+        return hints
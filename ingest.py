@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+import os
+import codecs
+import random
+import zlib
+
+import util
+
+'''
+The corpus is ingested as a pipeline of generators, so that a corpus of any
+size is streamed line by line and never held in memory:
+
+  readLines      lines of the corpus files, with their file and line number
+  parseLines     (kanji, furigana) of every valid line, without the kana
+                 shared by the beginning and the end of the kanji and the
+                 furigana (okurigana, see stripKana)
+  unique         repeated tuples are dropped (optional, repeated tuples are
+                 weighted in the learner)
+  shard          the tuples of one shard, a word always goes to the same shard
+
+iterTuples chains them for the files of a corpus directory and can cache its
+output on disk: the cache remembers the modification time and size of every
+corpus file, and is only rebuilt when one of them has changed.
+'''
+
+def corpusFiles(directory='corpus'):
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.endswith('.txt') and not name.startswith('_')]
+
+
+def readLines(paths):
+    for path in paths:
+        with codecs.open(path, 'r', encoding='utf-8') as f:
+            for lineNumber, line in enumerate(f):
+                yield path, lineNumber + 1, line
+
+
+def isValidTuple(kanji, furigana):
+    # the furigana is made of kana only, and has at least one kana per kanji
+    if not kanji or not furigana:
+        return False
+    if not all([util.isKana(util.toHiragana(c)) for c in furigana]):
+        return False
+    nKanji = len([c for c in util.normalizeWord(kanji) if not util.isKana(c)])
+    return len(furigana) >= nKanji
+
+
+def stripKana(kanji, furigana):
+    # remove parts of kanji and furigana that are the same (katakana is
+    # compared as hiragana)
+    while kanji and furigana and util.toHiragana(kanji[0]) == util.toHiragana(furigana[0]):
+        kanji = kanji[1:]
+        furigana = furigana[1:]
+    while kanji and furigana and util.toHiragana(kanji[-1]) == util.toHiragana(furigana[-1]):
+        kanji = kanji[:-1]
+        furigana = furigana[:-1]
+    return kanji, furigana
+
+
+def parseLines(lines, skipped=None):
+    # words written in kana only are left out, invalid lines are left out too
+    # and reported in the list skipped if given
+    for path, lineNumber, line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) == 2:
+            kanji, furigana = stripKana(*fields)
+            if not kanji:
+                continue
+            if isValidTuple(kanji, furigana):
+                yield kanji, furigana
+                continue
+        if skipped is not None:
+            skipped.append((path, lineNumber, line.rstrip()))
+
+
+def unique(tuples):
+    seen = set()
+    for t in tuples:
+        if t not in seen:
+            seen.add(t)
+            yield t
+
+
+def shardOf(kanji, numShards):
+    return (zlib.crc32(kanji.encode('utf-8')) & 0xffffffff) % numShards
+
+
+def shard(tuples, numShards, shardId):
+    for kanji, furigana in tuples:
+        if shardOf(kanji, numShards) == shardId:
+            yield kanji, furigana
+
+
+def readTuples(path='tuples.txt'):
+    with codecs.open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip() and not line.startswith('#'):
+                kanji, furigana = line.split()
+                yield kanji, furigana
+
+
+def writeTuples(tuples, path='tuples.txt', header=None):
+    # returns the number of tuples written
+    n = 0
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        if header:
+            f.write(u'# %s\n' % header)
+        for kanji, furigana in tuples:
+            f.write(u'%s %s\n' % (kanji, furigana))
+            n += 1
+    return n
+
+
+def _cacheKey(paths):
+    # the modification time is kept in full, a file can be edited twice
+    # within the same second without changing its size
+    return u' '.join([u'%s:%s:%d' % (os.path.basename(path), repr(os.path.getmtime(path)), os.path.getsize(path))
+                      for path in paths])
+
+
+def _cachedKey(cachePath):
+    if not os.path.isfile(cachePath):
+        return None
+    with codecs.open(cachePath, 'r', encoding='utf-8') as f:
+        header = f.readline()
+    return header[2:].rstrip(u'\n') if header.startswith(u'# ') else None
+
+
+def iterTuples(directory='corpus', uniqueOnly=False, numShards=1, shardId=0, cachePath=None, skipped=None):
+    # all the (kanji, furigana) tuples of the corpus files in directory
+    paths = corpusFiles(directory)
+    if cachePath:
+        key = _cacheKey(paths)
+        if _cachedKey(cachePath) != key:
+            # the cache holds the parsed tuples, before deduplication and
+            # sharding
+            tmpPath = cachePath + '.tmp'
+            writeTuples(parseLines(readLines(paths), skipped), tmpPath, header=key)
+            if os.path.exists(cachePath):
+                os.remove(cachePath)
+            os.rename(tmpPath, cachePath)
+        tuples = readTuples(cachePath)
+    else:
+        tuples = parseLines(readLines(paths), skipped)
+
+    if uniqueOnly:
+        tuples = unique(tuples)
+    if numShards > 1:
+        tuples = shard(tuples, numShards, shardId)
+    return tuples
+
+
+def sampleTuples(tuples, sampleSize):
+    # reservoir sampling, returns min(sampleSize, len(tuples)) tuples
+    sample = []
+    for i, t in enumerate(tuples):
+        if i < sampleSize:
+            sample.append(t)
+        else:
+            j = random.randint(0, i)
+            if j < sampleSize:
+                sample[j] = t
+    return sample
+
+
+if __name__ == "__main__":
+
+    for path in corpusFiles():
+        print 'Load file %s' % os.path.basename(path)
+
+    skipped = []
+    nTuples = writeTuples(iterTuples(skipped=skipped), 'tuples.txt')
+    for path, lineNumber, line in skipped:
+        print (u'Skip invalid line %d of %s: %s' % (lineNumber, path, line)).encode('utf-8')
+    print 'Total number of tuples: %d.' % nTuples
+
+    if not os.path.isfile('test.txt'):
+        sampleSize = 100
+        multipleKanjiTuples = (tp for tp in readTuples('tuples.txt') if len(tp[0]) > 1)
+        sample = sampleTuples(multipleKanjiTuples, sampleSize)
+        print 'Randomly sample %d tuples as test set.' % len(sample)
+        writeTuples(sample, 'test.txt')
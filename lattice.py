@@ -0,0 +1,365 @@
+
+# -*- coding: utf-8 -*-
+
+import random
+import util
+from array import array
+
+'''
+A lattice represents all the possible ways of splitting the furigana of a
+word among its kanjis, without listing every partition explicitly.
+The lattice state (i, j) means that the first i characters of the word have
+consumed the first j characters of the furigana. Every edge leaving layer i
+assigns a piece of furigana to the i-th character of the word: a hiragana
+character has exactly one edge (itself), a kanji has one edge per legal
+furigana length. Katakana, the long vowel mark and the iteration mark are
+read as given by util.segmentWord. Every path from (0, 0) to (len(word), len(furigana)) is one
+partition, so marginals can be obtained by a forward-backward pass whose cost
+is bounded by len(word) * len(furigana) instead of the number of partitions.
+
+The edges only depend on the furigana and on the kana of the word, not on
+which kanjis it is written with: homophones such as 構成, 公正 and 校正
+(こうせい) have the same edges. The edges of all lattices are stored in one
+shared buffer of integers, interned by (kana of the word, furigana),
+and a lattice only keeps its word, furigana, kanjis and the offset of its
+structure in the buffer (a lattice built with intern=False, e.g. for a query,
+adds nothing to the shared tables: unless its structure is already shared,
+it keeps its own, which goes away with it):
+
+  n, numEdges, slots (n), layerOffsets (n + 1), starts (numEdges), ends (numEdges)
+
+the edges of layer i are layerOffsets[i] to layerOffsets[i + 1], the edge e
+goes from (i, starts[e]) to (i + 1, ends[e]) and its furigana is
+pronunciation[starts[e]:ends[e]].
+'''
+
+_buffer = array('i')  # long compounds have more edges than a short integer can count
+_structures = {}  # (kana of the word, furigana) -> (offset in _buffer, furigana)
+_kanjis = {}      # interned tuples of kanjis
+
+# the structures in use are also kept decoded as lists (with the furigana of
+# every edge, interned), up to MAX_DECODED of them; when the cache is
+# full, a structure chosen uniformly at random is evicted, so that a trial
+# visiting more structures than that in the same order every time still
+# finds most of them decoded (least recently used would evict them all)
+MAX_DECODED = 10000
+_decoded = {}         # offset in _buffer -> decoded structure, see Lattice._structure
+_decodedOffsets = []  # the keys of _decoded, to draw the one evicted
+_evictions = random.Random(0)  # its own generator, the global one is left alone
+_furiganas = {}       # interned furiganas of the kanji edges
+
+def _candidates(chars, slots, pronunciation):
+    n = len(chars)
+    m = len(pronunciation)
+
+    # forward pass: collect every edge reachable from (0, 0), using the
+    # same constraints as util.generatePossiblePartitions
+    candidates = []
+    reachable = set([0])
+    for i, c in enumerate(chars):
+        layer = []
+        nextReachable = set()
+        for start in sorted(reachable):
+            if slots[i] == -1:
+                if start < m and pronunciation[start] == c:
+                    layer.append((start, start + 1))
+            elif i == n - 1:
+                if start < m and util.isLegalFurigana(pronunciation[start:]):
+                    layer.append((start, m))
+            else:
+                for end in range(start + 1, m - (n - i) + 2):
+                    if util.isLegalFurigana(pronunciation[start:end]):
+                        layer.append((start, end))
+        for _, end in layer:
+            nextReachable.add(end)
+        candidates.append(layer)
+        reachable = nextReachable
+
+    # backward pass: only keep edges that can reach (n, m)
+    alive = set([m])
+    for i in reversed(range(n)):
+        candidates[i] = [(start, end) for start, end in candidates[i] if end in alive]
+        alive = set([start for start, _ in candidates[i]])
+
+    if 0 not in alive:
+        candidates = [[] for _ in range(n)]
+    return candidates
+
+
+def _encode(chars, slots, pronunciation):
+    # the structure as an array of integers, see above
+    candidates = _candidates(chars, slots, pronunciation)
+    layerOffsets = [0]
+    for layer in candidates:
+        layerOffsets.append(layerOffsets[-1] + len(layer))
+    structure = array('i', [len(chars), layerOffsets[-1]])
+    structure.extend(slots)
+    structure.extend(layerOffsets)
+    structure.extend([start for layer in candidates for start, _ in layer])
+    structure.extend([end for layer in candidates for _, end in layer])
+    return structure
+
+
+def _store(chars, slots, pronunciation):
+    # append the structure to the buffer, returns its offset; the structure
+    # is computed in full first, so that the buffer is left as it was if
+    # anything fails
+    structure = _encode(chars, slots, pronunciation)
+    offset = len(_buffer)
+    _buffer.extend(structure)
+    return offset
+
+
+def _decode(buffer, o, pronunciation, intern=True):
+    # (slots, layerOffsets, starts, ends, furiganas) of the structure at
+    # offset o of buffer, furiganas[e] is the furigana of the kanji edge e
+    # (None for a kana edge), interned unless intern is False; the kanji
+    # edges themselves follow from slots and layerOffsets, see _kanjiEdges
+    n, numEdges = buffer[o], buffer[o + 1]
+    o += 2
+    slots = buffer[o:o + n].tolist()
+    o += n
+    layerOffsets = buffer[o:o + n + 1].tolist()
+    o += n + 1
+    starts, ends = buffer[o:o + numEdges].tolist(), buffer[o + numEdges:o + 2 * numEdges].tolist()
+    furiganas = [None] * numEdges
+    for e, slot, i in _kanjiEdges(slots, layerOffsets):
+        f = pronunciation[starts[e]:ends[e]]
+        furiganas[e] = _furiganas.setdefault(f, f) if intern else f
+    return slots, layerOffsets, starts, ends, furiganas
+
+
+def _kanjiEdges(slots, layerOffsets):
+    # (edgeIndex, slot, layer) of all the kanji edges, in order
+    for i, slot in enumerate(slots):
+        if slot != -1:
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                yield e, slot, i
+
+
+class Lattice(object):
+    __slots__ = ('word', 'pronunciation', 'allKanji', '_offset', '_local')
+
+    def __init__(self, kanji, furigana, intern=True):
+        self.word = kanji
+        pronunciation = u''.join(map(util.toHiragana, furigana))
+
+        # kanji characters of the word in order (kana excluded), the position
+        # of a kanji in this list is called its slot
+        chars = u''
+        allKanji = []
+        slots = []
+        for kana, text in util.segmentWord(kanji):
+            for c in text:
+                if kana:
+                    slots.append(-1)
+                else:
+                    slots.append(len(allKanji))
+                    allKanji.append(c)
+            chars += text
+        allKanji = tuple(allKanji)
+        self.allKanji = _kanjis.setdefault(allKanji, allKanji) if intern else _kanjis.get(allKanji, allKanji)
+
+        key = (u''.join([c if slot == -1 else u'\0' for c, slot in zip(chars, slots)]), pronunciation)
+        self._local = None
+        if key in _structures or intern:
+            if key not in _structures:
+                _structures[key] = (_store(chars, slots, pronunciation), pronunciation)
+            self._offset, self.pronunciation = _structures[key]
+        else:
+            # not shared: the lattice keeps its structure decoded
+            self._offset, self.pronunciation = -1, pronunciation
+            self._local = _decode(_encode(chars, slots, pronunciation), 0, pronunciation, intern=False)
+
+    def _structure(self):
+        # the decoded structure, see _decode
+        if self._local is not None:
+            return self._local
+        structure = _decoded.get(self._offset)
+        if structure is None:
+            structure = _decode(_buffer, self._offset, self.pronunciation)
+            if len(_decodedOffsets) >= MAX_DECODED:
+                i = _evictions.randrange(len(_decodedOffsets))
+                del _decoded[_decodedOffsets[i]]
+                _decodedOffsets[i] = self._offset
+            else:
+                _decodedOffsets.append(self._offset)
+            _decoded[self._offset] = structure
+        return structure
+
+    @property
+    def slots(self):
+        return self._structure()[0]
+
+    @property
+    def numEdges(self):
+        if self._local is not None:
+            return len(self._local[2])
+        return _buffer[self._offset + 1]
+
+    def isEmpty(self):
+        return self.numEdges == 0
+
+    def isAmbiguous(self):
+        # more than one partition: every edge left is on a complete path, so
+        # this is the case as soon as a layer has more than one edge
+        layerOffsets = self._structure()[1]
+        return any([layerOffsets[i + 1] - layerOffsets[i] > 1 for i in xrange(len(layerOffsets) - 1)])
+
+    def kanjiEdges(self):
+        # the list of (edgeIndex, kanji, furigana) of all the kanji edges
+        slots, layerOffsets, _, _, furiganas = self._structure()
+        allKanji = self.allKanji
+        return [(e, allKanji[slot], furiganas[e]) for e, slot, _ in _kanjiEdges(slots, layerOffsets)]
+
+    def furiganaSet(self):
+        furigana_set = set()
+        for _, _, f in self.kanjiEdges():
+            furigana_set.add(f)
+        return furigana_set
+
+    def forward(self, weights):
+        # alpha[i][j] is the total weight of all paths from (0, 0) to (i, j)
+        layerOffsets, starts, ends = self._structure()[1:4]
+        n = len(layerOffsets) - 1
+        m = len(self.pronunciation)
+        alpha = [[0.0] * (m + 1) for _ in range(n + 1)]
+        alpha[0][0] = 1.0
+        for i in xrange(n):
+            current, following = alpha[i], alpha[i + 1]
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                following[ends[e]] += current[starts[e]] * weights[e]
+        return alpha
+
+    def backward(self, weights):
+        # beta[i][j] is the total weight of all paths from (i, j) to the end
+        layerOffsets, starts, ends = self._structure()[1:4]
+        n = len(layerOffsets) - 1
+        m = len(self.pronunciation)
+        beta = [[0.0] * (m + 1) for _ in range(n + 1)]
+        beta[n][m] = 1.0
+        for i in reversed(xrange(n)):
+            current, following = beta[i], beta[i + 1]
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                current[starts[e]] += following[ends[e]] * weights[e]
+        return beta
+
+    def marginals(self, kanji, weights, ownWeights):
+        # the distribution of the furigana of kanji over all paths, where the
+        # edges of the kanji itself are weighted by ownWeights instead of
+        # weights (each path passes through exactly one edge of every layer).
+        # Only the forward weights up to the last layer of the kanji and the
+        # backward weights down to its first layer are needed: a single pass
+        # over the lattice for a kanji that appears once
+        slots, layerOffsets, starts, ends, furiganas = self._structure()
+        allKanji = self.allKanji
+        edges = [(e, furiganas[e], i) for e, slot, i in _kanjiEdges(slots, layerOffsets) if allKanji[slot] == kanji]
+        if not edges:
+            return {}
+        n = len(layerOffsets) - 1
+        m = len(self.pronunciation)
+
+        alpha = [[1.0] + [0.0] * m]
+        for i in xrange(edges[-1][2]):
+            current, following = alpha[i], [0.0] * (m + 1)
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                following[ends[e]] += current[starts[e]] * weights[e]
+            alpha.append(following)
+
+        beta = [None] * (n + 1)
+        beta[n] = [0.0] * m + [1.0]
+        for i in reversed(xrange(edges[0][2] + 1, n)):
+            current, following = [0.0] * (m + 1), beta[i + 1]
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                current[starts[e]] += following[ends[e]] * weights[e]
+            beta[i] = current
+
+        distribution = {}
+        for e, f, i in edges:
+            distribution[f] = distribution.get(f, 0.0) + alpha[i][starts[e]] * ownWeights[e] * beta[i + 1][ends[e]]
+        return distribution
+
+    def viterbi(self, weights):
+        # the path with the largest product of weights, ties are broken in
+        # favor of the path that comes last in the order of partitions()
+        layerOffsets, starts, ends = self._structure()[1:4]
+        n = len(layerOffsets) - 1
+        best = [{} for _ in range(n + 1)]
+        best[0][0] = (1.0, ())
+        for i in xrange(n):
+            current, following = best[i], best[i + 1]
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                start, end = starts[e], ends[e]
+                if start not in current:
+                    continue
+                value, path = current[start]
+                candidate = (value * weights[e], path + (e,))
+                if end not in following or candidate > following[end]:
+                    following[end] = candidate
+        return list(best[n][len(self.pronunciation)][1])
+
+    def kBest(self, weights, k, scores=None):
+        # the k paths with the largest product of weights, as a list of
+        # (product, sum of scores, path) by decreasing product; ties are broken
+        # by the largest sum of the scores of the edges, then as in viterbi.
+        # Every state keeps its k best prefixes, so the cost is bounded by
+        # k * numEdges whatever the number of partitions
+        layerOffsets, starts, ends = self._structure()[1:4]
+        n = len(layerOffsets) - 1
+        best = [{} for _ in range(n + 1)]
+        best[0][0] = [(1.0, 0.0, ())]
+        for i in xrange(n):
+            current, following = best[i], best[i + 1]
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                if starts[e] not in current:
+                    continue
+                weight, score = weights[e], scores[e] if scores else 0.0
+                following.setdefault(ends[e], []).extend(
+                    [(value * weight, total + score, path + (e,)) for value, total, path in current[starts[e]]])
+            for candidates in following.itervalues():
+                candidates.sort(reverse=True)
+                del candidates[k:]
+        return [(value, total, list(path)) for value, total, path in best[n].get(len(self.pronunciation), [])]
+
+    def paths(self):
+        # enumerate all the paths as lists of edge indices, in the same order
+        # as util.generatePossiblePartitions
+        layerOffsets, starts, ends = self._structure()[1:4]
+        n = len(layerOffsets) - 1
+        m = len(self.pronunciation)
+
+        def _search(i, start, partial):
+            if i == n:
+                if start == m:
+                    yield list(partial)
+                return
+            for e in xrange(layerOffsets[i], layerOffsets[i + 1]):
+                if starts[e] == start:
+                    partial.append(e)
+                    for path in _search(i + 1, ends[e], partial):
+                        yield path
+                    partial.pop()
+
+        if not self.isEmpty():
+            for path in _search(0, 0, []):
+                yield path
+
+    def partition(self, path):
+        # convert a path into a partition, i.e. a list of (kanji, furigana)
+        slots, layerOffsets, starts, ends = self._structure()[:4]
+        partition = []
+        for e in path:
+            i = self._layerOf(layerOffsets, e)
+            if slots[i] != -1:
+                partition.append((self.allKanji[slots[i]], self.pronunciation[starts[e]:ends[e]]))
+        return partition
+
+    def _layerOf(self, layerOffsets, e):
+        # the layer of the edge e (layers are few, a linear scan is enough)
+        i = 0
+        while layerOffsets[i + 1] <= e:
+            i += 1
+        return i
+
+    def partitions(self):
+        return [self.partition(path) for path in self.paths()]
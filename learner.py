@@ -1,124 +1,421 @@
 # -*- coding: utf-8 -*-
 
-import codecs
-import random
 import sys
+import time
 
+import ingest
+import metrics
+import partitioncache
+import snapshot
 import util
 from model import *
-from test import testModel, continuousTesting
+from compiled import CompiledGraph, CompiledScheduler
+from index import ReadingIndex
+from lattice import Lattice
+from output import ResultWriter
+from scheduler import ResidualScheduler
+from test import testModel, continuousTesting, flushTestLog
 
 nodeMap = {}
 allFactors = []
-
-
-def learn(trial, tuples, testingInterval=None):
+factorMap = {}  # (kanji, furigana) -> factor, repeated tuples share one factor
+readingIndex = ReadingIndex()  # readings <-> kanjis and words, for hints
+
+# factors that cannot change in the next trial (see adjustParameters), skipped
+# by learn in active set mode
+settledFactors = set()
+SETTLED_TOLERANCE = 1e-3
+
+# what adjustParameters has to update: the distribution (and smoothing) of
+# every node when it was last adjusted, and factors that are new or repeated
+# since then
+adjustedDistributions = {}
+staleFactors = set()
+
+# the compiled graph of the last compiled trial, reused by the next one if
+# the model still has the same nodes and factors
+graph = None
+
+
+def reset():
+    # forget the whole model
+    global readingIndex, graph
+    nodeMap.clear()
+    del allFactors[:]
+    factorMap.clear()
+    readingIndex = ReadingIndex()
+    settledFactors.clear()
+    adjustedDistributions.clear()
+    staleFactors.clear()
+    graph = None
+
+
+def construct(kanji, furigana):
+    if (kanji, furigana) in factorMap:
+        factor = factorMap[(kanji, furigana)]
+        factor.addOccurrence(nodeMap)
+        staleFactors.add(factor)
+        return factor
+
+    newFactor = Factor(kanji, furigana)
+    allFactors.append(newFactor)
+    staleFactors.add(newFactor)
+    factorMap[(kanji, furigana)] = newFactor
+    for k in newFactor.allKanji:
+        if k not in nodeMap:
+            nodeMap[k] = Node(k, newFactor.furiganaSetForKanji(k), nodeMap)
+        nodeMap[k].addFactor(newFactor)
+    return newFactor
+
+
+@metrics.timed('learn')
+def learn(trial, tuples, testingInterval=None, tolerance=1e-2, updatesPerKanji=20, damping=0.5, activeSet=False,
+          compiled=False):
+    global graph
 
     print ' ** Start trial %d:' % trial
 
-    def construct():
-        newFactor = Factor(kanji, furigana, nodeMap)
-        allFactors.append(newFactor)
-        for k in newFactor.allKanji:
-            if k not in nodeMap:
-                nodeMap[k] = Node(k, newFactor.furiganaSetForKanji(k))
-            nodeMap[k].factors.append(newFactor)
-        return newFactor
-
-    def infer(factor):
-        MAX_ITERATION = 30
-        update_queue = set(factor.allKanji)
-        iteration = 0
-        while update_queue and iteration < MAX_ITERATION:
-            kanji = random.choice(list(update_queue))
-            update_queue.remove(kanji)
-            node = nodeMap[kanji]
-            if node.updateDistribution():
-                update_queue.update(node.allAdjacentKanjis())
-            iteration += 1
+    # tuples can be any iterable (e.g. a stream from ingest.iterTuples), it is
+    # only iterated once; the progress bar needs its length when available
+    total = len(tuples) if hasattr(tuples, '__len__') else None
+
+    # the compiled graph is built from all the tuples at once, its factors
+    # are then seen one by one in the initial trial; the node objects get
+    # their distributions back at the end of the trial (and before testing)
+    nodes = nodeMap
+    scheduler = ResidualScheduler(nodeMap, tolerance, updatesPerKanji, damping)
+    if compiled:
+        if trial == 0:
+            tuples = [construct(kanji, furigana) for kanji, furigana in tuples]
+            total = len(tuples)
+            graph = CompiledGraph(nodeMap, allFactors, numActive=0)
+        elif graph is None or not graph.compiles(nodeMap, allFactors):
+            graph = CompiledGraph(nodeMap, allFactors)
+        else:
+            graph.load()
+        nodes = graph.nodes
+        scheduler = CompiledScheduler(graph, tolerance, updatesPerKanji, damping)
 
     progress = 0
 
-    if trial > 0:
-        for node in nodeMap.itervalues():
-            node.resetDistribution()
+    # kanjis whose probabilities may have changed since the last test, None
+    # when all of them have (continuousTesting then rescores every test case)
+    testedKanjis = None
 
-    for i, (kanji, furigana) in enumerate(tuples):
-        if trial == 0:
+    # the model tested: in the initial trial of a compiled graph all the nodes
+    # exist from the start, but as with node objects only the kanjis of the
+    # tuples seen so far are known to the test
+    testedModel = nodeMap
+    if compiled and trial == 0:
+        testedModel = {}
+
+    # later trials visit every distinct factor once, or in active set mode
+    # only the factors that are not settled (the distribution of a node is
+    # then only reset and inferred again if one of its factors is active)
+    if trial > 0:
+        tuples = list(allFactors)
+        if activeSet:
+            tuples = [factor for factor in tuples if factor not in settledFactors]
+            print '    Active set: %d of %d factors (%.1f%% skipped).' % (
+                len(tuples), len(allFactors), 100.0 - 100.0 * len(tuples) / max(len(allFactors), 1))
+            metrics.current.count('learn.skipped', len(allFactors) - len(tuples))
+        total = len(tuples)
+
+        kanjis = nodes.iterkeys()
+        if activeSet:
+            kanjis = set([k for factor in tuples for k in factor.allKanji])
+        for k in kanjis:
+            nodes[k].resetDistribution()
+
+    for item in tuples:
+        if trial == 0 and not compiled:
             # have to construct necessary nodes and factors for the initial trial
-            factor = construct()
+            factor = construct(*item)
         else:
-            factor = allFactors[i]
-
-        infer(factor)  
+            # factors have already been constructed
+            factor = item
+            if trial == 0:
+                graph.addOccurrence(factor)
+                for k in factor.allKanji:
+                    testedModel[k] = nodeMap[k]
+
+        scheduler.infer(factor)
+        if testingInterval and testedKanjis is not None:
+            # a new node changes the probabilities even if inference did not
+            testedKanjis.update(factor.allKanji)
 
         progress += 1
         if testingInterval and (progress % testingInterval == 0): 
-            continuousTesting(nodeMap, trial, progress)
+            if testedKanjis is not None:
+                testedKanjis |= scheduler.updated
+            if compiled:
+                graph.store(testedKanjis)
+            continuousTesting(testedModel, trial, progress, testedKanjis)
+            testedKanjis = set()
+            scheduler.updated.clear()
 
-        percentage = float(progress) / len(tuples) 
         sys.stdout.write('\r')
-        sys.stdout.write('  LEARNING [%-30s] %.1f%%' % ('=' * int(percentage * 30), percentage * 100))
+        if total:
+            percentage = float(progress) / total
+            sys.stdout.write('  LEARNING [%-30s] %.1f%%' % ('=' * int(percentage * 30), percentage * 100))
+        else:
+            sys.stdout.write('  LEARNING %d tuples' % progress)
         sys.stdout.flush()
 
 
+    if compiled:
+        graph.store()
+    if testingInterval:
+        flushTestLog()
+
     print '\n ** Finish trial %d.' % trial
+    print '    Inference: %s' % scheduler.summary()
+    metrics.current.count('learn.tuples', progress)
+    return scheduler
 
 
+@metrics.timed('adjust')
 def adjustParameters():
     # always update omega before update alpha because the calculation of alpha is dependent
     # upon the lateset value of omega
 
-    for factor in allFactors:
-        factor.updateWeightVectorOmega()
-    
-    for node in nodeMap.itervalues():
+    # the omegas of a factor only depend on the distributions of its kanjis,
+    # and the alphas of a node on the best partitions and weights of its
+    # factors: only the factors of the nodes whose distribution changed since
+    # the last adjustment (and new or repeated factors) get new omegas, and
+    # only the nodes of the factors whose best partition flipped (or that
+    # are new or repeated) get new alphas
+    changedKanjis = [k for k, node in nodeMap.iteritems()
+                     if adjustedDistributions.get(k) != (node.distribution, node.probSmoothing)]
+    factors = set(staleFactors)
+    alphaKanjis = set([k for factor in staleFactors for k in factor.allKanji])
+    for k in changedKanjis:
+        node = nodeMap[k]
+        adjustedDistributions[k] = (dict(node.distribution), node.probSmoothing)
+        factors.update(node.factors)
+    staleFactors.clear()
+
+    # kanjis with a moved alpha, or with a factor whose omegas moved
+    movedKanjis = set()
+
+    for factor in factors:
+        omegas = factor.omegas
+        if factor.updateWeightVectorOmega(nodeMap):
+            alphaKanjis.update(factor.allKanji)
+        if util.vectorDelta(omegas, factor.omegas) > SETTLED_TOLERANCE:
+            movedKanjis.update(factor.allKanji)
+
+    for k in alphaKanjis:
+        node = nodeMap[k]
+        alphas = node.alphas
         node.updateWeightVectorAlpha()
-
-    print 'Updated weight vectors omega and alpha.'
+        if util.vectorDelta(alphas, node.alphas) > SETTLED_TOLERANCE:
+            movedKanjis.add(k)
+
+    print 'Updated weight vectors omega (%d factors) and alpha (%d nodes).' % (len(factors), len(alphaKanjis))
+    metrics.current.count('adjust.factors', len(factors))
+    metrics.current.count('adjust.nodes', len(alphaKanjis))
+
+    # a factor is settled if it has only one partition, or if nothing moved
+    # around it
+    settledFactors.clear()
+    settledFactors.update(allFactors)
+    settledFactors.difference_update([factor for k in movedKanjis for factor in nodeMap[k].factors
+                                      if factor.lattice.isAmbiguous()])
+
+    nNodes, nFactors = readingIndex.update([nodeMap[k] for k in changedKanjis], factors)
+    print 'Updated reading index (%d nodes, %d factors changed).' % (nNodes, nFactors)
+
+
+def modelState():
+    # what a trial changes: distributions, best partitions, alphas and omegas
+    return (dict([(k, dict(node.distribution)) for k, node in nodeMap.iteritems()]),
+            dict([(factor, (factor.bestPath, list(factor.omegas))) for factor in allFactors]),
+            dict([(k, list(node.alphas)) for k, node in nodeMap.iteritems()]))
+
+
+def modelChange(before, after):
+    # the change between two model states, as a dict of
+    #   distributionDelta  largest change of a probability (mean over nodes
+    #                      of the largest change of the node in distributionMean)
+    #   flips              number of factors whose best partition changed
+    #   flipRate           flips over the number of factors
+    #   alphaDelta         largest change of an alpha (alphaMean: mean over nodes)
+    #   omegaDelta         largest change of an omega (omegaMean: mean over factors)
+    # a node or factor missing from before is compared to an empty one
+    distributions, factors, alphas = before
+
+    def _stats(deltas):
+        return max(deltas or [0.0]), sum(deltas) / max(len(deltas), 1)
+
+    change = {}
+    change['distributionDelta'], change['distributionMean'] = _stats(
+        [util.distributionDelta(distributions.get(k, {}), distribution) for k, distribution in after[0].iteritems()])
+    change['flips'] = len([factor for factor, (bestPath, _) in after[1].iteritems()
+                           if factors.get(factor, (None, []))[0] != bestPath])
+    change['flipRate'] = float(change['flips']) / max(len(after[1]), 1)
+    change['omegaDelta'], change['omegaMean'] = _stats(
+        [util.vectorDelta(factors.get(factor, (None, []))[1], omegas) for factor, (_, omegas) in after[1].iteritems()])
+    change['alphaDelta'], change['alphaMean'] = _stats(
+        [util.vectorDelta(alphas.get(k, []), nodeAlphas) for k, nodeAlphas in after[2].iteritems()])
+    return change
+
+
+def train(tuples, maxTrials=10, timeBudget=None, distributionTolerance=1e-3, maxFlipRate=1e-3,
+          weightTolerance=1e-2, afterTrial=None, **kwargs):
+    # run trials (learn and adjustParameters) until the model has converged
+    # since the previous trial: on average, no probability of a node moved by
+    # more than distributionTolerance and no alpha or omega by more than
+    # weightTolerance, and at most maxFlipRate of the best partitions changed.
+    # A few factors with close partitions can flip back and forth forever, so
+    # the largest changes are reported but not required to vanish.
+    # Stops after maxTrials, or when the next trial is expected to end after
+    # timeBudget seconds. afterTrial(trial, change) is called after every
+    # trial, kwargs are passed to learn. Returns the change of every trial.
+    tuples = list(tuples)
+    start = time.time()
+    changes = []
+    for trial in range(maxTrials):
+        trialStart = time.time()
+        before = modelState()
+        learn(trial, tuples, **kwargs)
+        adjustParameters()
+        change = modelChange(before, modelState())
+        change['seconds'] = time.time() - trialStart
+        change['converged'] = (change['distributionMean'] <= distributionTolerance and
+                               change['flipRate'] <= maxFlipRate and
+                               max(change['alphaMean'], change['omegaMean']) <= weightTolerance)
+        changes.append(change)
+
+        print '    Change: probabilities %.4f (max %.4f), %d best partitions, alphas %.4f, omegas %.4f.' % (
+            change['distributionMean'], change['distributionDelta'], change['flips'],
+            change['alphaMean'], change['omegaMean'])
+        if afterTrial:
+            afterTrial(trial, change)
+
+        if change['converged']:
+            print ' ** Converged after trial %d.' % trial
+            break
+        if timeBudget is not None and time.time() - start + change['seconds'] > timeBudget:
+            print ' ** Time budget of %.1fs spent after trial %d.' % (timeBudget, trial)
+            break
+    return changes
+
+
+def learnMany(batch, tolerance=1e-2, updatesPerKanji=20, damping=0.5):
+    # add (kanji, furigana) tuples to an already trained graph: only the
+    # neighbourhood of the new factors is inferred, and omegas and alphas are
+    # only adjusted where distributions have changed
+    # the whole batch is checked before the graph is changed, so that a pair
+    # without partition does not leave the factors of the others half added
+    for kanji, furigana in batch:
+        if (kanji, furigana) not in factorMap and Lattice(kanji, furigana, intern=False).isEmpty():
+            raise ValueError(u'No possible partition for (%s %s).' % (kanji, furigana))
+    factors = [construct(kanji, furigana) for kanji, furigana in batch]
+
+    # every new factor gets its omegas and best partition right away, even
+    # if all its kanjis are new, and the nodes of the new factors (new nodes
+    # included) their alphas, which in turn need the best partitions
+    def _adjustAlphas(kanjis):
+        for k in kanjis:
+            if nodeMap[k].alphas:
+                nodeMap[k].updateWeightVectorAlpha()
+
+    for factor in factors:
+        factor.updateWeightVectorOmega(nodeMap)
+    for k in set([k for factor in factors for k in factor.allKanji]):
+        nodeMap[k].updateWeightVectorAlpha()
+
+    scheduler = ResidualScheduler(nodeMap, tolerance, updatesPerKanji, damping)
+    for factor in factors:
+        scheduler.infer(factor)
+
+    affectedFactors = set()
+    for k in scheduler.changed:
+        affectedFactors.update(nodeMap[k].factors)
+    affectedFactors = [factor for factor in affectedFactors if factor.omegas]
+    for factor in affectedFactors:
+        factor.updateWeightVectorOmega(nodeMap)
+    _adjustAlphas(set([k for factor in affectedFactors for k in factor.allKanji]))
+
+    changedKanjis = scheduler.changed | set([k for factor in factors for k in factor.allKanji])
+    readingIndex.update([nodeMap[k] for k in changedKanjis], set(factors) | set(affectedFactors))
+
+    return factors
+
+
+def learnOne(kanji, furigana, tolerance=1e-2, updatesPerKanji=20, damping=0.5):
+    return learnMany([(kanji, furigana)], tolerance, updatesPerKanji, damping)[0]
+
+
+def saveModel(path):
+    snapshot.save(path, nodeMap, allFactors)
+
+
+def loadModel(path):
+    # replace the current model by the one in a snapshot
+    global graph, readingIndex
+    nodeMap.clear()
+    _, factors = snapshot.load(path).restore(nodeMap)
+    allFactors[:] = factors
+    settledFactors.clear()
+    adjustedDistributions.clear()
+    staleFactors.clear()
+    factorMap.clear()
+    for factor in allFactors:
+        factorMap[(factor.word, factor.pronunciation)] = factor
+    graph = None
+    readingIndex = ReadingIndex()
+    readingIndex.update(nodeMap.itervalues(), allFactors)
 
 
-def outputResult(trial, distribution=True, partitions=True, alphas=True):
+resultWriter = None  # the writer used by outputResult, text files by default
 
-    def outputAllNodeDistributions():    
-        with codecs.open('result/distribution_%d.txt' % trial, 'w', encoding='utf-8') as f:
-            for node in nodeMap.itervalues():
-                f.write(unicode(node) + u'\n')
+@metrics.timed('output')
+def outputResult(trial, distribution=True, partitions=True, alphas=True, writer=None):
+    global resultWriter
+    if writer is None:
+        if resultWriter is None:
+            resultWriter = ResultWriter()
+        writer = resultWriter
+    writer.write(trial, nodeMap.itervalues(), allFactors, distribution, partitions, alphas)
 
-    def outputAllFactorPartitions():
-        with codecs.open('result/partitions_%d.txt' % trial, 'w', encoding='utf-8') as f:
-            for factor in allFactors:
-                f.write(unicode(factor) + u'\n')
 
-    def outputAllAlphaVectors():
-        with codecs.open('result/alphas_%d.txt' % trial, 'w', encoding='utf-8') as f:
-            for node in nodeMap.itervalues():
-                f.write(unicode(node.outputAlphaVector()) + u'\n')
+if __name__ == "__main__":
 
-    if distribution:    outputAllNodeDistributions()
-    if partitions:      outputAllFactorPartitions()
-    if alphas:          outputAllAlphaVectors()
+    # --metrics writes the metrics of every trial to result/metrics.jsonl,
+    # --profile also profiles every phase
+    if '--metrics' in sys.argv or '--profile' in sys.argv:
+        metrics.enable(metrics.JsonLinesSink('result/metrics.jsonl'), profile='--profile' in sys.argv)
 
+    # --partition-cache keeps the partitions of every pair in result/partitions
+    # for the next runs
+    if '--partition-cache' in sys.argv:
+        partitioncache.configure(path='result/partitions')
 
-if __name__ == "__main__":
-
-    alltuples = []
-    with codecs.open('tuples.txt', 'r', encoding='utf-8') as f:
-        def _converter(line):
-            kanji, furigana = line.split()
-            return (kanji, furigana)
-        alltuples = map(_converter, f.readlines())
+    alltuples = list(ingest.readTuples('tuples.txt'))
 
     print ' ** Training set contains %d tuples.' % (len(alltuples))
 
-    TOTAL_TRIAL = 3
-    for trial in range(TOTAL_TRIAL):
-        learn(trial, alltuples)
-        adjustParameters()
+    # results are written in the background while the next trial runs
+    resultWriter = ResultWriter(background=True)
+
+    def _afterTrial(trial, change):
         outputResult(trial)
 
         print ' ** Start testing:'
         testModel(nodeMap)
+        metrics.current.endTrial(trial)
+
+    MAX_TRIAL = 10
+    train(alltuples, MAX_TRIAL, afterTrial=_afterTrial, compiled=True, activeSet=True)
+
+    resultWriter.close()
+    saveModel('result/model.snapshot')
+    if metrics.current.enabled:
+        metrics.current.dumpProfiles('result')
+        metrics.current.close()
 
+    print ' ** Partitions: %s' % partitioncache.current.summary()
     print ' ** All done. Output written to files.'
 
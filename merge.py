@@ -0,0 +1,170 @@
+
+# -*- coding: utf-8 -*-
+
+import argparse
+from array import array
+
+import util
+import learner
+import ingest
+import snapshot
+from scheduler import ResidualScheduler
+from test import testModel
+
+'''
+Shards of the model can be trained separately (e.g. one per JLPT level or per
+customer word list, possibly on different machines), saved as snapshots, and
+merged into one model without training on all the tuples again:
+
+  - the factors are the union of the factors of the shards; a factor found
+    in several shards has the sum of its weights, and the average of its
+    omegas weighted by its weight in every shard
+  - the distribution and smoothing of a kanji found in several shards are
+    the average of its distributions and smoothings, weighted by the number
+    of tuples of the kanji in every shard
+  - the alphas of a kanji found in several shards are computed again over
+    all of its factors, the other kanjis keep the alphas of their shard
+
+A kanji found in a single shard keeps everything it had in its shard. Only
+the factors of the kanjis shared between shards are then refined: they are
+inferred again by the residual scheduler, and the omegas and alphas around
+the distributions that moved are adjusted.
+'''
+
+def _nodeWeight(node):
+    # the number of tuples of the kanji in its shard
+    return sum([factor.weight for factor in node.factors])
+
+
+def _factorKeys(node):
+    return [(factor.word, factor.pronunciation) for factor in node.factors]
+
+
+def mergeModels(shards, refine=True, tolerance=1e-2, updatesPerKanji=20, damping=0.5):
+    # merge shards, a list of (nodeMap, factors) as given by
+    # Snapshot.restore, into the model of learner; returns the kanjis shared
+    # between shards
+    learner.reset()
+    nodeMap = learner.nodeMap
+
+    # union of the factors, with the factors of the shards they come from
+    sources = {}
+    for _, factors in shards:
+        for factor in factors:
+            merged = learner.factorMap.get((factor.word, factor.pronunciation))
+            if merged is None:
+                merged = learner.construct(factor.word, factor.pronunciation)
+                merged.weight = 0
+                sources[merged] = []
+            merged.weight += factor.weight
+            sources[merged].append(factor)
+
+    # omegas and best partitions, once the weights are final (the nodes count
+    # the furiganas of the best partitions by weight)
+    for merged, factors in sources.iteritems():
+        factors = [factor for factor in factors if factor.omegas]
+        if not factors:
+            continue
+        if len(factors) == 1:
+            merged.omegas = array('d', factors[0].omegas)
+            merged.setBestPath(factors[0].bestPath, nodeMap)
+            continue
+        total = float(sum([factor.weight for factor in factors]))
+        omegas = array('d', [0.0]) * merged.lattice.numEdges
+        for factor in factors:
+            for e, omega in enumerate(factor.omegas):
+                omegas[e] += omega * factor.weight / total
+        merged.omegas = omegas
+        merged.setBestPath(tuple(merged.lattice.viterbi(omegas)), nodeMap)
+
+    shardNodes = {}
+    for shardNodeMap, _ in shards:
+        for k, node in shardNodeMap.iteritems():
+            shardNodes.setdefault(k, []).append(node)
+    shared = set([k for k, nodes in shardNodes.iteritems() if len(nodes) > 1])
+
+    for k, nodes in shardNodes.iteritems():
+        node = nodeMap[k]
+        if len(nodes) == 1:
+            node.probSmoothing = nodes[0].probSmoothing
+            node.setDistribution(dict(nodes[0].distribution))
+            if nodes[0].alphas and _factorKeys(nodes[0]) == _factorKeys(node):
+                node.alphas = array('d', nodes[0].alphas)
+                continue
+        else:
+            weights = [_nodeWeight(n) for n in nodes]
+            total = float(sum(weights))
+            distribution = {}
+            for weight, n in zip(weights, nodes):
+                util.addDistribution(distribution, n.distribution, weight=weight / total)
+            node.probSmoothing = sum([weight * n.probSmoothing for weight, n in zip(weights, nodes)]) / total
+            node.setDistribution(util.normalize(distribution))
+        if all([factor.bestPath is not None for factor in node.factors]):
+            node.updateWeightVectorAlpha()
+
+    # what the shards have adjusted is up to date, except the factors found
+    # in several shards, whose omegas are averages
+    learner.staleFactors.clear()
+    learner.staleFactors.update([merged for merged, factors in sources.iteritems() if len(factors) > 1])
+    for k, node in nodeMap.iteritems():
+        learner.adjustedDistributions[k] = (dict(node.distribution), node.probSmoothing)
+
+    if refine and shared:
+        factors = set([factor for k in shared for factor in nodeMap[k].factors])
+        factors = [factor for factor in learner.allFactors if factor in factors]
+        scheduler = ResidualScheduler(nodeMap, tolerance, updatesPerKanji, damping)
+        for factor in factors:
+            scheduler.infer(factor)
+        print ' ** Refined %d factors of %d shared kanjis.' % (len(factors), len(shared))
+        print '    Inference: %s' % scheduler.summary()
+        learner.adjustParameters()
+
+    learner.readingIndex.update(nodeMap.itervalues(), learner.allFactors)
+    return shared
+
+
+def trainShard(paths, output, numTrials=10):
+    # train a shard on corpus files and save it as a snapshot, returns the
+    # number of tuples
+    tuples = list(ingest.parseLines(ingest.readLines(paths)))
+    print ' ** Shard of %d tuples from %s.' % (len(tuples), ', '.join(paths))
+    learner.reset()
+    learner.train(tuples, numTrials, compiled=True, activeSet=True)
+    learner.saveModel(output)
+    return len(tuples)
+
+
+def mergeSnapshots(paths, output=None, refine=True):
+    shards = [snapshot.load(path).restore() for path in paths]
+    shared = mergeModels(shards, refine)
+    print ' ** Merged %d shards: %d factors, %d kanjis (%d shared).' % (
+        len(shards), len(learner.allFactors), len(learner.nodeMap), len(shared))
+    if output:
+        learner.saveModel(output)
+    return shared
+
+
+def main():
+    argParser = argparse.ArgumentParser(description='Train model shards and merge them.')
+    commands = argParser.add_subparsers(dest='command')
+    trainParser = commands.add_parser('train', help='train a shard on corpus files')
+    trainParser.add_argument('corpus', nargs='+', help='vocabulary files ("word reading" per line)')
+    trainParser.add_argument('-o', '--output', required=True, help='shard snapshot')
+    trainParser.add_argument('-t', '--trials', type=int, default=10, help='maximal number of trials')
+    mergeParser = commands.add_parser('merge', help='merge shard snapshots')
+    mergeParser.add_argument('shards', nargs='+', help='shard snapshots')
+    mergeParser.add_argument('-o', '--output', default='result/model.snapshot', help='merged snapshot')
+    mergeParser.add_argument('--no-refine', action='store_true', help='do not refine the shared kanjis')
+    mergeParser.add_argument('--test', action='store_true', help='test the merged model on test.txt')
+    args = argParser.parse_args()
+
+    if args.command == 'train':
+        trainShard(args.corpus, args.output, args.trials)
+    else:
+        mergeSnapshots(args.shards, args.output, not args.no_refine)
+        if args.test:
+            testModel(learner.nodeMap)
+
+
+if __name__ == "__main__":
+    main()
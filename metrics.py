@@ -0,0 +1,317 @@
+
+# -*- coding: utf-8 -*-
+
+import cProfile
+import functools
+import json
+import math
+import os
+import pstats
+import signal
+import time
+from contextlib import contextmanager
+
+'''
+Metrics collect what happens while learning:
+  - counters, optionally labelled (e.g. the number of updates of every
+    kanji, to find the hub kanjis)
+  - histograms of observed values (e.g. the number of updates needed by a
+    factor), kept as count, sum, min, max and power of two buckets
+  - timers, the total time and number of calls of every phase (learn,
+    adjust, output, test), also optionally labelled
+  - cProfile profiles around named sections, and a sampling profiler that
+    counts the functions found on the stack at regular intervals
+
+Metrics are disabled by default: metrics.current is then a NullMetrics whose
+enabled attribute is False, and hot loops test it once before doing any work.
+enable() installs a Metrics that reports to a sink (JsonLinesSink or
+MemorySink) at the end of every trial.
+'''
+
+class Histogram:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = {}  # b -> number of values in [2^(b-1), 2^b), 0 for values < 1
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        b = 0 if value < 1 else int(math.floor(math.log(value, 2))) + 1
+        self.buckets[b] = self.buckets.get(b, 0) + 1
+
+    def quantile(self, q):
+        # upper bound of the bucket holding the quantile q
+        seen = 0
+        for b in sorted(self.buckets):
+            seen += self.buckets[b]
+            if seen >= q * self.count:
+                return min(2 ** b, self.max)
+        return self.max
+
+    def toDict(self):
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'mean': self.sum / self.count if self.count else None,
+                'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99),
+                'buckets': dict([(str(b), n) for b, n in self.buckets.iteritems()])}
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+'''
+A sampling profiler: a profiling timer signal interrupts the program every
+interval seconds (of CPU time) and the function running at that moment is
+counted, as well as every function on the stack (cumulative). Only works on
+Unix, in the main thread.
+'''
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.own = {}
+        self.cumulative = {}
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        seen = set()
+        first = True
+        while frame is not None:
+            code = frame.f_code
+            key = '%s:%d(%s)' % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name)
+            if first:
+                self.own[key] = self.own.get(key, 0) + 1
+                first = False
+            if key not in seen:
+                self.cumulative[key] = self.cumulative.get(key, 0) + 1
+                seen.add(key)
+            frame = frame.f_back
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def top(self, n=10, cumulative=False):
+        table = self.cumulative if cumulative else self.own
+        return sorted(table.iteritems(), key=lambda t: (-t[1], t[0]))[:n]
+
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, sink=None, profile=False, sampler=None):
+        self.sink = sink
+        self.profiling = profile
+        self.sampler = sampler
+        self.profiles = {}
+        self.reset()
+
+    def reset(self):
+        self.counters = {}    # (name, label) -> count
+        self.histograms = {}  # name -> Histogram
+        self.timers = {}      # (name, label) -> [seconds, calls]
+
+    def count(self, name, n=1, label=None):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, name, value):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        self.histograms[name].observe(value)
+
+    def addTime(self, name, seconds, label=None):
+        timer = self.timers.setdefault((name, label), [0.0, 0])
+        timer[0] += seconds
+        timer[1] += 1
+
+    @contextmanager
+    def timer(self, name, label=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.time() - start, label)
+
+    @contextmanager
+    def profile(self, name):
+        # cProfile the section when profiling is on (one profile per name,
+        # accumulated over all the runs of the section)
+        if not self.profiling:
+            yield
+            return
+        profiler = self.profiles.setdefault(name, cProfile.Profile())
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+    def dumpProfiles(self, directory='result'):
+        paths = []
+        for name, profiler in self.profiles.iteritems():
+            path = os.path.join(directory, 'profile_%s.prof' % name)
+            profiler.dump_stats(path)
+            paths.append(path)
+        return paths
+
+    def _labelled(self, table, name, n):
+        # the n labels with the largest values of name
+        values = [(label, value) for (key, label), value in table.iteritems() if key == name and label is not None]
+        return sorted(values, key=lambda t: (-t[1], t[0]))[:n]
+
+    def toDict(self):
+        def _key(name, label):
+            return name if label is None else u'%s[%s]' % (name, label)
+        return {
+            'counters': dict([(_key(*key), n) for key, n in self.counters.iteritems()]),
+            'histograms': dict([(name, h.toDict()) for name, h in self.histograms.iteritems()]),
+            'timers': dict([(_key(*key), {'seconds': t[0], 'calls': t[1]}) for key, t in self.timers.iteritems()]),
+        }
+
+    def report(self, topLabels=5):
+        lines = []
+        for (name, label), n in sorted(self.counters.iteritems()):
+            if label is None:
+                lines.append('    %-24s %d' % (name, n))
+        for name, h in sorted(self.histograms.iteritems()):
+            lines.append('    %-24s n=%d mean=%.2f p50=%s p90=%s max=%s' % (
+                name, h.count, h.sum / h.count, h.quantile(0.5), h.quantile(0.9), h.max))
+        for (name, label), (seconds, calls) in sorted(self.timers.iteritems()):
+            if label is None:
+                lines.append('    %-24s %.3fs (%d calls)' % (name, seconds, calls))
+        for name in sorted(set([name for name, label in self.timers if label is not None])):
+            top = self._labelled(dict([(key, t[0]) for key, t in self.timers.iteritems()]), name, topLabels)
+            lines.append(u'    %-24s %s' % (name + ' top', u' '.join([u'%s:%.3fs' % t for t in top])))
+        for name in sorted(set([name for name, label in self.counters if label is not None])):
+            top = self._labelled(self.counters, name, topLabels)
+            lines.append(u'    %-24s %s' % (name + ' top', u' '.join([u'%s:%d' % t for t in top])))
+        if self.sampler and self.sampler.samples:
+            lines.append('    %-24s %s' % ('samples top', ' '.join(['%s:%d' % t for t in self.sampler.top(topLabels)])))
+        return u'\n'.join(lines)
+
+    def endTrial(self, trial, output=True):
+        # report the metrics of the trial, and start over for the next one
+        record = self.toDict()
+        record['event'] = 'trial'
+        record['trial'] = trial
+        record['time'] = time.time()
+        if self.sampler:
+            record['samples'] = {'own': dict(self.sampler.own), 'cumulative': dict(self.sampler.cumulative)}
+        if self.sink:
+            self.sink.write(record)
+        if output:
+            print ' ** Metrics of trial %d:' % trial
+            print self.report().encode('utf-8')
+        self.reset()
+        return record
+
+    def close(self):
+        if self.sampler:
+            self.sampler.stop()
+        if self.sink:
+            self.sink.close()
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_nullContext = _NullContext()
+
+
+class NullMetrics:
+    enabled = False
+
+    def count(self, name, n=1, label=None):
+        pass
+
+    def observe(self, name, value):
+        pass
+
+    def addTime(self, name, seconds, label=None):
+        pass
+
+    def timer(self, name, label=None):
+        return _nullContext
+
+    def profile(self, name):
+        return _nullContext
+
+    def endTrial(self, trial, output=True):
+        return None
+
+    def close(self):
+        pass
+
+
+current = NullMetrics()
+
+def enable(sink=None, profile=False, sampleInterval=None):
+    # sampleInterval: seconds between two samples of the sampling profiler
+    global current
+    current.close()
+    sampler = None
+    if sampleInterval:
+        sampler = Sampler(sampleInterval)
+        sampler.start()
+    current = Metrics(sink, profile, sampler)
+    return current
+
+
+def disable():
+    global current
+    current.close()
+    current = NullMetrics()
+
+
+def timed(name):
+    # decorator timing (and profiling) every call of a function as the phase
+    # name when metrics are enabled
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            m = current
+            if not m.enabled:
+                return function(*args, **kwargs)
+            with m.timer(name):
+                with m.profile(name):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarizeProfile(path, n=15):
+    stats = pstats.Stats(path)
+    stats.sort_stats('cumulative').print_stats(n)
@@ -1,14 +1,28 @@
 
+import output
+import partitioncache
 import util
+from array import array
+from lattice import Lattice
 from collections import Counter
 
 '''
 A node represents a kanji variable in the factor graph.
-It is initialized by the kanji and its possible furiganas (domain).
+It is initialized by the kanji and its possible furiganas (domain), and the
+map of all the nodes of the graph, which the factors of the node are given
+when they need the other nodes (factors are many more than nodes, so they
+do not keep a reference to the map themselves).
+Nodes and factors have __slots__ and keep their vectors in arrays, so that
+a large model does not pay for a __dict__ per object and a boxed float per
+weight.
 '''
-class Node:
-    def __init__(self, kanji, furigana_set):
+class Node(object):
+    __slots__ = ('kanji', 'nodeMap', 'factors', 'distribution', 'alphas', 'furiganaCounts', 'probSmoothing',
+                 'residual', '_positions', '_messages', '_sum', '_stale', '_totalWeight')
+
+    def __init__(self, kanji, furigana_set, nodeMap):
         self.kanji = kanji
+        self.nodeMap = nodeMap
         self.factors = []
 
         # default distribution
@@ -17,23 +31,26 @@ class Node:
         for f in furigana_set:
             self.distribution[f] = 1.0 / numFurigana
 
-        self.alphas  = []
+        self.alphas = array('d')
+        # occurrences of every furigana of the kanji in the best partitions
+        # of the factors, kept up to date by the factors
+        self.furiganaCounts = Counter()
         self.probSmoothing = 0.1
+        self.residual = 0.0  # largest change made by the last update
+
+        # the weighted sum of the messages of all factors is kept between
+        # updates, only the messages of stale factors are summed in again
+        self._positions = {}  # factor -> indices in self.factors
+        self._messages = []   # message of each factor in the current sum (None if not summed)
+        self._sum = None      # None if the sum must be rebuilt from scratch
+        self._stale = set()
+        self._totalWeight = None  # sum of the weights of the factors, None until needed
 
     def __str__(self):
-        outputStr = u'%s: ' % (self.kanji)
-        distributionList = sorted([(v, k) for k,v in self.distribution.iteritems()], reverse=True)
-        outputStr += u' '.join([u'%s(%.1f)' % (furigana, prob * 100) for prob, furigana in distributionList])
-        return outputStr
+        return output.textDistribution(output.distributionRecord(self))
 
     def outputAlphaVector(self):
-        alphaVector = []
-        for i, factor in enumerate(self.factors):
-            alphaVector.append((self.alphas[i], u'%s %s' % (factor.word, factor.pronunciation)))
-        alphaVector.sort(reverse=True)
-        outputStr = u'%s: ' % (self.kanji)
-        outputStr += u' '.join(['%.1f (%s)' % (alpha, factorStr) for alpha, factorStr in alphaVector])
-        return outputStr
+        return output.textAlphas(output.alphaRecord(self))
 
     def prob(self, furigana):
         if furigana in self.distribution:
@@ -41,21 +58,68 @@ class Node:
         else:
             return self.probSmoothing  # Laplace smoothing for non-existent furigana
 
-    def updateDistribution(self):
-        distribution = {}
-        if self.alphas:
+    def addFactor(self, factor):
+        self._positions.setdefault(factor, []).append(len(self.factors))
+        self.factors.append(factor)
+        self._messages.append(None)
+        self._totalWeight = None
+        self.markStale(factor)
+
+    def markStale(self, factor):
+        # the message of the factor to this node has changed
+        self._stale.add(factor)
+
+    def invalidateMessages(self):
+        self._sum = None
+        self._totalWeight = None
+
+    def _weight(self, i):
+        # repeated tuples count as many times as they appear
+        weight = self.factors[i].weight
+        return self.alphas[i] * weight if self.alphas else weight
+
+    def _updateMessageSum(self):
+        if self._sum is None:
+            self._sum = {}
             for i, factor in enumerate(self.factors):
-                util.addDistribution(distribution, factor.newDistributionForKanji(self.kanji), weight=self.alphas[i])
+                self._messages[i] = factor.newDistributionForKanji(self.kanji, self.nodeMap)
+                util.addDistribution(self._sum, self._messages[i], weight=self._weight(i))
         else:
-            for factor in self.factors:
-                util.addDistribution(distribution, factor.newDistributionForKanji(self.kanji))
-
-        util.normalize(distribution)
-        if not util.isSameDistribution(self.distribution, distribution):
-            self.distribution = distribution
+            # in the order of the factors: factors hash by id, and the order of
+            # the additions changes the rounding of the sum
+            for factor in sorted(self._stale, key=lambda factor: self._positions[factor][0]):
+                message = factor.newDistributionForKanji(self.kanji, self.nodeMap)
+                for i in self._positions[factor]:
+                    if self._messages[i] is not None:
+                        util.addDistribution(self._sum, self._messages[i], weight=-self._weight(i))
+                    util.addDistribution(self._sum, message, weight=self._weight(i))
+                    self._messages[i] = message
+
+            # drop what is left of removed entries (rounding errors)
+            for k in [k for k, v in self._sum.iteritems() if v < 1e-12]:
+                del self._sum[k]
+        self._stale.clear()
+
+    def updateDistribution(self, damping=0.0):
+        # with damping, the distribution only moves part of the way to the new
+        # one (damping is the part of the old one that is kept)
+        self._updateMessageSum()
+        distribution = util.normalize(dict(self._sum))
+        if damping:
+            distribution = util.normalize(util.mixDistributions(self.distribution, distribution, damping))
+
+        self.residual = util.distributionDelta(self.distribution, distribution)
+        if self.residual > util.SAME_DISTRIBUTION_TOLERANCE:
+            self.setDistribution(distribution)
             return False
         return True  # indicate that updates have been made
 
+    def setDistribution(self, distribution):
+        # the messages of all factors to the adjacent nodes become stale
+        self.distribution = distribution
+        for factor in self._positions:
+            factor.nodeChanged(self.kanji, self.nodeMap)
+
     def allAdjacentKanjis(self):
         kanji_set = set()
         for factor in self.factors:
@@ -63,68 +127,167 @@ class Node:
         kanji_set.remove(self.kanji)
         return kanji_set
 
-    def updateWeightVectorAlpha(self):
-        self.alphas = []
-        furiganas = []
+    def share(self, factor):
+        # the weight of the messages of factor in the distribution of the node
+        if self._totalWeight is None:
+            self._totalWeight = float(sum([self._weight(i) for i in xrange(len(self.factors))]))
+        if not self._totalWeight:
+            return 0.0
+        return sum([self._weight(i) for i in self._positions[factor]]) / self._totalWeight
+
+    def adjacentShares(self):
+        # [(kanji, share)] of all adjacent kanjis, the largest share in the
+        # distribution of the kanji of a factor shared with this node (a
+        # factor that sends a constant message to the kanji does not count);
+        # the kanjis are listed in the order of the factors (not by address
+        # or hash) so that they are pushed in the same order in every process
+        # and by a compiled graph
+        shares = {}
+        order = []
+        nodeMap = self.nodeMap
         for factor in self.factors:
-            furiganas.extend(factor.mostProbableFuriganas(self.kanji))
-        furigana_counter = Counter(furiganas)
+            for k in factor.allKanji:
+                if k != self.kanji and not factor.sendsConstantMessage(k):
+                    share = nodeMap[k].share(factor)
+                    if share > shares.get(k, 0.0):
+                        if k not in shares:
+                            order.append(k)
+                        shares[k] = share
+        return [(k, shares[k]) for k in order]
+
+    def countFuriganas(self, factor, weight):
+        # add weight occurrences of the furiganas given to the kanji by the
+        # best partition of factor (remove them if weight is negative)
+        for f in factor.mostProbableFuriganas(self.kanji):
+            self.furiganaCounts[f] += weight
+            if not self.furiganaCounts[f]:
+                del self.furiganaCounts[f]
+
+    def recountFuriganas(self):
+        # count from scratch, e.g. after the best partitions have been set
+        # directly
+        self.furiganaCounts = Counter()
+        for factor in self.factors:
+            if factor.bestPath is not None:
+                self.countFuriganas(factor, factor.weight)
+
+    def updateWeightVectorAlpha(self):
+        self.alphas = array('d')
         for factor in self.factors:
             alpha = 0.0
             for f in factor.mostProbableFuriganas(self.kanji):
-                alpha += 1.0 / (furigana_counter[f] + 1)
+                alpha += 1.0 / (self.furiganaCounts[f] + 1)
             self.alphas.append(alpha)
 
         util.normalize_vector(self.alphas)
+        self.invalidateMessages()
 
     def resetDistribution(self):
         furigana_set = set(filter(lambda key: self.distribution[key] > 0.01, self.distribution.iterkeys()))
         numFurigana = len(furigana_set)
-        self.distribution = {}
+        distribution = {}
         for f in furigana_set:
-            self.distribution[f] = 1.0 / numFurigana
+            distribution[f] = 1.0 / numFurigana
         self.probSmoothing = 0.001
+        self.setDistribution(distribution)
 
 '''
 A factor represents a constraint between nodes in the factor graph.
 It is initialized by a tuple of (word, pronunciation) in the training data.
+The possible partitions of the pronunciation are kept as a lattice, so they
+are never listed unless needed for output (then by the partition cache).
 '''
-class Factor:
-    def __init__(self, kanji, furigana, verticesMap):
-        self.word = kanji
+class Factor(object):
+    __slots__ = ('pronunciation', 'lattice', 'allKanji', 'weight', 'omegas', 'bestPath', '_messages', '_ambiguous')
+
+    def __init__(self, kanji, furigana):
         self.pronunciation = furigana
 
-        self.partitions = util.generatePossiblePartitions(kanji, furigana)
-        self.allKanji = []
-        for k, _ in self.partitions[0]:
-            self.allKanji.append(k)
+        self.lattice = Lattice(kanji, furigana)
+        if self.lattice.isEmpty():
+            raise ValueError(u'No possible partition for (%s %s).' % (kanji, furigana))
+        self.allKanji = self.lattice.allKanji
+        self._ambiguous = self.lattice.isAmbiguous()
+        self.weight = 1  # number of times the tuple appears in the training data
 
-        self._verticesMap = verticesMap  # store a pointer to the the map of all vertices 
-        self.omegas = []
-        # self.omegas = util.omegaHeuristics(self.partitions)
-        self.bestPartition = None
+        # omegas are kept per lattice edge, the omega of a partition is the
+        # product of the omegas of its edges, and the best partition as the
+        # path of its edges
+        self.omegas = array('d')
+        self.bestPath = None
 
-    def __str__(self):
-        outputStr = u'--- (%s %s) ---\n' % (self.word, self.pronunciation)
-        for i, p in enumerate(self.partitions):
-            omegaStr = u'-'
-            if self.omegas:
-                omegaStr = '%.1f' % self.omegas[i]
-            bestPartitionIndicator = ' '
-            if self.bestPartition == p:
-                bestPartitionIndicator = '>'
-            outputStr += u' %s[%6s] %s\n' % (bestPartitionIndicator, omegaStr, u' '.join(map(lambda t: '%s:%s' % (t[0], t[1]), p)))
-        return outputStr
+        # outgoing message for each kanji, until one of the nodes changes
+        # (None until the first message)
+        self._messages = None
 
+    def __str__(self):
+        return output.textPartitions(output.partitionRecord(self))
+
+    @property
+    def word(self):
+        return self.lattice.word
+
+    @property
+    def partitions(self):
+        # listed by the shared partition cache, in the order of the lattice paths
+        return partitioncache.partitions(self.word, self.pronunciation)
+
+    @property
+    def bestPartition(self):
+        if self.bestPath is None:
+            return None
+        return self.lattice.partition(self.bestPath)
+
+    def partitionOmegas(self):
+        if not self.omegas:
+            return []
+        omegas = []
+        for path in self.lattice.paths():
+            prop = 1.0
+            for e in path:
+                prop *= self.omegas[e]
+            omegas.append(prop)
+        return util.normalize_vector(omegas)
 
     def furiganaSetForKanji(self, kanji):
-        furigana_set = set()
-        for p in self.partitions:
-            for k, f in p:
-                furigana_set.add(f)
-        return furigana_set
-
-    def newDistributionForKanji(self, kanji):
+        return self.lattice.furiganaSet()
+
+    def addOccurrence(self, nodeMap):
+        self.weight += 1
+        for k in set(self.allKanji):
+            nodeMap[k].invalidateMessages()
+        if self.bestPath is not None:
+            for k in self.allKanji:
+                nodeMap[k].countFuriganas(self, 1)
+
+    def sendsConstantMessage(self, kanji):
+        # the message to kanji does not depend on any distribution if kanji
+        # is the only kanji, or if it has a single edge on the only partition
+        return len(self.allKanji) == 1 or (not self._ambiguous and self.allKanji.count(kanji) == 1)
+
+    def nodeChanged(self, kanji, nodeMap):
+        # the messages to all other kanjis depend on the distribution of kanji
+        # (and so does the message to kanji itself if it appears twice)
+        messages = self._messages
+        for k in self.allKanji:
+            if (k != kanji or self.allKanji.count(k) > 1) and not self.sendsConstantMessage(k):
+                if messages:
+                    messages.pop(k, None)
+                nodeMap[k].markStale(self)
+
+    def invalidateMessages(self, nodeMap):
+        self._messages = None
+        for k in set(self.allKanji):
+            nodeMap[k].markStale(self)
+
+    def newDistributionForKanji(self, kanji, nodeMap):
+        if self._messages is None:
+            self._messages = {}
+        if kanji not in self._messages:
+            self._messages[kanji] = self._newDistributionForKanji(kanji, nodeMap)
+        return self._messages[kanji]
+
+    def _newDistributionForKanji(self, kanji, nodeMap):
         distribution = {}
             
         if len(self.allKanji) == 1:
@@ -134,30 +297,15 @@ class Factor:
                 distribution[f] = 1.0 / numFurigana
 
         else:
-            # k is the kanji whose probability will be marginalized out
-            for kIndex, k in enumerate(self.allKanji):
-                if kanji == k:
-
-                    # for all possible partitions p for the current factor
-                    for pIndex, p in enumerate(self.partitions):
-
-                        # the probability will be the join probability of
-                        # all other kanjis having the furigana specified 
-                        # by the particular partition
-                        prob = 1.0
-                        for index in range(len(p)):
-                            if index != kIndex:
-                                k0, f0 = p[index]
-                                prob *= self._verticesMap[k0].prob(f0)
-
-                        if self.omegas:
-                            prob *= self.omegas[pIndex]
-
-                        furigana = p[kIndex][1]
-                        if furigana not in distribution:
-                            distribution[furigana] = prob
-                        else:
-                            distribution[furigana] += prob
+            # k is the kanji whose probability will be marginalized out: the
+            # edges of k are only weighted by omega, while the edges of all
+            # other kanjis are weighted by the probability of having the
+            # furigana specified by the edge
+            ownWeights = self.omegas or [1.0] * self.lattice.numEdges
+            weights = list(ownWeights)
+            for e, k, f in self.lattice.kanjiEdges():
+                weights[e] *= nodeMap[k].prob(f)
+            distribution = self.lattice.marginals(kanji, weights, ownWeights)
 
         # return the normalized distribution for a kanji respect to one
         # specific factor
@@ -166,18 +314,28 @@ class Factor:
     # the best partition predicted after one trial might not necessarily
     # be correct, add smoothing factor to give some chance to other possible
     # partitions in the next round
-    def updateWeightVectorOmega(self, smoothing = 0.5):
-        self.omegas = []
-        for p in self.partitions:
-            prop = 1.0
-            for k, f in p:
-                prop *= (self._verticesMap[k].prob(f) + smoothing)
-            self.omegas.append(prop)
-        util.normalize_vector(self.omegas)
-
-        # find the most probable partition
-        _, index = max([(omega, i) for i, omega in enumerate(self.omegas)])
-        self.bestPartition = self.partitions[index]
+    def updateWeightVectorOmega(self, nodeMap, smoothing = 0.5):
+        self.omegas = array('d', [1.0]) * self.lattice.numEdges
+        for e, k, f in self.lattice.kanjiEdges():
+            self.omegas[e] = nodeMap[k].prob(f) + smoothing
+
+        # find the most probable partition, returns True if it has changed
+        bestPath = tuple(self.lattice.viterbi(self.omegas))
+        self.invalidateMessages(nodeMap)
+        if bestPath == self.bestPath:
+            return False
+        self.setBestPath(bestPath, nodeMap)
+        return True
+
+    def setBestPath(self, bestPath, nodeMap):
+        # a kanji appearing twice in the word counts the furiganas of the
+        # factor twice, as the factor appears twice in its node
+        if self.bestPath is not None:
+            for k in self.allKanji:
+                nodeMap[k].countFuriganas(self, -self.weight)
+        self.bestPath = bestPath
+        for k in self.allKanji:
+            nodeMap[k].countFuriganas(self, self.weight)
 
     def mostProbableFuriganas(self, kanji):
         furiganas = list()
@@ -0,0 +1,219 @@
+
+# -*- coding: utf-8 -*-
+
+import codecs
+import gzip
+import json
+import os
+import threading
+from Queue import Queue
+
+'''
+The results of a trial are the distribution of every node, the partitions
+of every factor and the alpha vector of every node. Each of them is first
+turned into a record of plain values (so that the model can change while
+the records are written), then formatted as lines by a format:
+
+  text      the human readable format of Node.__str__, Factor.__str__ and
+            Node.outputAlphaVector (.txt)
+  jsonl     one JSON object per record (.jsonl)
+  columnar  one tab separated row per entry of a record, e.g. one row per
+            (kanji, furigana, probability) (.tsv)
+
+A ResultWriter streams the lines of every record to its file, optionally
+compressed with gzip, and can write deltas (only the records that changed
+since the previous trial written by the same writer) and work in a
+background thread, so that writing overlaps the next trial.
+'''
+
+def distributionRecord(node):
+    # (kanji, [(furigana, prob)]) by decreasing probability
+    return (node.kanji, [(f, p) for p, f in sorted([(p, f) for f, p in node.distribution.iteritems()], reverse=True)])
+
+
+def partitionRecord(factor):
+    # (word, pronunciation, [(partition, omega or None, isBest)])
+    partitionOmegas = factor.partitionOmegas()
+    bestPartition = factor.bestPartition
+    partitions = []
+    for i, p in enumerate(factor.partitions):
+        partitions.append((p, partitionOmegas[i] if partitionOmegas else None, p == bestPartition))
+    return (factor.word, factor.pronunciation, partitions)
+
+
+def alphaRecord(node):
+    # (kanji, [(alpha, word, pronunciation, weight)]) by decreasing alpha
+    alphas = [(node.alphas[i], factor.word, factor.pronunciation, factor.weight)
+              for i, factor in enumerate(node.factors)]
+    alphas.sort(key=lambda t: (t[0], _factorText(*t[1:])), reverse=True)
+    return (node.kanji, alphas)
+
+
+def _factorText(word, pronunciation, weight):
+    if weight > 1:
+        return u'%s %s x%d' % (word, pronunciation, weight)
+    return u'%s %s' % (word, pronunciation)
+
+
+def _partitionText(partition):
+    return u' '.join([u'%s:%s' % t for t in partition])
+
+
+def textDistribution(record):
+    kanji, distribution = record
+    return u'%s: %s' % (kanji, u' '.join([u'%s(%.1f)' % (f, p * 100) for f, p in distribution]))
+
+
+def textPartitions(record):
+    word, pronunciation, partitions = record
+    lines = [u'--- (%s %s) ---\n' % (word, pronunciation)]
+    for p, omega, isBest in partitions:
+        omegaStr = u'-' if omega is None else u'%.1f' % omega
+        lines.append(u' %s[%6s] %s\n' % ('>' if isBest else ' ', omegaStr, _partitionText(p)))
+    return u''.join(lines)
+
+
+def textAlphas(record):
+    kanji, alphas = record
+    return u'%s: %s' % (kanji, u' '.join([u'%.1f (%s)' % (alpha, _factorText(word, pronunciation, weight))
+                                          for alpha, word, pronunciation, weight in alphas]))
+
+
+class TextFormat:
+    extension = '.txt'
+
+    def lines(self, kind, record):
+        return {'distribution': textDistribution,
+                'partitions': textPartitions,
+                'alphas': textAlphas}[kind](record) + u'\n'
+
+
+class JsonLinesFormat:
+    extension = '.jsonl'
+
+    def lines(self, kind, record):
+        if kind == 'distribution':
+            kanji, distribution = record
+            data = {'kanji': kanji, 'distribution': distribution}
+        elif kind == 'partitions':
+            word, pronunciation, partitions = record
+            data = {'word': word, 'pronunciation': pronunciation,
+                    'partitions': [{'partition': p, 'omega': omega, 'best': isBest}
+                                   for p, omega, isBest in partitions]}
+        else:
+            kanji, alphas = record
+            data = {'kanji': kanji, 'alphas': [{'alpha': alpha, 'word': word, 'pronunciation': pronunciation,
+                                                'weight': weight} for alpha, word, pronunciation, weight in alphas]}
+        return json.dumps(data, ensure_ascii=False) + u'\n'
+
+
+class ColumnarFormat:
+    extension = '.tsv'
+
+    def lines(self, kind, record):
+        if kind == 'distribution':
+            kanji, distribution = record
+            rows = [u'%s\t%s\t%r' % (kanji, f, p) for f, p in distribution]
+        elif kind == 'partitions':
+            word, pronunciation, partitions = record
+            rows = [u'%s\t%s\t%d\t%s\t%d\t%s' % (word, pronunciation, i, u'' if omega is None else repr(omega),
+                                                 isBest, _partitionText(p))
+                    for i, (p, omega, isBest) in enumerate(partitions)]
+        else:
+            kanji, alphas = record
+            rows = [u'%s\t%s\t%s\t%d\t%r' % (kanji, word, pronunciation, weight, alpha)
+                    for alpha, word, pronunciation, weight in alphas]
+        return u''.join([row + u'\n' for row in rows])
+
+
+FORMATS = {'text': TextFormat, 'jsonl': JsonLinesFormat, 'columnar': ColumnarFormat}
+
+_RECORDS = [('distribution', distributionRecord, 'nodes'),
+            ('partitions', partitionRecord, 'factors'),
+            ('alphas', alphaRecord, 'nodes')]
+
+
+class ResultWriter:
+    def __init__(self, directory='result', outputFormat='text', compress=False, delta=False, background=False):
+        self.directory = directory
+        self.format = FORMATS[outputFormat]()
+        self.compress = compress
+        self.delta = delta
+        self._written = {}  # kind -> {key: hash of the lines last written}
+
+        self._queue = None
+        self._error = None
+        if background:
+            self._queue = Queue(maxsize=1)  # at most one trial waiting
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def path(self, kind, trial):
+        name = '%s_%d%s%s' % (kind, trial, '.delta' if self.delta else '', self.format.extension)
+        return os.path.join(self.directory, name + ('.gz' if self.compress else ''))
+
+    def _open(self, path):
+        if self.compress:
+            return codecs.getwriter('utf-8')(gzip.open(path, 'wb'))
+        return codecs.open(path, 'w', encoding='utf-8')
+
+    def write(self, trial, nodes, factors, distribution=True, partitions=True, alphas=True):
+        # the records are taken now, and written now or in the background
+        selected = {'distribution': distribution, 'partitions': partitions, 'alphas': alphas}
+        sources = {'nodes': list(nodes), 'factors': list(factors)}
+        jobs = [(kind, [record(item) for item in sources[source]])
+                for kind, record, source in _RECORDS if selected[kind]]
+        if self._queue is None:
+            self._write(trial, jobs)
+        else:
+            self._queue.put((trial, jobs))
+
+    def _write(self, trial, jobs):
+        for kind, records in jobs:
+            written = self._written.setdefault(kind, {})
+            f = self._open(self.path(kind, trial))
+            try:
+                for record in records:
+                    lines = self.format.lines(kind, record)
+                    if self.delta:
+                        key = record[:-1]
+                        digest = hash(lines)
+                        if written.get(key) == digest:
+                            continue
+                        written[key] = digest
+                    f.write(lines)
+            finally:
+                f.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is not None:
+                    self._write(*item)
+            except Exception, e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+            if item is None:
+                return
+
+    def _raise(self):
+        # errors of the background thread are raised in the caller
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def flush(self):
+        # wait until everything given to the writer has been written
+        if self._queue is not None:
+            self._queue.join()
+        self._raise()
+
+    def close(self):
+        if self._queue is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._queue = None
+        self._raise()
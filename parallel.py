@@ -0,0 +1,136 @@
+
+# -*- coding: utf-8 -*-
+
+import heapq
+import multiprocessing
+import os
+import sys
+from array import array
+
+import util
+import learner
+import ingest
+from test import testModel
+
+'''
+Tuples only interact through the kanjis they share, so the connected
+components of the factor graph can be trained independently. Components are
+packed into shards of similar size, each shard is trained (all trials of
+learn and adjustParameters) in its own process, and the results are merged
+back into learner.nodeMap and learner.allFactors.
+'''
+
+def tupleKanjis(kanji):
+    return [c for c in util.normalizeWord(kanji) if not util.isKana(c)]
+
+
+def connectedComponents(tuples):
+    # union-find over the kanjis, returns the tuples of every component
+    # (in their original order), largest component first
+    parent = {}
+
+    def _find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for kanji, _ in tuples:
+        kanjis = tupleKanjis(kanji)
+        for k in kanjis:
+            parent.setdefault(k, k)
+        for k in kanjis[1:]:
+            parent[_find(k)] = _find(kanjis[0])
+
+    components = {}
+    for kanji, furigana in tuples:
+        components.setdefault(_find(tupleKanjis(kanji)[0]), []).append((kanji, furigana))
+    return sorted(components.values(), key=len, reverse=True)
+
+
+def packShards(components, numShards):
+    # greedily put the largest remaining component into the smallest shard
+    shards = [[] for _ in range(numShards)]
+    heap = [(0, i) for i in range(numShards)]
+    for component in components:
+        size, i = heapq.heappop(heap)
+        shards[i].extend(component)
+        heapq.heappush(heap, (size + len(component), i))
+    return [shard for shard in shards if shard]
+
+
+def _trainShard(args):
+    tuples, numTrials = args
+    sys.stdout = open(os.devnull, 'w')
+    learner.reset()
+    for trial in range(numTrials):
+        learner.learn(trial, tuples, compiled=True)
+        learner.adjustParameters()
+
+    nodes = {}
+    for node in learner.nodeMap.itervalues():
+        alphas = dict([((factor.word, factor.pronunciation), node.alphas[i])
+                       for i, factor in enumerate(node.factors)])
+        nodes[node.kanji] = (node.distribution, node.probSmoothing, alphas)
+    factors = {}
+    for factor in learner.allFactors:
+        factors[(factor.word, factor.pronunciation)] = (factor.omegas, factor.bestPath)
+    return nodes, factors
+
+
+def merge(tuples, results):
+    # rebuild the whole graph in learner and copy the state of every shard
+    learner.reset()
+    for kanji, furigana in tuples:
+        learner.construct(kanji, furigana)
+
+    for nodes, factors in results:
+        for key, (omegas, bestPath) in factors.iteritems():
+            factor = learner.factorMap[key]
+            factor.omegas = omegas
+            factor.setBestPath(bestPath, learner.nodeMap)
+            factor.invalidateMessages(learner.nodeMap)
+        for kanji, (distribution, probSmoothing, alphas) in nodes.iteritems():
+            node = learner.nodeMap[kanji]
+            node.probSmoothing = probSmoothing
+            node.alphas = array('d', [alphas[(factor.word, factor.pronunciation)] for factor in node.factors])
+            node.invalidateMessages()
+            node.setDistribution(distribution)
+
+    learner.readingIndex.update(learner.nodeMap.itervalues(), learner.allFactors)
+
+
+def train(tuples, numTrials, numProcesses=None):
+    numProcesses = numProcesses or multiprocessing.cpu_count()
+    components = connectedComponents(tuples)
+    shards = packShards(components, numProcesses)
+    print ' ** %d components packed into %d shards of %s tuples.' % (
+        len(components), len(shards), '/'.join([str(len(shard)) for shard in shards]))
+
+    pool = multiprocessing.Pool(len(shards))
+    try:
+        results = pool.map(_trainShard, [(shard, numTrials) for shard in shards])
+    finally:
+        pool.close()
+        pool.join()
+
+    merge(tuples, results)
+    print ' ** Merged %d shards.' % len(results)
+
+
+if __name__ == "__main__":
+
+    alltuples = list(ingest.readTuples('tuples.txt'))
+
+    print ' ** Training set contains %d tuples.' % (len(alltuples))
+
+    TOTAL_TRIAL = 3
+    numProcesses = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    train(alltuples, TOTAL_TRIAL, numProcesses)
+    learner.outputResult(TOTAL_TRIAL - 1)
+
+    print ' ** Start testing:'
+    testModel(learner.nodeMap)
+
+    learner.saveModel('result/model.snapshot')
+    print ' ** All done. Output written to files.'
@@ -0,0 +1,171 @@
+
+# -*- coding: utf-8 -*-
+
+import anydbm
+import atexit
+import collections
+import threading
+from array import array
+
+import util
+
+'''
+The partitions of a (word, reading) pair are needed again and again: by the
+output of every factor, and by every test case in TestCase.test and the
+compiled test set. A partition cache computes them once with
+util.generatePossiblePartitions and keeps them in a LRU of at most maxSize
+pairs, optionally backed by an on-disk store (a dbm file) shared by all the
+runs of the workflow. A store is not meant to be used by several processes
+at the same time; the threads of a process share the cache and its store
+under a lock.
+
+An entry does not keep the partitions as lists of tuples, but the offsets
+where the furigana of every kanji ends in the reading (in hiragana):
+
+  numPartitions, ends of the kanjis of partition 0, of partition 1, ...
+
+as an array of integers (long compounds have tens of thousands of
+partitions, more than a short integer can count). The kanjis and the kana anchors come from
+util.segmentWord, so the partitions are rebuilt from the offsets in the same
+order as util.generatePossiblePartitions.
+'''
+
+FORMAT = '2'  # changes when the offsets of a stored entry mean something else
+
+def encode(word, partitions):
+    offsets = array('i', [len(partitions)])
+    segments = util.segmentWord(word)
+    for p in partitions:
+        pairs = iter(p)
+        pos = 0
+        for kana, text in segments:
+            if kana:
+                pos += len(text)
+                continue
+            for _ in text:
+                pos += len(next(pairs)[1])
+                offsets.append(pos)
+    return offsets
+
+
+def decode(word, reading, offsets):
+    reading = u''.join(map(util.toHiragana, reading))
+    segments = util.segmentWord(word)
+    numKanjis = sum([len(text) for kana, text in segments if not kana])
+    partitions = []
+    o = 1
+    for _ in xrange(offsets[0]):
+        partition = []
+        pos = 0
+        for kana, text in segments:
+            if kana:
+                pos += len(text)
+                continue
+            for c in text:
+                partition.append((c, reading[pos:offsets[o]]))
+                pos = offsets[o]
+                o += 1
+        partitions.append(partition)
+    assert o == 1 + offsets[0] * numKanjis
+    return partitions
+
+
+class PartitionCache:
+    def __init__(self, maxSize=100000, path=None):
+        self.maxSize = maxSize
+        self._entries = collections.OrderedDict()  # (word, reading) -> offsets, least recently used first
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()  # e.g. the threads of the annotation service
+
+        self.store = None
+        if path is not None:
+            self.store = anydbm.open(path, 'c')
+            if self.store.get('__format__') != FORMAT:
+                for key in self.store.keys():
+                    del self.store[key]
+                self.store['__format__'] = FORMAT
+
+    def _storeKey(self, word, reading):
+        return (u'%s %s' % (word, reading)).encode('utf-8')
+
+    def _insert(self, key, offsets):
+        with self._lock:
+            if key not in self._entries and len(self._entries) >= self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = offsets
+
+    def partitions(self, word, reading):
+        key = (word, reading)
+        with self._lock:
+            offsets = self._entries.pop(key, None)
+            if offsets is not None:
+                self.hits += 1
+                self._entries[key] = offsets
+        if offsets is not None:
+            return decode(word, reading, offsets)
+
+        if self.store is not None:
+            with self._lock:
+                stored = self.store.get(self._storeKey(word, reading))
+                if stored is not None:
+                    self.diskHits += 1
+            if stored is not None:
+                offsets = array('i')
+                offsets.fromstring(stored)
+                self._insert(key, offsets)
+                return decode(word, reading, offsets)
+
+        # computed partitions are returned as such, only the cache keeps them
+        # as offsets
+        partitions = util.generatePossiblePartitions(word, reading)
+        offsets = encode(word, partitions)
+        with self._lock:
+            self.misses += 1
+            if self.store is not None:
+                self.store[self._storeKey(word, reading)] = offsets.tostring()
+        self._insert(key, offsets)
+        return partitions
+
+    def stats(self):
+        return {'hits': self.hits, 'diskHits': self.diskHits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': len(self._entries)}
+
+    def summary(self):
+        lookups = self.hits + self.diskHits + self.misses
+        if not lookups:
+            return 'No partition looked up.'
+        return '%d lookups, %d hits (%.1f%%), %d from disk, %d computed, %d evicted.' % (
+            lookups, self.hits, 100.0 * self.hits / lookups, self.diskHits, self.misses, self.evictions)
+
+    def sync(self):
+        with self._lock:
+            if self.store is not None:
+                self.store.sync()
+
+    def close(self):
+        with self._lock:
+            if self.store is not None:
+                self.store.close()
+                self.store = None
+
+
+current = PartitionCache()
+
+def configure(maxSize=100000, path=None):
+    # replace the shared cache, e.g. by one backed by an on-disk store; the
+    # store is closed when the process exits
+    global current
+    current.close()
+    current = PartitionCache(maxSize, path)
+    if path is not None:
+        atexit.register(current.close)
+    return current
+
+
+def partitions(word, reading):
+    # the partitions of (word, reading) from the shared cache
+    return current.partitions(word, reading)
@@ -0,0 +1,105 @@
+
+# -*- coding: utf-8 -*-
+
+import heapq
+import itertools
+import time
+
+import metrics
+
+'''
+A residual scheduler runs belief propagation after a factor is added (or
+revisited) by always updating the node whose incoming messages changed the
+most. The residual of a node estimates how much its incoming messages changed
+since it was last updated: when a neighbour changes by r, the message of a
+factor they share changes by about r, and moves the distribution of the node
+by r times the share of the factor in it (see Node.share); a factor whose
+message to the node is constant passes nothing on. A node passes on
+at most its own residual: what it changes beyond that was left over by
+earlier inferences (e.g. when the budget ran out), not caused by this one.
+Inference stops when no residual is larger than the tolerance, or when the
+update budget of the factor is spent: updatesPerKanji for every distinct
+kanji of the factor, as a longer word reaches more of the graph.
+
+Nodes are updated with damping, so that nodes feeding each other (e.g. a
+kanji whose only factor is a word with another kanji) settle instead of
+oscillating. With the default tolerance (a change of 1% in some
+probability), almost every factor settles within its budget: on tuples.txt,
+trial 0 needs about 3 updates per factor and no factor runs out of budget,
+with the same accuracy as tighter tolerances.
+'''
+class ResidualScheduler:
+    def __init__(self, nodes, tolerance=1e-2, updatesPerKanji=20, damping=0.5):
+        self.nodes = nodes
+        self.tolerance = tolerance
+        self.updatesPerKanji = updatesPerKanji
+        self.damping = damping
+
+        # number of updateDistribution calls needed by each inferred factor,
+        # and the number of factors that ran out of budget
+        self.updateCounts = []
+        self.exhausted = 0
+
+        # kanjis whose distribution has been changed by inference, and all the
+        # kanjis updated (including changes below the tolerance)
+        self.changed = set()
+        self.updated = set()
+
+    def infer(self, factor):
+        heap = []
+        residuals = {}
+        order = itertools.count()
+
+        def _push(kanji, residual):
+            if residual > self.tolerance and residual > residuals.get(kanji, 0.0):
+                residuals[kanji] = residual
+                heapq.heappush(heap, (-residual, next(order), kanji))
+
+        # the nodes of the factor have a new incoming message
+        for kanji in factor.allKanji:
+            _push(kanji, float('inf'))
+
+        m = metrics.current
+        enabled = m.enabled
+
+        updates = 0
+        budget = self.updatesPerKanji * len(set(factor.allKanji))
+        while heap and updates < budget:
+            negResidual, _, kanji = heapq.heappop(heap)
+            if residuals.get(kanji) != -negResidual:
+                continue  # outdated entry, the node has been pushed again
+            del residuals[kanji]
+
+            node = self.nodes[kanji]
+            if enabled:
+                start = time.time()
+            unchanged = node.updateDistribution(self.damping)
+            if enabled:
+                m.addTime('node.update', time.time() - start, kanji)
+                m.count('node.update.unchanged' if unchanged else 'node.update.changed')
+            if not unchanged:
+                self.changed.add(kanji)
+            self.updated.add(kanji)
+            updates += 1
+            residual = min(node.residual, -negResidual)
+            if residual > self.tolerance:
+                for k, share in node.adjacentShares():
+                    _push(k, residual * share)
+
+        if residuals:
+            self.exhausted += 1
+        self.updateCounts.append(updates)
+        if enabled:
+            m.count('infer.factors')
+            if residuals:
+                m.count('infer.exhausted')
+            m.observe('infer.updates', updates)
+        return updates
+
+    def summary(self):
+        if not self.updateCounts:
+            return 'No factor inferred.'
+        total = sum(self.updateCounts)
+        return '%d updates for %d factors (%.1f per factor, max %d), %d factors ran out of budget.' % (
+            total, len(self.updateCounts), float(total) / len(self.updateCounts),
+            max(self.updateCounts), self.exhausted)
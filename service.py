@@ -0,0 +1,219 @@
+
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import time
+from Queue import Queue, Empty
+
+import snapshot
+from annotate import Annotator
+
+'''
+The annotation service loads a model snapshot once and answers requests over
+a Unix or TCP socket. The protocol is one JSON object per line in both
+directions:
+
+  request   {"id": any, "word": "大手企業", "reading": "おおてきぎょう",
+             "alternatives": 3 (optional, at most maxAlternatives)}
+  response  {"id": any, "partition": [[kanji, furigana], ...],
+             "alternatives": [{"partition": ..., "belief": ...}, ...],
+             "belief": ..., "confidence": ..., "unknown": [kanjis],
+             "fallback": true if the omega heuristics were used}
+            or {"id": any, "error": message}
+
+A client can send many requests without waiting for the responses, which
+come back in the same order. Every connection is served by its own thread,
+but all annotations are made by a single batcher thread: requests waiting in
+the queue are taken together (up to maxBatch, waiting at most maxDelay
+seconds for more to arrive) and annotated in one batch, so that concurrent
+clients share the lookups of the batch.
+'''
+
+class _Request:
+    def __init__(self, word, reading):
+        self.word = word
+        self.reading = reading
+        self.done = threading.Event()
+        self.annotation = None
+        self.error = None
+
+
+class Batcher:
+    def __init__(self, annotator, maxBatch=256, maxDelay=0.002):
+        self.annotator = annotator
+        self.maxBatch = maxBatch
+        self.maxDelay = maxDelay
+        self.queue = Queue()
+        self.batches = 0
+        self.requests = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, word, reading):
+        request = _Request(word, reading)
+        self.queue.put(request)
+        return request
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.maxDelay
+            while len(batch) < self.maxBatch:
+                timeout = deadline - time.time()
+                try:
+                    batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                annotations = self.annotator.annotateBatch([(r.word, r.reading) for r in batch])
+                for request, annotation in zip(batch, annotations):
+                    request.annotation = annotation
+            except Exception:
+                # one bad request must not fail the others of the batch
+                for request in batch:
+                    try:
+                        request.annotation = self.annotator.annotate(request.word, request.reading)
+                    except Exception, e:
+                        request.error = str(e)
+            self.batches += 1
+            self.requests += len(batch)
+            for request in batch:
+                request.done.set()
+
+
+def _validate(message):
+    # (word, reading, alternatives) of a request, invalid requests are
+    # rejected before they reach the batcher
+    word, reading = message['word'], message['reading']
+    if not isinstance(word, basestring) or not isinstance(reading, basestring):
+        raise TypeError('word and reading must be strings')
+    alternatives = message.get('alternatives')
+    if alternatives is not None and (isinstance(alternatives, bool) or not isinstance(alternatives, (int, long))):
+        raise TypeError('alternatives must be an integer')
+    if alternatives is not None and alternatives < 0:
+        raise ValueError('alternatives must not be negative')
+    return word, reading, alternatives
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # responses are written by a second thread, in the order of the
+        # requests, so that a client can pipeline its requests
+        pending = Queue()
+        writer = threading.Thread(target=self._write, args=(pending,))
+        writer.start()
+        try:
+            for line in iter(self.rfile.readline, ''):
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                    word, reading, alternatives = _validate(message)
+                    request = self.server.batcher.submit(word, reading)
+                    pending.put((message.get('id'), alternatives, request))
+                except (ValueError, KeyError, TypeError), e:
+                    pending.put((None, None, 'Invalid request: %s' % e))
+        finally:
+            pending.put(None)
+            writer.join()
+
+    def _write(self, pending):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            requestId, alternatives, request = item
+            if isinstance(request, _Request):
+                request.done.wait()
+                if request.error:
+                    response = {'error': request.error}
+                else:
+                    response = request.annotation.toDict(alternatives)
+            else:
+                response = {'error': request}
+            response['id'] = requestId
+            try:
+                self.wfile.write(json.dumps(response) + '\n')
+                self.wfile.flush()
+            except socket.error:
+                pass  # the client has gone
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def createServer(model, address, maxBatch=256, maxDelay=0.002, maxAlternatives=10):
+    # address is a path for a Unix socket, or a (host, port) pair
+    if isinstance(address, basestring):
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, _Handler)
+    else:
+        server = TCPServer(address, _Handler)
+    server.batcher = Batcher(Annotator(model, maxAlternatives), maxBatch, maxDelay)
+    return server
+
+
+class Client:
+    def __init__(self, address):
+        if isinstance(address, basestring):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('r+b')
+
+    def annotateMany(self, pairs, alternatives=None):
+        # send all the requests first, then read the responses
+        for i, (word, reading) in enumerate(pairs):
+            message = {'id': i, 'word': word, 'reading': reading}
+            if alternatives is not None:
+                message['alternatives'] = alternatives
+            self.file.write(json.dumps(message) + '\n')
+        self.file.flush()
+        return [json.loads(self.file.readline()) for _ in pairs]
+
+    def annotate(self, word, reading, alternatives=None):
+        return self.annotateMany([(word, reading)], alternatives)[0]
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+def _address(text):
+    # host:port for TCP, anything else is the path of a Unix socket
+    if ':' in text:
+        host, port = text.rsplit(':', 1)
+        return (host, int(port))
+    return text
+
+
+if __name__ == "__main__":
+    # python service.py [address] [snapshot]
+    address = _address(sys.argv[1] if len(sys.argv) > 1 else 'furigana.sock')
+    path = sys.argv[2] if len(sys.argv) > 2 else 'result/model.snapshot'
+
+    server = createServer(snapshot.load(path), address)
+    print ' ** Serving %s on %s.' % (path, address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if isinstance(address, basestring) and os.path.exists(address):
+            os.remove(address)
@@ -0,0 +1,278 @@
+
+# -*- coding: utf-8 -*-
+
+import ctypes
+import mmap
+import struct
+from array import array
+
+from model import Node, Factor
+
+'''
+A snapshot is a binary copy of a trained model: the interned tables, node
+distributions, alphas, factors, omegas and best partitions, stored as flat
+arrays indexed by the numbers of the kanjis, furiganas, factors and lattice
+edges.
+
+Layout (little endian):
+  header   MAGIC, version, number of sections
+  table    one entry per section: name, type code, offset, length
+  sections raw arrays, each aligned to 8 bytes
+
+A loaded snapshot maps the file into memory and reads the arrays in place, so
+loading takes constant time whatever the size of the model. The mapping is
+private and never written, so worker processes loading the same snapshot
+share the same physical pages.
+'''
+
+MAGIC = 'FURIGANA'
+VERSION = 1
+
+_HEADER = struct.Struct('<8sII')
+_ENTRY = struct.Struct('<24sc7xQQ')
+_CTYPES = {'i': ctypes.c_int32, 'd': ctypes.c_double, 'b': ctypes.c_int8, 'c': ctypes.c_char}
+
+
+def _strings(strings):
+    # encode strings as one utf-8 blob plus the offset of each of them
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = array('i', [0])
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+    return ''.join(encoded), offsets
+
+
+def save(path, nodeMap, allFactors):
+    # kanjis are numbered in the order of the factors, and the domain of a
+    # node is its distribution, in the order of the furiganas
+    kanjiTable, kanjiIds = [], {}
+    for factor in allFactors:
+        for k in factor.allKanji:
+            if k not in kanjiIds:
+                kanjiIds[k] = len(kanjiTable)
+                kanjiTable.append(k)
+    factorIds = dict([(id(factor), f) for f, factor in enumerate(allFactors)])
+    nodes = [nodeMap[k] for k in kanjiTable]
+
+    furiganaTable, furiganaIds = [], {}
+    nodeOffsets, nodeFurigana, nodeProb = array('i', [0]), array('i'), array('d')
+    nodeFactorOffsets, nodeFactors, nodeAlphas = array('i', [0]), array('i'), array('d')
+    nodeSmoothing, nodeHasAlpha = array('d'), array('b')
+    for node in nodes:
+        for f in sorted(node.distribution.iterkeys()):
+            if f not in furiganaIds:
+                furiganaIds[f] = len(furiganaTable)
+                furiganaTable.append(f)
+            nodeFurigana.append(furiganaIds[f])
+            nodeProb.append(node.distribution[f])
+        nodeOffsets.append(len(nodeFurigana))
+        nodeSmoothing.append(node.probSmoothing)
+        nodeFactors.extend([factorIds[id(factor)] for factor in node.factors])
+        nodeFactorOffsets.append(len(nodeFactors))
+        nodeAlphas.extend(node.alphas or [0.0] * len(node.factors))
+        nodeHasAlpha.append(1 if node.alphas else 0)
+
+    # omegas are kept per lattice edge (1.0 for factors not adjusted yet)
+    edgeOffsets, edgeOmega, factorWeight = array('i', [0]), array('d'), array('d')
+    for factor in allFactors:
+        edgeOmega.extend(factor.omegas or [1.0] * factor.lattice.numEdges)
+        edgeOffsets.append(len(edgeOmega))
+        factorWeight.append(factor.weight)
+
+    sections = []
+    def _add(name, typecode, data):
+        sections.append((name, typecode, data))
+
+    kanjiText, kanjiTextOffsets = _strings(kanjiTable)
+    furiganaText, furiganaTextOffsets = _strings(furiganaTable)
+    wordText, wordTextOffsets = _strings([factor.word for factor in allFactors])
+    readingText, readingTextOffsets = _strings([factor.pronunciation for factor in allFactors])
+    _add('kanjiText', 'c', kanjiText)
+    _add('kanjiTextOffsets', 'i', kanjiTextOffsets)
+    _add('furiganaText', 'c', furiganaText)
+    _add('furiganaTextOffsets', 'i', furiganaTextOffsets)
+    _add('wordText', 'c', wordText)
+    _add('wordTextOffsets', 'i', wordTextOffsets)
+    _add('readingText', 'c', readingText)
+    _add('readingTextOffsets', 'i', readingTextOffsets)
+
+    # kanji code points in increasing order, to find a kanji by bisection
+    sortedKanji = sorted([(ord(k), n) for n, k in enumerate(kanjiTable)])
+    _add('kanjiSorted', 'i', array('i', [c for c, _ in sortedKanji]))
+    _add('kanjiSortedIds', 'i', array('i', [n for _, n in sortedKanji]))
+
+    _add('nodeOffsets', 'i', nodeOffsets)
+    _add('nodeFurigana', 'i', nodeFurigana)
+    _add('nodeFactorOffsets', 'i', nodeFactorOffsets)
+    _add('nodeFactors', 'i', nodeFactors)
+    _add('edgeOffsets', 'i', edgeOffsets)
+    _add('nodeProb', 'd', nodeProb)
+    _add('nodeSmoothing', 'd', nodeSmoothing)
+    _add('nodeAlphas', 'd', nodeAlphas)
+    _add('edgeOmega', 'd', edgeOmega)
+    _add('factorWeight', 'd', factorWeight)
+    _add('nodeHasAlpha', 'b', nodeHasAlpha)
+
+    # factors without omegas have not been adjusted yet and have no best
+    # partition, the best partition is kept as a list of edges
+    factorHasOmega = array('b')
+    bestEdgeOffsets = array('i', [0])
+    bestEdges = array('i')
+    for f, factor in enumerate(allFactors):
+        factorHasOmega.append(1 if factor.omegas else 0)
+        if factor.omegas:
+            bestEdges.extend([edgeOffsets[f] + e for e in factor.lattice.viterbi(factor.omegas)])
+        bestEdgeOffsets.append(len(bestEdges))
+    _add('factorHasOmega', 'b', factorHasOmega)
+    _add('bestEdgeOffsets', 'i', bestEdgeOffsets)
+    _add('bestEdges', 'i', bestEdges)
+
+    offset = _HEADER.size + _ENTRY.size * len(sections)
+    entries = []
+    chunks = []
+    for name, typecode, data in sections:
+        raw = data if typecode == 'c' else data.tostring()
+        padding = -offset % 8
+        chunks.append('\0' * padding + raw)
+        offset += padding
+        entries.append(_ENTRY.pack(name, typecode, offset, len(raw) / ctypes.sizeof(_CTYPES[typecode])))
+        offset += len(raw)
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(sections)))
+        for entry in entries:
+            f.write(entry)
+        for chunk in chunks:
+            f.write(chunk)
+
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        magic, version, numSections = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a model snapshot.' % path)
+        if version != VERSION:
+            raise ValueError('Snapshot version %d is not supported (expected %d).' % (version, VERSION))
+
+        for i in range(numSections):
+            name, typecode, offset, length = _ENTRY.unpack_from(self._mmap, _HEADER.size + i * _ENTRY.size)
+            section = (_CTYPES[typecode] * length).from_buffer(self._mmap, offset)
+            setattr(self, name.rstrip('\0'), section)
+
+        self.numNodes = len(self.nodeOffsets) - 1
+        self.numFactors = len(self.edgeOffsets) - 1
+
+        # furigana -> id, built on the first lookup (each process has its own)
+        self._furiganaIds = None
+
+    def _string(self, name, i):
+        offsets = getattr(self, name + 'Offsets')
+        return getattr(self, name)[offsets[i]:offsets[i + 1]].decode('utf-8')
+
+    def kanji(self, n):
+        return self._string('kanjiText', n)
+
+    def furigana(self, fid):
+        return self._string('furiganaText', fid)
+
+    def furiganaId(self, furigana):
+        # -1 if no node has the furigana
+        if self._furiganaIds is None:
+            self._furiganaIds = dict([(self.furigana(fid), fid) for fid in range(len(self.furiganaTextOffsets) - 1)])
+        return self._furiganaIds.get(furigana, -1)
+
+    def kanjiId(self, kanji):
+        # bisection over the sorted kanji code points, -1 if not found
+        code = ord(kanji) if len(kanji) == 1 else -1
+        low, high = 0, len(self.kanjiSorted)
+        while low < high:
+            middle = (low + high) // 2
+            if self.kanjiSorted[middle] < code:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.kanjiSorted) and self.kanjiSorted[low] == code:
+            return self.kanjiSortedIds[low]
+        return -1
+
+    def __contains__(self, kanji):
+        return self.kanjiId(kanji) != -1
+
+    def __getitem__(self, kanji):
+        n = self.kanjiId(kanji)
+        if n == -1:
+            raise KeyError(kanji)
+        return SnapshotNode(self, n)
+
+    def distribution(self, n):
+        distribution = {}
+        for slot in range(self.nodeOffsets[n], self.nodeOffsets[n + 1]):
+            if self.nodeProb[slot] > 0.0:
+                distribution[self.furigana(self.nodeFurigana[slot])] = self.nodeProb[slot]
+        return distribution
+
+    def prob(self, n, furigana):
+        # the furigana is looked up once, the domain of the node is then
+        # scanned for its id
+        fid = self.furiganaId(furigana)
+        if fid != -1:
+            nodeFurigana, nodeProb = self.nodeFurigana, self.nodeProb
+            for slot in xrange(self.nodeOffsets[n], self.nodeOffsets[n + 1]):
+                if nodeFurigana[slot] == fid and nodeProb[slot] > 0.0:
+                    return nodeProb[slot]
+        return self.nodeSmoothing[n]
+
+    def restore(self, nodeMap=None):
+        # rebuild the node and factor objects (into nodeMap if given), e.g. to
+        # continue training
+        if nodeMap is None:
+            nodeMap = {}
+        allFactors = []
+        for n in range(self.numNodes):
+            node = Node(self.kanji(n), [], nodeMap)
+            node.distribution = self.distribution(n)
+            node.probSmoothing = self.nodeSmoothing[n]
+            nodeMap[node.kanji] = node
+
+        for f in range(self.numFactors):
+            factor = Factor(self._string('wordText', f), self._string('readingText', f))
+            factor.weight = int(self.factorWeight[f])
+            e0, e1 = self.edgeOffsets[f], self.edgeOffsets[f + 1]
+            if self.factorHasOmega[f]:
+                factor.omegas = array('d', self.edgeOmega[e0:e1])
+                factor.bestPath = tuple([e - e0 for e in self.bestEdges[self.bestEdgeOffsets[f]:self.bestEdgeOffsets[f + 1]]])
+            allFactors.append(factor)
+
+        for n in range(self.numNodes):
+            node = nodeMap[self.kanji(n)]
+            for j in range(self.nodeFactorOffsets[n], self.nodeFactorOffsets[n + 1]):
+                node.addFactor(allFactors[self.nodeFactors[j]])
+            node.recountFuriganas()
+            if self.nodeHasAlpha[n]:
+                node.alphas = array('d', self.nodeAlphas[self.nodeFactorOffsets[n]:self.nodeFactorOffsets[n + 1]])
+
+        return nodeMap, allFactors
+
+
+'''
+A read-only view of a node of a snapshot, with the interface used for testing.
+'''
+class SnapshotNode:
+    def __init__(self, snapshot, n):
+        self.snapshot = snapshot
+        self.id = n
+        self.kanji = snapshot.kanji(n)
+
+    @property
+    def distribution(self):
+        return self.snapshot.distribution(self.id)
+
+    def prob(self, furigana):
+        return self.snapshot.prob(self.id, furigana)
+
+
+def load(path):
+    return Snapshot(path)
@@ -1,25 +1,34 @@
 # -*- coding: utf-8 -*-
 
 import codecs
+import heapq
+import os
 
+import metrics
+import partitioncache
 import util
 import model
 
 class TestCase:
     def __init__(self, line):
         self.word, self.pronunciation = line.split()
-        self.mapping = {}
         partition = self.pronunciation.split(',')
         self.pronunciation = ''.join(partition)
-        for index, kanji in enumerate(self.word):
-            self.mapping[kanji] = partition[index]
+
+        # the correct furigana of each kanji of the word, in order
+        self.answer = []
+        for index, c in enumerate(util.normalizeWord(self.word)):
+            if not util.isKana(c):
+                self.answer.append(u''.join(map(util.toHiragana, partition[index])))
+        self.partitions = None
         self.model = None
 
     def test(self, model):
         self.model = model
 
         self.beliefs = []
-        self.partitions = util.generatePossiblePartitions(self.word, self.pronunciation)
+        if self.partitions is None:
+            self.partitions = partitioncache.partitions(self.word, self.pronunciation)
         for p in self.partitions:
             prop = 1.0
             for k, f in p:
@@ -37,15 +46,13 @@ class TestCase:
         else:
             self.confidence = beliefMatrix[0][0] - beliefMatrix[1][0]
 
-        self.correctAnswer = True
-        for k, f in self.bestPartition:
-            if self.mapping[k] != f:
-                self.correctAnswer = False
-                break
+        self.correctAnswer = [f for _, f in self.bestPartition] == self.answer
 
 
     def baseline_test(self):
-        self.partitions = util.generatePossiblePartitions(self.word, self.pronunciation)
+        self.model = None
+        if self.partitions is None:
+            self.partitions = partitioncache.partitions(self.word, self.pronunciation)
         self.beliefs = util.omegaHeuristics(self.partitions)
         util.normalize_vector(self.beliefs)
 
@@ -56,11 +63,16 @@ class TestCase:
         else:
             self.confidence = beliefMatrix[0][0] - beliefMatrix[1][0]
 
-        self.correctAnswer = True
-        for k, f in self.bestPartition:
-            if self.mapping[k] != f:
-                self.correctAnswer = False
-                break
+        self.correctAnswer = [f for _, f in self.bestPartition] == self.answer
+
+
+    def setResult(self, model, beliefs, best, confidence):
+        # the result of the test as scored by a compiled test set
+        self.model = model
+        self.beliefs = beliefs
+        self.bestPartition = self.partitions[best]
+        self.confidence = confidence
+        self.correctAnswer = [f for _, f in self.bestPartition] == self.answer
 
 
     def __str__(self):
@@ -84,42 +96,133 @@ class TestCase:
         return outputStr
 
 
-def _buildTestStatistics(allTestCases):
-    nTestCases = 0
-    nCorrectTestCases = 0
-    totalConfidence = 0
-
-    for testcase in allTestCases:
-        nTestCases += 1
-        if testcase.correctAnswer:
-            nCorrectTestCases += 1
-            totalConfidence += testcase.confidence
-        else:
-            totalConfidence -= testcase.confidence * 3.0
-
-    return (nTestCases, nCorrectTestCases, totalConfidence)
-
-
-def _performTesting(model, writeResults=False):
-    with codecs.open('test.txt', 'r', encoding='utf-8') as f:
-        def _converter(line):
-            return TestCase(line)
-        allTestCases = map(_converter, f.readlines())
-
-    for testcase in allTestCases:
-        testcase.test(model)
-
-    nTestCases, nCorrectTestCases, totalConfidence = _buildTestStatistics(allTestCases)
+'''
+A compiled test set is built once from the test file: the partitions of every
+test case are enumerated, the (kanji, furigana) pairs they use are interned,
+and the index of the correct partition is found in advance. Scoring a model
+then only looks up the probability of every distinct pair once, and computes
+the beliefs of all partitions from these probabilities.
+'''
+class CompiledTestSet:
+    def __init__(self, path):
+        with codecs.open(path, 'r', encoding='utf-8') as f:
+            self.testCases = [TestCase(line) for line in f.readlines()]
+
+        self.pairs = []  # interned (kanji, furigana) pairs
+        pairIds = {}
+
+        # partition p of test case c uses the pairs
+        # partitionPairs[partitionPairOffsets[p]:partitionPairOffsets[p + 1]],
+        # the partitions of c are caseOffsets[c] to caseOffsets[c + 1]
+        self.caseOffsets = [0]
+        self.partitionPairOffsets = [0]
+        self.partitionPairs = []
+        self.heuristics = []
+        self.goldIndices = []
+        for testcase in self.testCases:
+            partitions = partitioncache.partitions(testcase.word, testcase.pronunciation)
+            testcase.partitions = partitions
+            for p in partitions:
+                for pair in p:
+                    if pair not in pairIds:
+                        pairIds[pair] = len(self.pairs)
+                        self.pairs.append(pair)
+                    self.partitionPairs.append(pairIds[pair])
+                self.partitionPairOffsets.append(len(self.partitionPairs))
+            self.caseOffsets.append(self.caseOffsets[-1] + len(partitions))
+            self.heuristics.append(util.omegaHeuristics(partitions))
+
+            gold = [i for i, p in enumerate(partitions) if [f for _, f in p] == testcase.answer]
+            self.goldIndices.append(gold[0] if gold else -1)
+
+        # the pairs of every kanji, and the test cases depending on every kanji
+        self.kanjiPairs = {}
+        for pair, (k, _) in enumerate(self.pairs):
+            self.kanjiPairs.setdefault(k, []).append(pair)
+        self.kanjiCases = {}
+        for c in range(len(self.testCases)):
+            first = self.partitionPairOffsets[self.caseOffsets[c]]
+            last = self.partitionPairOffsets[self.caseOffsets[c + 1]]
+            for k in set([self.pairs[pair][0] for pair in self.partitionPairs[first:last]]):
+                self.kanjiCases.setdefault(k, []).append(c)
+
+    def pairProbs(self, model, pairs=None):
+        # probability of the pairs (all of them if not given) according to model
+        if pairs is None:
+            pairs = range(len(self.pairs))
+        return [model[k].prob(f) if k in model else 1.0
+                for k, f in [self.pairs[pair] for pair in pairs]]
+
+    def beliefs(self, c, pairProbs):
+        beliefs = []
+        for p in range(self.caseOffsets[c], self.caseOffsets[c + 1]):
+            prop = 1.0
+            for pair in self.partitionPairs[self.partitionPairOffsets[p]:self.partitionPairOffsets[p + 1]]:
+                prop *= pairProbs[pair]
+            beliefs.append(prop)
+        return util.normalize_vector(beliefs)
+
+    def rank(self, c, beliefs):
+        # (index of the best partition, confidence) of test case c, same as
+        # TestCase.test
+        heuristics = self.heuristics[c]
+        top = heapq.nlargest(2, [(belief, heuristics[i], i) for i, belief in enumerate(beliefs)])
+        return top[0][2], 10.0 if len(top) == 1 else top[0][0] - top[1][0]
+
+    def scoreCase(self, c, beliefs):
+        # (correct, contribution to the total confidence) of test case c: a
+        # wrong answer costs three times its confidence
+        best, confidence = self.rank(c, beliefs)
+        if best == self.goldIndices[c]:
+            return True, confidence
+        return False, -confidence * 3.0
+
+    def _score(self, beliefsOfCase, model=None, record=False):
+        # record: also keep the result of every test case in its TestCase, to
+        # write it without testing again
+        nCorrectTestCases = 0
+        totalConfidence = 0
+        for c in range(len(self.testCases)):
+            beliefs = beliefsOfCase(c)
+            if record:
+                self.testCases[c].setResult(model, beliefs, *self.rank(c, beliefs))
+            correct, confidence = self.scoreCase(c, beliefs)
+            if correct:
+                nCorrectTestCases += 1
+            totalConfidence += confidence
+        return (len(self.testCases), nCorrectTestCases, totalConfidence)
+
+    def score(self, model, record=False):
+        pairProbs = self.pairProbs(model)
+        return self._score(lambda c: self.beliefs(c, pairProbs), model, record)
+
+    def scoreBaseline(self, record=False):
+        return self._score(lambda c: util.normalize_vector(list(self.heuristics[c])), None, record)
+
+
+_testSets = {}
+def loadTestSet(path='test.txt'):
+    # the compiled test set is reused until the test file is modified
+    mtime = os.path.getmtime(path)
+    if path not in _testSets or _testSets[path][0] != mtime:
+        _testSets[path] = (mtime, CompiledTestSet(path))
+    return _testSets[path][1]
+
+
+def _performTesting(model, writeResults=False, path='test.txt'):
+    testSet = loadTestSet(path)
+    result = testSet.score(model, record=writeResults)
 
     if writeResults:
         with codecs.open('test_result.txt', 'w', encoding='utf-8') as f:
-            for testcase in allTestCases:
+            for testcase in testSet.testCases:
                 f.write(unicode(testcase) + u'\n')
 
-    return (nTestCases, nCorrectTestCases, totalConfidence)
+    return result
 
 
 lastConfidence = None
+@metrics.timed('test')
 def testModel(model, output=True):
     nTestCases, nCorrectTestCases, totalConfidence = _performTesting(model, writeResults=True)
     print 'Correct: %d/%d (%.1f%%)' % (nCorrectTestCases, nTestCases, float(nCorrectTestCases) / nTestCases * 100.0)
@@ -132,18 +235,67 @@ def testModel(model, output=True):
     lastConfidence = totalConfidence
 
 
-logFileInitialized = False
-def continuousTesting(model, trialID, tupleID):
-    nTestCases, nCorrectTestCases, totalConfidence = _performTesting(model, writeResults=False)
-
-    global logFileInitialized
-    if not logFileInitialized:
-        with open("test_log.txt", "w") as f:
-            f.write('==== Continuous Performance Testing Log ====\n')
-        logFileInitialized = True
-    
-    with open("test_log.txt", "a") as f:
-        f.write('%d %d %.1f%% %.3f\n' % (trialID, tupleID, float(nCorrectTestCases) / nTestCases * 100.0, totalConfidence))
+'''
+An incremental scorer keeps the probability of every pair and the result of
+every test case between two calls. Given the kanjis whose distribution has
+changed since the last call, only the test cases depending on them are
+rescored, and the totals are updated with the difference.
+'''
+class IncrementalScorer:
+    def __init__(self, testSet):
+        self.testSet = testSet
+        self.pairProbs = None
+        self.results = None  # (correct, confidence) of every test case
+        self.nCorrectTestCases = 0
+        self.totalConfidence = 0
+
+    def score(self, model, changedKanjis=None):
+        # rescore everything when no kanjis are given
+        testSet = self.testSet
+        if self.results is None or changedKanjis is None:
+            self.pairProbs = testSet.pairProbs(model)
+            self.results = [testSet.scoreCase(c, testSet.beliefs(c, self.pairProbs))
+                            for c in range(len(testSet.testCases))]
+            self.nCorrectTestCases = len(filter(None, [correct for correct, _ in self.results]))
+            self.totalConfidence = sum([confidence for _, confidence in self.results])
+            return (len(testSet.testCases), self.nCorrectTestCases, self.totalConfidence)
+
+        cases = set()
+        for k in changedKanjis:
+            pairs = testSet.kanjiPairs.get(k, ())
+            for pair, prob in zip(pairs, testSet.pairProbs(model, pairs)):
+                self.pairProbs[pair] = prob
+            cases.update(testSet.kanjiCases.get(k, ()))
+
+        for c in cases:
+            oldCorrect, oldConfidence = self.results[c]
+            correct, confidence = self.results[c] = testSet.scoreCase(c, testSet.beliefs(c, self.pairProbs))
+            self.nCorrectTestCases += int(correct) - int(oldCorrect)
+            self.totalConfidence += confidence - oldConfidence
+        return (len(testSet.testCases), self.nCorrectTestCases, self.totalConfidence)
+
+
+scorer = None
+logFile = None
+def continuousTesting(model, trialID, tupleID, changedKanjis=None):
+    # changedKanjis: the kanjis whose distribution has changed since the last
+    # call, None to rescore all test cases
+    global scorer, logFile
+    testSet = loadTestSet()
+    if scorer is None or scorer.testSet is not testSet:
+        scorer = IncrementalScorer(testSet)
+    nTestCases, nCorrectTestCases, totalConfidence = scorer.score(model, changedKanjis)
+
+    if logFile is None:
+        logFile = open("test_log.txt", "w")
+        logFile.write('==== Continuous Performance Testing Log ====\n')
+
+    logFile.write('%d %d %.1f%% %.3f\n' % (trialID, tupleID, float(nCorrectTestCases) / nTestCases * 100.0, totalConfidence))
+
+
+def flushTestLog():
+    if logFile is not None:
+        logFile.flush()
 
 
 def testWordPartition():
@@ -156,32 +308,21 @@ def testWordPartition():
         alltuples = map(_converter, f.readlines())
 
     for kanji, furigana in alltuples:
-        partitions = util.generatePossiblePartitions(kanji, furigana)
+        partitions = partitioncache.partitions(kanji, furigana)
         print u'--- (%s %s) ---' % (kanji, furigana)
         for p in partitions:
             print ' '.join(map(lambda t: '%s:%s' % (t[0], t[1]), p))
         print
 
 def testBaselineAlgorithm():
-    with codecs.open('test.txt', 'r', encoding='utf-8') as f:
-        def _converter(line):
-            return TestCase(line)
-        allTestCases = map(_converter, f.readlines())
-
-    nTestCases = 0
-    nCorrectTestCases = 0
-    totalConfidence = 0
-
-    for testcase in allTestCases:
-        testcase.baseline_test()
-
-    nTestCases, nCorrectTestCases, totalConfidence = _buildTestStatistics(allTestCases)
+    testSet = loadTestSet()
+    nTestCases, nCorrectTestCases, totalConfidence = testSet.scoreBaseline(record=True)
 
     print 'Correct: %d/%d (%.1f%%)' % (nCorrectTestCases, nTestCases, float(nCorrectTestCases) / nTestCases * 100.0)
     print 'Confidence: %.3f' % totalConfidence
 
     with codecs.open('baseline_test_result.txt', 'w', encoding='utf-8') as f:
-        for testcase in allTestCases:
+        for testcase in testSet.testCases:
             f.write(unicode(testcase) + u'\n')
 
 
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import lattice
+import util
+from annotate import Annotator
+
+class _Node:
+    def __init__(self, distribution):
+        self.distribution = distribution
+
+    def prob(self, furigana):
+        return self.distribution.get(furigana, 0.01)
+
+
+class AnnotatorTest(unittest.TestCase):
+    model = {u'大': _Node({u'おお': 0.7, u'だい': 0.3}), u'企': _Node({u'き': 0.9})}
+
+    def testSameAsListedPartitions(self):
+        # the best partitions of the lattice are those of the sorted list of
+        # all the partitions, unknown kanjis (手, 業) left out of the beliefs
+        word, reading = u'大手企業', u'おおてきぎょう'
+        partitions = util.generatePossiblePartitions(word, reading)
+        heuristics = util.omegaHeuristics(partitions)
+        beliefs = []
+        for p in partitions:
+            belief = 1.0
+            for k, f in p:
+                if k in self.model:
+                    belief *= self.model[k].prob(f)
+            beliefs.append(belief)
+        order = sorted([(belief, heuristics[i], i) for i, belief in enumerate(beliefs)], reverse=True)
+
+        annotation = Annotator(self.model, maxAlternatives=4).annotate(word, reading)
+        self.assertEqual(annotation.partitions, [partitions[i] for _, _, i in order[:5]])
+        self.assertEqual(annotation.unknownKanjis, [u'手', u'業'])
+        self.assertFalse(annotation.fallback)
+
+    def testLongCompound(self):
+        # more than a million partitions, only the best ones are searched
+        word, reading = u'独立行政法人情報通信研究機構', u'どくりつぎょうせいほうじんじょうほうつうしんけんきゅうきこう'
+        annotation = Annotator(self.model, maxAlternatives=2).annotate(word, reading)
+        self.assertEqual(len(annotation.partitions), 3)
+        self.assertTrue(annotation.fallback)
+        self.assertEqual(annotation.beliefs[0], 10.0)
+
+    def testSharedTablesUnchanged(self):
+        # queries do not grow the shared tables of the lattices
+        annotator = Annotator(self.model)
+        annotator.annotate(u'大企業', u'だいきぎょう')
+        sizes = (len(lattice._buffer), len(lattice._structures), len(lattice._kanjis), len(lattice._furiganas))
+        for i in range(20):
+            reading = u'だいきぎょう' + u'あいうえお'[i % 5] * (i // 5 + 1)
+            self.assertEqual(annotator.annotate(u'大企業家', reading).bestPartition[0][0], u'大')
+        annotator.annotate(u'大企業', u'だいきぎょう')
+        self.assertEqual((len(lattice._buffer), len(lattice._structures), len(lattice._kanjis), len(lattice._furiganas)),
+                         sizes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,27 @@
+
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from index import ReadingIndex
+from model import Factor
+
+class ReadingIndexTest(unittest.TestCase):
+    def testRepeatedPair(self):
+        # the best partition of 点々 uses 点:てん twice
+        factor = Factor(u'点々', u'てんてん')
+        factor.bestPath = tuple(next(factor.lattice.paths()))
+        self.assertEqual(factor.bestPartition, [(u'点', u'てん'), (u'点', u'てん')])
+
+        index = ReadingIndex()
+        self.assertTrue(index.updateFactor(factor))
+        self.assertEqual(index.readingsForKanji(u'点'), {u'てん': [(u'点々', u'てんてん')]})
+
+        factor.bestPath = None
+        self.assertTrue(index.updateFactor(factor))
+        self.assertEqual(index.readingsForKanji(u'点'), {})
+        self.assertFalse(index.updateFactor(factor))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import codecs
+import os
+import shutil
+import tempfile
+import unittest
+
+import ingest
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.corpusPath = os.path.join(self.directory, 'vocab.txt')
+        self.cachePath = os.path.join(self.directory, '_tuples.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write(self, line, mtime):
+        with codecs.open(self.corpusPath, 'w', encoding='utf-8') as f:
+            f.write(line + u'\n')
+        os.utime(self.corpusPath, (mtime, mtime))
+
+    def _tuples(self):
+        return list(ingest.iterTuples(self.directory, cachePath=self.cachePath))
+
+    def testEditWithinOneSecond(self):
+        # same size, same second: the cache is still rebuilt
+        self._write(u'大学 だいがく', 1000000000.25)
+        self.assertEqual(self._tuples(), [(u'大学', u'だいがく')])
+        self._write(u'大手 おおてて', 1000000000.75)
+        self.assertEqual(self._tuples(), [(u'大手', u'おおてて')])
+
+    def testUnchanged(self):
+        self._write(u'大学 だいがく', 1000000000.25)
+        self._tuples()
+        key = ingest._cachedKey(self.cachePath)
+        self.assertEqual(self._tuples(), [(u'大学', u'だいがく')])
+        self.assertEqual(ingest._cachedKey(self.cachePath), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import lattice
+from lattice import Lattice
+
+class LatticeTest(unittest.TestCase):
+    def testLongCompound(self):
+        # 25 kanjis and 80 kana: more edges than a short integer can count
+        word = u'独立行政法人情報通信研究機構国際電気通信基礎技術研'
+        reading = (u'あいうえおかきくけこさしすせそたちつてとなにぬねの' * 4)[:80]
+        lattice = Lattice(word, reading)
+        self.assertTrue(lattice.numEdges > 32767)
+        partition = lattice.partition(lattice.viterbi([1.0] * lattice.numEdges))
+        self.assertEqual(u''.join([k for k, _ in partition]), word)
+        self.assertEqual(u''.join([f for _, f in partition]), reading)
+
+    def testDecodedEviction(self):
+        # the decoded structures are bounded, evicted ones are decoded again
+        maxDecoded = lattice.MAX_DECODED
+        lattice.MAX_DECODED = len(lattice._decodedOffsets) + 5
+        try:
+            lattices = [Lattice(u'大学', u'だいがく' + u'あいうえおかきくけこ'[:i]) for i in range(10)]
+            for _ in range(3):
+                for l in lattices:
+                    self.assertEqual(l.partitions()[0], [(u'大', u'だ'), (u'学', l.pronunciation[1:])])
+            self.assertEqual(len(lattice._decoded), lattice.MAX_DECODED)
+            self.assertEqual(sorted(lattice._decoded), sorted(lattice._decodedOffsets))
+        finally:
+            lattice.MAX_DECODED = maxDecoded
+
+
+if __name__ == '__main__':
+    unittest.main()
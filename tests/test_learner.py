@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import learner
+
+class LearnManyTest(unittest.TestCase):
+    def setUp(self):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            learner.reset()
+            tuples = [(u'大手', u'おおて'), (u'大学', u'だいがく'), (u'手紙', u'てがみ'), (u'学生', u'がくせい')]
+            for trial in range(2):
+                learner.learn(trial, tuples)
+                learner.adjustParameters()
+        finally:
+            sys.stdout = stdout
+
+    def tearDown(self):
+        learner.reset()
+
+    def testPairWithoutPartition(self):
+        # 漢字 cannot be read か: nothing of the batch is added
+        numFactors = len(learner.allFactors)
+        self.assertRaises(ValueError, learner.learnMany, [(u'大阪', u'おおさか'), (u'漢字', u'か')])
+        self.assertEqual(len(learner.allFactors), numFactors)
+        self.assertFalse((u'大阪', u'おおさか') in learner.factorMap)
+        self.assertFalse(u'阪' in learner.nodeMap)
+        node = learner.nodeMap[u'大']
+        self.assertEqual(len(node.factors), len(node.alphas))
+
+        factor = learner.learnOne(u'大人', u'おとな')
+        self.assertTrue(factor.bestPath is not None)
+        self.assertEqual(len(node.factors), len(node.alphas))
+
+    def testNewKanjis(self):
+        # none of the kanjis of 鬱鬱 is known: it still gets a best partition,
+        # readings and alphas right away
+        factor = learner.learnOne(u'鬱鬱', u'うつうつ')
+        self.assertEqual(factor.bestPartition, [(u'鬱', u'うつ'), (u'鬱', u'うつ')])
+        self.assertEqual(learner.readingIndex.readingsForKanji(u'鬱'), {u'うつ': [(u'鬱鬱', u'うつうつ')]})
+        node = learner.nodeMap[u'鬱']
+        self.assertEqual(len(node.factors), len(node.alphas))
+
+        factor = learner.learnOne(u'憂鬱', u'ゆううつ')
+        self.assertEqual(factor.bestPartition, [(u'憂', u'ゆう'), (u'鬱', u'うつ')])
+        self.assertEqual(learner.readingIndex.wordsForReading(u'憂', u'ゆう'), [(u'憂鬱', u'ゆううつ')])
+        self.assertEqual(len(node.factors), len(node.alphas))
+
+
+if __name__ == '__main__':
+    unittest.main()
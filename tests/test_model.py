@@ -0,0 +1,49 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import subprocess
+import sys
+import unittest
+
+# trains the model on the first tuples of tuples.txt (with the compiled
+# graph if asked) and prints its distributions and best paths; the padding
+# moves the factors to other addresses
+_TRAIN = '''
+import os, sys
+padding = [object() for _ in range(int(sys.argv[1]))]
+sys.stdout, stdout = open(os.devnull, 'w'), sys.stdout
+import ingest, learner
+tuples = list(ingest.readTuples('tuples.txt'))[:1500]
+for trial in range(2):
+    learner.learn(trial, tuples, compiled=sys.argv[2] == 'compiled')
+    learner.adjustParameters()
+sys.stdout = stdout
+print repr((sorted([(k, sorted(node.distribution.items())) for k, node in learner.nodeMap.items()]),
+            sorted([(factor.word, factor.pronunciation, factor.bestPath) for factor in learner.allFactors])))
+'''
+
+class ObjectModelTest(unittest.TestCase):
+    def _train(self, padding, engine='object'):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.check_output([sys.executable, '-c', _TRAIN, str(padding), engine], cwd=root)
+
+    def testReproducible(self):
+        # the messages of a node are summed in the same order in every process
+        self.assertEqual(self._train(0), self._train(54321))
+
+    def testCompiledGraph(self):
+        # the compiled graph updates the nodes in the same order, only the
+        # rounding of the sums differs
+        distributions, bestPaths = eval(self._train(0))
+        compiledDistributions, compiledBestPaths = eval(self._train(0, 'compiled'))
+        self.assertEqual(bestPaths, compiledBestPaths)
+        self.assertEqual([k for k, _ in distributions], [k for k, _ in compiledDistributions])
+        for (k, distribution), (_, compiled) in zip(distributions, compiledDistributions):
+            self.assertEqual([f for f, _ in distribution], [f for f, _ in compiled], k)
+            for (f, p), (_, q) in zip(distribution, compiled):
+                self.assertAlmostEqual(p, q, places=9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import util
+import partitioncache
+from partitioncache import PartitionCache
+
+class PartitionCacheTest(unittest.TestCase):
+    PAIRS = [(u'漢字', u'かんじ'), (u'取り扱い', u'とりあつかい'), (u'点々', u'てんてん'),
+             (u'かな', u'かな'), (u'漢字', u'か')]
+
+    def testSameAsGenerated(self):
+        cache = PartitionCache()
+        for word, reading in self.PAIRS * 2:
+            self.assertEqual(cache.partitions(word, reading), util.generatePossiblePartitions(word, reading))
+        self.assertEqual((cache.hits, cache.misses), (len(self.PAIRS), len(self.PAIRS)))
+
+    def testLongCompound(self):
+        # more partitions than a short integer can count
+        word, reading = u'独立行政法人情報通信研', u'どくりつぎょうせいほうじんじょうほうつうしんけん'
+        cache = PartitionCache()
+        generated = util.generatePossiblePartitions(word, reading)
+        self.assertEqual(len(generated), 43758)
+        self.assertEqual(cache.partitions(word, reading), generated)
+        self.assertEqual(cache.partitions(word, reading), generated)
+        self.assertEqual(cache.hits, 1)
+
+    def testEviction(self):
+        cache = PartitionCache(maxSize=2)
+        for word in [u'一', u'二', u'三', u'一']:
+            cache.partitions(word, u'いち')
+        self.assertEqual(cache.stats(), {'hits': 0, 'diskHits': 0, 'misses': 4, 'evictions': 2, 'size': 2})
+
+    def testStore(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'partitions')
+            cache = PartitionCache(path=path)
+            for word, reading in self.PAIRS:
+                cache.partitions(word, reading)
+            cache.close()
+
+            cache = PartitionCache(path=path)
+            for word, reading in self.PAIRS:
+                self.assertEqual(cache.partitions(word, reading), util.generatePossiblePartitions(word, reading))
+            self.assertEqual((cache.diskHits, cache.misses), (len(self.PAIRS), 0))
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def testModuleCache(self):
+        # no furigana starts with ん
+        self.assertEqual(partitioncache.partitions(u'漢字', u'かんじ'), [[(u'漢', u'かん'), (u'字', u'じ')]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+import ingest
+import learner
+
+class ResidualSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        learner.reset()
+
+    def tearDown(self):
+        learner.reset()
+
+    def _learn(self, tuples):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            return learner.learn(0, tuples)
+        finally:
+            sys.stdout = stdout
+
+    def testFactorsSettle(self):
+        # with damping, inference stops on the tolerance for almost every
+        # factor instead of spending its whole budget
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        tuples = list(ingest.readTuples(os.path.join(root, 'tuples.txt')))[:1500]
+        scheduler = self._learn(tuples)
+        self.assertEqual(len(scheduler.updateCounts), len(tuples))
+        self.assertTrue(scheduler.exhausted <= len(tuples) / 100)
+        self.assertTrue(sum(scheduler.updateCounts) < 10 * len(tuples))
+
+    def testPairSettles(self):
+        # 挨 and 拶 only have each other: damping settles them in a few updates
+        scheduler = self._learn([(u'挨拶', u'あいさつ'), (u'挨拶', u'あいさつ')])
+        self.assertEqual(scheduler.exhausted, 0)
+        self.assertTrue(max(scheduler.updateCounts) < 2 * scheduler.updatesPerKanji)
+
+
+if __name__ == '__main__':
+    unittest.main()
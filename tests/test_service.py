@@ -0,0 +1,60 @@
+
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import service
+from annotate import Annotator
+
+class ServiceTest(unittest.TestCase):
+    # an empty model: every annotation falls back on the omega heuristics
+
+    def testBadRequestInBatch(self):
+        batcher = service.Batcher(Annotator({}), maxDelay=0.5)
+        requests = [batcher.submit(u'大手', u'おおて'), batcher.submit(5, u'おおて'), batcher.submit(u'企業', u'きぎょう')]
+        for request in requests:
+            self.assertTrue(request.done.wait(5))
+        self.assertEqual(batcher.batches, 1)
+        annotator = Annotator({})
+        for request in [requests[0], requests[2]]:
+            self.assertEqual(request.error, None)
+            self.assertEqual(request.annotation.bestPartition,
+                             annotator.annotate(request.word, request.reading).bestPartition)
+        self.assertTrue(requests[1].error)
+        self.assertEqual(requests[1].annotation, None)
+
+    def testInvalidRequests(self):
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, 'furigana.sock')
+        server = service.createServer({}, address, maxDelay=0.05)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = service.Client(address)
+            for line in ['{"id": 1, "word": "\\u5927\\u624b", "reading": "\\u304a\\u304a\\u3066"}',
+                         '{"id": 2, "word": 5, "reading": "\\u304a\\u304a\\u3066"}',
+                         '{"id": 3, "word": "\\u5927\\u624b", "reading": "\\u304a\\u304a\\u3066", "alternatives": -1}',
+                         '{"id": 4, "word": "\\u5927\\u624b", "reading": "\\u304a\\u304a\\u3066", "alternatives": "2"}',
+                         '{"id": 5, "word": "\\u5927\\u624b", "reading": "\\u304a\\u304a\\u3066", "alternatives": 0}']:
+                client.file.write(line + '\n')
+            client.file.flush()
+            responses = [service.json.loads(client.file.readline()) for _ in range(5)]
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+
+        self.assertEqual(responses[0]['partition'], [[u'大', u'おお'], [u'手', u'て']])
+        for response in responses[1:4]:
+            self.assertTrue(response['error'].startswith('Invalid request'))
+        self.assertEqual(responses[4]['alternatives'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
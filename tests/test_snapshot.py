@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import learner
+import snapshot
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            learner.reset()
+            tuples = [(u'大手', u'おおて'), (u'大学', u'だいがく'), (u'手紙', u'てがみ'), (u'学生', u'がくせい')]
+            for trial in range(2):
+                learner.learn(trial, tuples)
+                learner.adjustParameters()
+        finally:
+            sys.stdout = stdout
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'model.snapshot')
+        learner.saveModel(self.path)
+
+    def tearDown(self):
+        learner.reset()
+        shutil.rmtree(self.directory)
+
+    def testProb(self):
+        model = snapshot.load(self.path)
+        for k, node in learner.nodeMap.iteritems():
+            for f in list(node.distribution) + [u'だい', u'ん']:
+                self.assertEqual(model[k].prob(f), node.prob(f))
+            self.assertEqual(model[k].distribution, node.distribution)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import ingest
+import util
+from lattice import Lattice
+
+class LongVowelMarkTest(unittest.TestCase):
+    def testAnchor(self):
+        # ー is read as itself, like the kana around it
+        self.assertEqual(util.segmentWord(u'ビール瓶'), [(True, u'びーる'), (False, u'瓶')])
+        self.assertEqual(util.generatePossiblePartitions(u'ビール瓶', u'びーるびん'), [[(u'瓶', u'びん')]])
+        self.assertEqual(Lattice(u'ビール瓶', u'びーるびん').partitions(), [[(u'瓶', u'びん')]])
+        self.assertEqual(util.generatePossiblePartitions(u'ビール瓶', u'びいるびん'), [])
+
+    def testValidTuple(self):
+        self.assertTrue(ingest.isValidTuple(u'ビール瓶', u'びーるびん'))
+        self.assertTrue(ingest.isValidTuple(u'ビール瓶', u'ビールびん'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,49 @@
 # -*- coding: utf-8 -*-
 
-import re
+import itertools
+
+# character tables are built once, so that classifying a character is a
+# single set or dict lookup
+HIRAGANA_SET = frozenset([unichr(c) for c in range(0x3041, 0x3095)])
+KATAKANA_TO_HIRAGANA = dict([(unichr(c), unichr(c - 0x60)) for c in range(0x30A1, 0x30F5)])
+ITERATION_MARK = u'々'
+LONG_VOWEL_MARK = u'ー'
+
+# kana that stand for themselves in the furigana: hiragana (katakana being
+# read as hiragana) and the long vowel mark (ビール is read びーる)
+KANA_SET = HIRAGANA_SET | frozenset([LONG_VOWEL_MARK])
 
 def isHiragana(char):
-    return re.search(ur'[\u3041-\u3094]', char) != None
+    return char in HIRAGANA_SET
+
+def isKana(char):
+    return char in KANA_SET
+
+def toHiragana(char):
+    return KATAKANA_TO_HIRAGANA.get(char, char)
+
+def normalizeWord(word):
+    # katakana is read as the corresponding hiragana, and the iteration mark
+    # stands for the kanji right before it (人々 = 人人)
+    chars = []
+    for c in word:
+        c = toHiragana(c)
+        if c == ITERATION_MARK and chars and not isKana(chars[-1]):
+            c = chars[-1]
+        chars.append(c)
+    return u''.join(chars)
+
+def segmentWord(word):
+    # split a word into runs of kana (anchors, which have to appear as such
+    # in the furigana) and runs of kanji, as a list of (isKana, text)
+    segments = []
+    for c in normalizeWord(word):
+        kana = isKana(c)
+        if segments and segments[-1][0] == kana:
+            segments[-1] = (kana, segments[-1][1] + c)
+        else:
+            segments.append((kana, c))
+    return segments
 
 AUX_HIRAGANA_SET = set([u'ゃ', u'ゅ', u'ょ', u'っ', u'ん'])
 def isAuxHiragana(char):
@@ -34,29 +74,59 @@ def furiganaHeuristics(furigana):
         return 3.0 / length ** 2
 
 def generatePossiblePartitions(kanji, furigana):
-
-    partitions = []
-
-    def _search(partial, kanji, furigana):
-        if isHiragana(kanji[0]):
-            if kanji[0] == furigana[0]:
-                _search(partial, kanji[1:], furigana[1:])
-            return  
-
-        if len(kanji) == 1:
-            if isLegalFurigana(furigana):
-                partial.append((kanji, furigana))
-                partitions.append(partial)
+    # the kana anchors of the word split the search into independent runs of
+    # kanji: for every way of placing the anchors in the furigana, the
+    # partitions are the cross product of the splits of each run
+    segments = segmentWord(kanji)
+    furigana = u''.join(map(toHiragana, furigana))
+    runSplits = {}
+
+    def _splitRun(run, text):
+        if (run, text) not in runSplits:
+            splits = []
+            if len(run) == 1:
+                if text and isLegalFurigana(text):
+                    splits.append([(run, text)])
+            else:
+                for untilIndex in range(1, len(text) - len(run) + 2):
+                    if isLegalFurigana(text[:untilIndex]):
+                        for split in _splitRun(run[1:], text[untilIndex:]):
+                            splits.append([(run[0], text[:untilIndex])] + split)
+            runSplits[(run, text)] = splits
+        return runSplits[(run, text)]
+
+    alignments = []
+
+    def _align(index, start, runs):
+        if index == len(segments):
+            if start == len(furigana):
+                alignments.append(runs)
             return
 
-        for untilIndex in range(len(furigana) - len(kanji) + 1):
-            if isLegalFurigana(furigana[:untilIndex + 1]):
-                extendedPartial = list(partial)
-                extendedPartial.append((kanji[0], furigana[:untilIndex + 1]))
-                _search(extendedPartial, kanji[1:], furigana[untilIndex + 1:])
+        kana, text = segments[index]
+        if kana:
+            if furigana.startswith(text, start):
+                _align(index + 1, start + len(text), runs)
+        elif index == len(segments) - 1:
+            if len(furigana) - start >= len(text):
+                _align(index + 1, len(furigana), runs + [(text, furigana[start:])])
+        else:
+            anchor = segments[index + 1][1]
+            end = furigana.find(anchor, start + len(text))
+            while end != -1:
+                _align(index + 1, end, runs + [(text, furigana[start:end])])
+                end = furigana.find(anchor, end + 1)
+
+    _align(0, 0, [])
 
-    _search(list(), kanji, furigana)
+    partitions = []
+    for runs in alignments:
+        for splits in itertools.product(*[_splitRun(run, text) for run, text in runs]):
+            partitions.append([t for split in splits for t in split])
 
+    # same order as a search over the kanjis from left to right, trying the
+    # shortest furigana first
+    partitions.sort(key=lambda p: [len(f) for _, f in p])
     return partitions
 
 def omegaHeuristics(partitions):
@@ -102,10 +172,28 @@ def addDistribution(d1, d2, weight = 1.0):
         else:
             d1[k] = d2[k] * weight
 
-def isSameDistribution(d1, d2):
+def mixDistributions(d1, d2, weight):
+    # weight * d1 + (1 - weight) * d2 (no normalization provided)
+    mixed = {}
+    for k in set(d1.iterkeys()) | set(d2.iterkeys()):
+        mixed[k] = weight * d1.get(k, 0.0) + (1.0 - weight) * d2.get(k, 0.0)
+    return mixed
+
+def distributionDelta(d1, d2):
+    # the largest difference between the probabilities of two distributions
+    delta = 0.0
     for k in set(d1.iterkeys()) | set(d2.iterkeys()):
-        if abs(d1.get(k, 0.0) - d2.get(k, 0.0)) > 1e-6:
-            return False
-    return True
+        delta = max(delta, abs(d1.get(k, 0.0) - d2.get(k, 0.0)))
+    return delta
+
+SAME_DISTRIBUTION_TOLERANCE = 1e-6
+def isSameDistribution(d1, d2):
+    return distributionDelta(d1, d2) <= SAME_DISTRIBUTION_TOLERANCE
+
+def vectorDelta(v1, v2):
+    # the largest difference between the entries of two weight vectors, the
+    # shorter one (e.g. not adjusted yet) is padded with zeros
+    deltas = [abs(a - b) for a, b in itertools.izip_longest(v1, v2, fillvalue=0.0)]
+    return max(deltas or [0.0])
 
 